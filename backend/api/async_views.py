@@ -0,0 +1,176 @@
+"""
+Асинхронные варианты представлений чтения для запуска под ASGI.
+В Django 3.2 нет асинхронного ORM, а DRF не поддерживает асинхронные
+APIView, поэтому запрос на чтение (GET, HEAD) целиком выполняется
+в ограниченном пуле потоков (ASYNC_VIEW_THREADS на процесс), а цикл
+событий тем временем принимает другие запросы. Синхронные представления
+и запросы на изменение тех же маршрутов Django под ASGI выполняет
+по очереди в одном общем потоке процесса.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+from django.urls import URLPattern
+
+from .metrics import track_queries
+
+# маршруты DefaultRouter, которые под ASGI обслуживаются асинхронно
+ASYNC_ROUTE_NAMES = frozenset((
+    'tag-list', 'tag-detail', 'ingredient-list', 'ingredient-detail',
+    'recipe-list', 'recipe-detail', 'recipe-download-shopping-cart',
+))
+
+# методы, которые выполняются в пуле: запросы на изменение (в том числе
+# загрузка изображений) не занимают потоки, рассчитанные на чтение
+ASYNC_METHODS = frozenset(('GET', 'HEAD'))
+# частей потокового ответа в очереди между потоком пула и циклом событий
+STREAM_QUEUE_SIZE = 4
+
+executor = ThreadPoolExecutor(max_workers=settings.ASYNC_VIEW_THREADS,
+                              thread_name_prefix='async-view')
+
+
+def call_view(view, request, *args, **kwargs):
+    """
+    Вызов синхронного представления; ответ формируется здесь же,
+    части потокового ответа (список покупок) читает позже
+    StreamingASGIHandler.
+    """
+    response = view(request, *args, **kwargs)
+    if callable(getattr(response, 'render', None)):
+        response.render()
+    return response
+
+
+def call_in_thread(view, request, *args, **kwargs):
+    """
+    Вызов синхронного представления в потоке пула.
+    Соединения потоков пула закрываются, как в конце синхронного
+    запроса, с учетом CONN_MAX_AGE.
+    """
+    close_old_connections()
+    try:
+        with track_queries():
+            return call_view(view, request, *args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+run_in_pool = sync_to_async(call_in_thread, thread_sensitive=False,
+                            executor=executor)
+# как синхронное представление Django: в общем потоке процесса
+run_sync = sync_to_async(call_view, thread_sensitive=True)
+
+
+def async_view(view):
+    """
+    Асинхронная обертка синхронного представления: чтение в пуле
+    потоков, изменения - как у синхронного представления.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method in ASYNC_METHODS:
+            return await run_in_pool(view, request, *args, **kwargs)
+        return await run_sync(view, request, *args, **kwargs)
+    return wrapper
+
+
+def async_urlpatterns(urlpatterns, names=ASYNC_ROUTE_NAMES):
+    """Копия маршрутов, где представления маршрутов names асинхронные."""
+    return [
+        URLPattern(pattern.pattern, async_view(pattern.callback),
+                   pattern.default_args, pattern.name)
+        if pattern.name in names else pattern
+        for pattern in urlpatterns
+    ]
+
+
+async def iterate_in_pool(iterable):
+    """
+    Асинхронный перебор частей синхронного потокового ответа.
+    Части читает одна задача пула потоков, поэтому запросы к базе данных
+    выполняются в одном потоке и соединении, а не в цикле событий.
+    Очередь ограничена: ответ целиком в памяти не собирается, а поток
+    ждет, пока клиент примет уже прочитанные части.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        close_old_connections()
+        try:
+            for part in iterable:
+                if stopped.is_set():
+                    return
+                put(part)
+        finally:
+            close_old_connections()
+            if not stopped.is_set():
+                put(end)
+
+    task = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            part = await queue.get()
+            if part is end:
+                break
+            yield part
+    finally:
+        # клиент отключился: освободить очередь и дождаться потока
+        stopped.set()
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.wait([task])
+    task.result()
+
+
+def response_headers(response):
+    """Заголовки и cookie ответа для сообщения http.response.start."""
+    headers = []
+    for header, value in response.items():
+        if isinstance(header, str):
+            header = header.encode('ascii')
+        if isinstance(value, str):
+            value = value.encode('latin1')
+        headers.append((bytes(header), bytes(value)))
+    for cookie in response.cookies.values():
+        headers.append(
+            (b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+    return headers
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    Обработчик ASGI, который читает потоковые ответы в пуле потоков.
+    Django 3.2 перебирает части потокового ответа прямо в цикле
+    событий, где обращения к базе данных запрещены.
+    """
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': response_headers(response),
+        })
+        parts = iterate_in_pool(response)
+        try:
+            async for part in parts:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+        finally:
+            await parts.aclose()
+        await send({'type': 'http.response.body'})
+        await sync_to_async(response.close, thread_sensitive=True)()
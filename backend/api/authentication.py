@@ -0,0 +1,202 @@
+"""
+Аутентификация по токену без запроса к базе данных на каждый запрос.
+"""
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from users.models import User
+
+TOKEN_CACHE_KEY = 'auth_token:{}'
+REVOKED_CACHE_KEY = 'auth_token_revoked:{}'
+REVOCATIONS_CACHE_KEY = 'auth_token_revocations'
+# поля пользователя в кэше: их хватает для /api/users/me/ и проверок прав,
+# остальные поля загружаются при первом обращении (User.refresh_from_db)
+CACHED_USER_FIELDS = ('id', 'email', 'username', 'first_name', 'last_name',
+                      'is_active', 'is_staff', 'is_superuser')
+
+
+def token_cache_key(key):
+    # сам токен в ключах кэша не хранится
+    return TOKEN_CACHE_KEY.format(sha256(key.encode()).hexdigest())
+
+
+class LocalTokenCache:
+    """
+    LRU-кэш записей (поля пользователя, счетчик отзывов) по токену
+    в памяти процесса с ограничением времени жизни записи.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        ttl = settings.TOKEN_CACHE_LOCAL_TTL
+        if not ttl:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.TOKEN_CACHE_LOCAL_SIZE:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_token_cache = LocalTokenCache()
+
+
+class Revocations:
+    """
+    Счетчик отзывов токенов в общем кэше. Процесс читает его не чаще
+    раза в TOKEN_CACHE_REVOCATION_INTERVAL секунд; записи LRU,
+    сохраненные при другом значении счетчика, не используются.
+    """
+
+    def __init__(self):
+        self._value = None
+        self._checked_at = None
+
+    def current(self):
+        now = time.monotonic()
+        if (self._checked_at is None or now - self._checked_at
+                >= settings.TOKEN_CACHE_REVOCATION_INTERVAL):
+            self._value = cache.get(REVOCATIONS_CACHE_KEY, 0)
+            self._checked_at = now
+        return self._value
+
+    def bump(self):
+        cache.add(REVOCATIONS_CACHE_KEY, 0, None)
+        try:
+            value = cache.incr(REVOCATIONS_CACHE_KEY)
+        except ValueError:
+            # счетчик вытеснен из кэша между add и incr
+            value = 1
+            cache.set(REVOCATIONS_CACHE_KEY, value, None)
+        self._value, self._checked_at = value, time.monotonic()
+
+    def reset(self):
+        self._value = self._checked_at = None
+
+
+revocations = Revocations()
+
+
+def revoked_cache_key(key):
+    return REVOKED_CACHE_KEY.format(sha256(key.encode()).hexdigest())
+
+
+def invalidate_tokens(*keys):
+    """
+    Удаление токенов из кэшей. Отметка об отзыве в общем кэше
+    не дает повторно сохранить устаревшую запись, а новое значение
+    счетчика отзывов - доверять своим записям LRU другим процессам.
+    """
+    for key in keys:
+        local_token_cache.delete(key)
+    if not settings.TOKEN_CACHE_SHARED:
+        return
+    cache.delete_many([token_cache_key(key) for key in keys])
+    cache.set_many({revoked_cache_key(key): True for key in keys},
+                   settings.TOKEN_CACHE_TTL)
+    revocations.bump()
+
+
+def user_fields(user):
+    return {name: getattr(user, name) for name in CACHED_USER_FIELDS}
+
+
+def cached_user(fields):
+    """Пользователь из полей в кэше без запроса к базе."""
+    # from_db ждет значения в порядке полей модели
+    names = [field.attname for field in User._meta.concrete_fields
+             if field.attname in fields]
+    return User.from_db(DEFAULT_DB_ALIAS, names,
+                        [fields[name] for name in names])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication с кэшированием пользователя по токену:
+    LRU в памяти процесса, затем общий кэш (TOKEN_CACHE_SHARED),
+    затем запрос Token JOIN User. В кэшах хранятся поля пользователя
+    CACHED_USER_FIELDS. Кэш сбрасывается сигналами при выходе, смене
+    пароля и изменении пользователя: в своем процессе сразу, в других -
+    через TOKEN_CACHE_REVOCATION_INTERVAL секунд при общем кэше
+    и через TOKEN_CACHE_LOCAL_TTL секунд без него.
+    """
+
+    def authenticate_credentials(self, key):
+        if not settings.TOKEN_CACHE:
+            return super().authenticate_credentials(key)
+        fields = self.get_cached(key)
+        if fields is None:
+            user, token = super().authenticate_credentials(key)
+            self.set_cached(key, user_fields(user))
+            return user, token
+        if not fields['is_active']:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+        return cached_user(fields), Token(key=key, user_id=fields['id'])
+
+    @staticmethod
+    def get_cached(key):
+        """Поля пользователя, если токен не отозван после их сохранения."""
+        shared = settings.TOKEN_CACHE_SHARED
+        version = revocations.current() if shared else None
+        entry = local_token_cache.get(key)
+        if entry is not None:
+            fields, entry_version = entry
+            if entry_version == version:
+                return fields
+            local_token_cache.delete(key)
+        if not shared:
+            return None
+        values = cache.get_many([token_cache_key(key),
+                                 revoked_cache_key(key)])
+        if revoked_cache_key(key) in values:
+            return None
+        fields = values.get(token_cache_key(key))
+        if fields is not None:
+            local_token_cache.set(key, (fields, version))
+        return fields
+
+    @staticmethod
+    def set_cached(key, fields):
+        if not settings.TOKEN_CACHE_SHARED:
+            local_token_cache.set(key, (fields, None))
+            return
+        version = revocations.current()
+        # запись, прочитанная до отзыва токена, не сохраняется
+        if cache.get(revoked_cache_key(key)) is not None:
+            return
+        local_token_cache.set(key, (fields, version))
+        cache.set(token_cache_key(key), fields, settings.TOKEN_CACHE_TTL)
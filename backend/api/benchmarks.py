@@ -0,0 +1,583 @@
+"""
+Сценарии нагрузочных замеров.
+Каждый сценарий создает свои данные внутри транзакции,
+которая откатывается после замера.
+Запуск: python manage.py benchmark [сценарий ...]
+Результаты можно сохранить как базовые (--save) и сравнивать
+с ними следующие запуски (--compare).
+"""
+import asyncio
+import functools
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.db import connection, transaction
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django_filters.rest_framework import filters
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from recipes.dataset import DatasetGenerator
+from recipes.models import (AmountIngredient, FeedEntry, Ingredient, Recipe,
+                            ShoppingCart, ShoppingCartIngredient, Subscribe,
+                            Tag)
+from users.models import User
+
+from .async_views import async_view
+from .filters import RecipeFilter
+from .ingredient_index import ingredient_index
+from .pantry import pantry_index
+from .serializers import IngredientSerializer
+from .similarity import recipe_matrix
+from .views import (BulkShoppingCartView, IngredientViewSet, RecipeViewSet,
+                    ShoppingCartView, SubscriptionsView, TagViewSet)
+
+SCENARIOS = {}
+BENCHMARK_IMAGE = 'recipes/images/benchmark.jpg'
+
+
+def scenario(name):
+    """Регистрация сценария замера."""
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+def measure(func, repeat=5):
+    """
+    Замер функции: медианное время, пропускная способность
+    в одном потоке, число SQL-запросов и пиковый объем
+    выделенной памяти за один вызов.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    with CaptureQueriesContext(connection) as queries:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    median = statistics.median(timings)
+    return {
+        'ms': round(median, 3),
+        'rps': round(1000 / median, 1) if median else None,
+        'queries': len(queries),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def call_view(view, path, user=None, view_kwargs=None, method='get',
+              data=None, **params):
+    """
+    Вызов представления в обход маршрутизации и middleware.
+    params - параметры GET-запроса, data - тело запроса других методов.
+    """
+    if method == 'get':
+        request = APIRequestFactory().get(path, params)
+    else:
+        request = getattr(APIRequestFactory(), method)(path, data,
+                                                       format='json')
+    if user is not None:
+        force_authenticate(request, user)
+    response = view(request, **(view_kwargs or {}))
+    if response.status_code >= 400:
+        raise RuntimeError(f'{path}: статус {response.status_code}')
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    else:
+        response.render()
+    return response
+
+
+def make_user(username):
+    return User.objects.create_user(username=username,
+                                    email=f'{username}@benchmark.local')
+
+
+def make_ingredients(count, prefix='Ингредиент'):
+    Ingredient.objects.bulk_create(
+        Ingredient(name=f'{prefix} {i}', measurement_unit='г')
+        for i in range(count)
+    )
+    return list(Ingredient.objects.filter(name__startswith=prefix))
+
+
+def make_tags(count):
+    Tag.objects.bulk_create(
+        Tag(name=f'Тег {i}', color='#FF8000', slug=f'benchmark-{i}')
+        for i in range(count)
+    )
+    return list(Tag.objects.filter(slug__startswith='benchmark-'))
+
+
+def make_recipes(author, count, ingredients, per_recipe):
+    """Рецепты автора с per_recipe ингредиентами в каждом."""
+    Recipe.objects.bulk_create(
+        Recipe(name=f'Рецепт {i}', text='Описание', cooking_time=10,
+               image=BENCHMARK_IMAGE, author=author)
+        for i in range(count)
+    )
+    recipes = list(Recipe.objects.filter(author=author))
+    AmountIngredient.objects.bulk_create(
+        AmountIngredient(
+            recipe=recipe,
+            ingredient=ingredients[(i + j) % len(ingredients)],
+            amount=j + 1
+        )
+        for i, recipe in enumerate(recipes)
+        for j in range(per_recipe)
+    )
+    return recipes
+
+
+@scenario('shopping_list')
+def shopping_list_scenario(repeat):
+    """Скачивание списка покупок для корзины из 1000 рецептов."""
+    user = make_user('benchmark')
+    ingredients = make_ingredients(300)
+    recipes = make_recipes(user, 1000, ingredients, 10)
+    ShoppingCart.objects.bulk_create(
+        ShoppingCart(user=user, recipe=recipe) for recipe in recipes)
+    ShoppingCartIngredient.objects.rebuild([user.id])
+    view = RecipeViewSet.as_view(
+        {'get': 'download_shopping_cart'},
+        **RecipeViewSet.download_shopping_cart.kwargs
+    )
+    results = {}
+    for file_format in ('txt', 'csv', 'pdf'):
+        results[file_format] = measure(
+            lambda: call_view(view, '/api/recipes/download_shopping_cart/',
+                              user, format=file_format),
+            repeat
+        )
+    return results
+
+
+@scenario('ingredient_search')
+def ingredient_search_scenario(repeat):
+    """Поиск ингредиентов по началу названия: база данных и индекс."""
+    make_ingredients(2200)
+    ingredient_index.invalidate()
+    ingredient_index.ensure_built()
+    return {
+        'database': measure(lambda: IngredientSerializer(
+            Ingredient.objects.filter(name__istartswith='ингредиент 12'),
+            many=True).data, repeat),
+        'index': measure(
+            lambda: ingredient_index.search('ингредиент 12'), repeat),
+    }
+
+
+@scenario('recipe_search')
+def recipe_search_scenario(repeat):
+    """
+    Поиск среди 20000 рецептов через API.
+    На PostgreSQL используются GIN-индексы полнотекстового поиска.
+    """
+    user = make_user('benchmark')
+    ingredients = make_ingredients(10)
+    make_recipes(user, 20000, ingredients, 1)
+    Recipe.objects.filter(id__in=Recipe.objects.filter(
+        author=user).values('id')[:20]).update(name='Борщ со сметаной')
+    view = RecipeViewSet.as_view({'get': 'list'})
+    return {
+        query: measure(lambda: call_view(view, '/api/recipes/',
+                                         search=query), repeat)
+        for query in ('борщ', 'Рецепт 1999', 'пельмени')
+    }
+
+
+class LegacyRecipeFilter(RecipeFilter):
+    """Прежний фильтр тегов: выбор значений через SELECT DISTINCT."""
+    tags = filters.AllValuesMultipleFilter(field_name='tags__slug')
+
+
+@scenario('tags_filter')
+def tags_filter_scenario(repeat):
+    """Фильтр по двум тегам на 100000 рецептов: до и после."""
+    user = make_user('benchmark')
+    tags = make_tags(6)
+    recipes = make_recipes(user, 100000, make_ingredients(10), 1)
+    Recipe.tags.through.objects.bulk_create(
+        Recipe.tags.through(recipe_id=recipe.id,
+                            tag_id=tags[i % len(tags)].id)
+        for i, recipe in enumerate(recipes)
+    )
+    params = {'tags': [tags[0].slug, tags[1].slug]}
+    results = {}
+    for case, filterset_class in (('all_values', LegacyRecipeFilter),
+                                  ('cached_ids', RecipeFilter)):
+        view = RecipeViewSet.as_view({'get': 'list'},
+                                     filterset_class=filterset_class)
+        results[case] = measure(
+            lambda: call_view(view, '/api/recipes/', **params), repeat)
+    return results
+
+
+@scenario('feed')
+def feed_scenario(repeat):
+    """
+    Лента пользователя, подписанного на 2000 авторов (10000 рецептов)
+    среди 20000 чужих рецептов: fan-out on read и fan-out on write.
+    """
+    user = make_user('benchmark')
+    User.objects.bulk_create(
+        User(username=f'benchmark-author-{i}',
+             email=f'benchmark-author-{i}@benchmark.local')
+        for i in range(2000)
+    )
+    authors = User.objects.filter(username__startswith='benchmark-author-')
+    Subscribe.objects.bulk_create(
+        Subscribe(user=user, author=author) for author in authors)
+    ingredients = make_ingredients(10)
+    Recipe.objects.bulk_create(
+        Recipe(name=f'Рецепт {i}', text='Описание', cooking_time=10,
+               image=BENCHMARK_IMAGE, author=author)
+        for author in authors for i in range(5)
+    )
+    make_recipes(make_user('benchmark-other'), 20000, ingredients, 1)
+    FeedEntry.objects.rebuild([user.id])
+    view = RecipeViewSet.as_view({'get': 'feed'},
+                                 **RecipeViewSet.feed.kwargs)
+    results = {}
+    for strategy in ('read', 'write'):
+        with override_settings(FEED_STRATEGY=strategy):
+            results[strategy] = measure(
+                lambda: call_view(view, '/api/recipes/feed/', user),
+                repeat)
+    return results
+
+
+@scenario('api')
+def api_scenario(repeat):
+    """
+    Основные запросы API на синтетических данных: 1000 пользователей,
+    10000 рецептов с 5-30 ингредиентами, избранное, корзины и подписки.
+    Повторные запросы рецепта и ингредиентов идут через кэш.
+    """
+    DatasetGenerator(users=1000, recipes=10, ingredients=2000,
+                     prefix='benchmark', image=BENCHMARK_IMAGE,
+                     seed=1).generate()
+    # у первого пользователя больше всего рецептов и подписчиков
+    user = User.objects.get(username='benchmark-0')
+    tags = list(Tag.objects.values_list('slug', flat=True)[:2])
+    recipe = Recipe.objects.order_by('-favorites_count').first()
+    ingredient = Ingredient.objects.order_by('id').first()
+    list_view = RecipeViewSet.as_view({'get': 'list'})
+    list_cases = {
+        'list': {},
+        'list_tags': {'tags': tags},
+        'list_author': {'author': user.id},
+        'list_favorited': {'is_favorited': 1},
+        'list_in_cart': {'is_in_shopping_cart': 1},
+        'list_search': {'search': 'курицей'},
+        'list_popular': {'ordering': 'popular'},
+    }
+    results = {
+        case: measure(lambda: call_view(list_view, '/api/recipes/', user,
+                                        **params), repeat)
+        for case, params in list_cases.items()
+    }
+    results['detail'] = measure(lambda: call_view(
+        RecipeViewSet.as_view({'get': 'retrieve'}),
+        f'/api/recipes/{recipe.id}/', user, {'pk': recipe.id}), repeat)
+    results['subscriptions'] = measure(lambda: call_view(
+        SubscriptionsView.as_view(), '/api/users/subscriptions/', user,
+        recipes_limit=3), repeat)
+    results['shopping_cart'] = measure(lambda: call_view(
+        RecipeViewSet.as_view({'get': 'download_shopping_cart'},
+                              **RecipeViewSet.download_shopping_cart.kwargs),
+        '/api/recipes/download_shopping_cart/', user), repeat)
+    results['ingredient_search'] = measure(lambda: call_view(
+        IngredientViewSet.as_view({'get': 'list'}), '/api/ingredients/',
+        name=ingredient.name[:3]), repeat)
+    return results
+
+
+def make_random_recipes(rng, count=100000, ingredients=2200):
+    """Рецепты с 5-30 случайными ингредиентами из ingredients."""
+    user = make_user('benchmark')
+    ingredient_ids = [ingredient.id
+                      for ingredient in make_ingredients(ingredients)]
+    recipes = make_recipes(user, count, [], 0)
+    AmountIngredient.objects.bulk_create(
+        (AmountIngredient(recipe_id=recipe.id, ingredient_id=ingredient_id,
+                          amount=1)
+         for recipe in recipes
+         for ingredient_id in rng.sample(ingredient_ids, rng.randint(5, 30))),
+        batch_size=10000
+    )
+    return recipes, ingredient_ids
+
+
+@scenario('similar')
+def similar_scenario(repeat):
+    """
+    Похожие рецепты среди 100000 рецептов с 5-30 из 2200 ингредиентов:
+    матрица в памяти и самосоединение AmountIngredient в SQL.
+    """
+    rng = random.Random(1)
+    recipes, ingredient_ids = make_random_recipes(rng)
+    recipe_id = recipes[len(recipes) // 2].id
+    pantry = rng.sample(ingredient_ids, 10)
+
+    def build():
+        recipe_matrix.invalidate()
+        recipe_matrix.get_snapshot()
+
+    def sql_self_join():
+        return list(AmountIngredient.objects.filter(
+            ingredient__in=AmountIngredient.objects.filter(
+                recipe_id=recipe_id).values('ingredient_id')
+        ).exclude(recipe_id=recipe_id).values('recipe_id').annotate(
+            common=Count('id')).order_by('-common', '-recipe_id')[:10])
+
+    def incremental_update():
+        recipe_matrix.mark_changed(recipe_id)
+        recipe_matrix.get_snapshot()
+
+    results = {'build': measure(build, 1)}
+    for metric in ('jaccard', 'cosine'):
+        results[f'similar_{metric}'] = measure(
+            lambda: recipe_matrix.similar(recipe_id, 10, metric), repeat)
+    results['by_ingredients'] = measure(
+        lambda: recipe_matrix.by_ingredients(pantry, 10), repeat)
+    results['incremental_update'] = measure(incremental_update, repeat)
+    results['sql_self_join'] = measure(sql_self_join, repeat)
+    recipe_matrix.invalidate()
+    return results
+
+
+@scenario('pantry')
+def pantry_scenario(repeat):
+    """
+    Рецепты из 300 продуктов среди 100000 рецептов с 5-30 из 2200
+    ингредиентов: битовые множества в памяти и NOT EXISTS в SQL.
+    """
+    rng = random.Random(1)
+    recipes, ingredient_ids = make_random_recipes(rng)
+    tags = make_tags(6)
+    Recipe.tags.through.objects.bulk_create(
+        Recipe.tags.through(recipe_id=recipe.id,
+                            tag_id=tags[i % len(tags)].id)
+        for i, recipe in enumerate(recipes)
+    )
+    pantry = rng.sample(ingredient_ids, 300)
+
+    def build():
+        pantry_index.invalidate()
+        pantry_index.get_snapshot()
+
+    def sql_not_exists(max_missing):
+        missing = AmountIngredient.objects.filter(
+            recipe_id=OuterRef('pk')).exclude(ingredient_id__in=pantry)
+        if not max_missing:
+            return list(Recipe.objects.filter(
+                ~Exists(missing)).values_list('id', flat=True))
+        return list(Recipe.objects.annotate(missing=Coalesce(Subquery(
+            missing.order_by().values('recipe_id').annotate(
+                total=Count('id')).values('total')), 0)
+        ).filter(missing__lte=max_missing).values_list('id', flat=True))
+
+    results = {'build': measure(build, 1)}
+    for max_missing in (0, 2):
+        results[f'index_missing_{max_missing}'] = measure(
+            lambda: pantry_index.matching(pantry, max_missing), repeat)
+        results[f'sql_missing_{max_missing}'] = measure(
+            lambda: sql_not_exists(max_missing), repeat)
+    results['index_tags'] = measure(lambda: pantry_index.matching(
+        pantry, 2, [tags[0].id, tags[1].id]), repeat)
+    pantry_index.invalidate()
+    return results
+
+
+@scenario('bulk_relations')
+def bulk_relations_scenario(repeat):
+    """
+    Заполнение и очистка корзины из 100 рецептов по 5 ингредиентов:
+    запрос на каждый рецепт и один массовый запрос.
+    """
+    user = make_user('benchmark')
+    recipes = make_recipes(make_user('benchmark-author'), 100,
+                           make_ingredients(50), 5)
+    ids = [recipe.id for recipe in recipes]
+    single_view = ShoppingCartView.as_view()
+    bulk_view = BulkShoppingCartView.as_view()
+    path = '/api/recipes/shopping_cart/'
+
+    def single():
+        for method in ('post', 'delete'):
+            for recipe_id in ids:
+                call_view(single_view, f'/api/recipes/{recipe_id}'
+                          '/shopping_cart/', user,
+                          {'recipe_id': recipe_id}, method)
+
+    def bulk():
+        for method in ('post', 'delete'):
+            call_view(bulk_view, path, user, method=method,
+                      data={'ids': ids})
+
+    return {'single': measure(single, repeat),
+            'bulk': measure(bulk, repeat)}
+
+
+CONCURRENCY = 64
+QUERY_LATENCY = 0.002
+
+
+def delayed(view):
+    """
+    Представление, каждый запрос SQL которого задержан на QUERY_LATENCY:
+    так выглядит обращение к PostgreSQL по сети.
+    """
+    def delay(execute, sql, params, many, context):
+        time.sleep(QUERY_LATENCY)
+        return execute(sql, params, many, context)
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with connection.execute_wrapper(delay):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+def read_requests(user, recipe_ids):
+    """CONCURRENCY запросов на чтение: (представление, запрос, kwargs)."""
+    factory = APIRequestFactory()
+    retrieve = RecipeViewSet.as_view({'get': 'retrieve'})
+    cases = [
+        (TagViewSet.as_view({'get': 'list'}), '/api/tags/', {}, {}),
+        (IngredientViewSet.as_view({'get': 'list'}), '/api/ingredients/',
+         {'name': 'syn'}, {}),
+        (RecipeViewSet.as_view({'get': 'list'}), '/api/recipes/', {}, {}),
+        (RecipeViewSet.as_view(
+            {'get': 'download_shopping_cart'},
+            **RecipeViewSet.download_shopping_cart.kwargs),
+         '/api/recipes/download_shopping_cart/', {}, {}),
+    ]
+    requests = []
+    for i in range(CONCURRENCY):
+        if i % (len(cases) + 1) == len(cases):
+            recipe_id = recipe_ids[i % len(recipe_ids)]
+            view, path, params, kwargs = (
+                retrieve, f'/api/recipes/{recipe_id}/', {},
+                {'pk': recipe_id})
+        else:
+            view, path, params, kwargs = cases[i % (len(cases) + 1)]
+        request = factory.get(path, params)
+        force_authenticate(request, user)
+        requests.append((view, request, kwargs))
+    return requests
+
+
+def finish(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'статус {response.status_code}')
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    else:
+        response.render()
+
+
+@scenario('asgi')
+def asgi_scenario(repeat):
+    """
+    Пропускная способность одного воркера при CONCURRENCY одновременных
+    запросах на чтение (теги, ингредиенты, рецепты, список покупок):
+    синхронный воркер обрабатывает их по очереди, асинхронные
+    представления - в пуле из ASYNC_VIEW_THREADS потоков.
+    Потоки пула не видят данных незафиксированной транзакции сценария,
+    поэтому запросы идут к данным в базе (после generate_data);
+    в пустой базе сценарий пропускается.
+    """
+    cart = ShoppingCart.objects.select_related('user').first()
+    recipe_ids = list(Recipe.objects.values_list('id', flat=True)[:100])
+    if cart is None or not recipe_ids:
+        return {}
+    requests = read_requests(cart.user, recipe_ids)
+    sync_requests = [(delayed(view), request, kwargs)
+                     for view, request, kwargs in requests]
+    async_requests = [(async_view(delayed(view)), request, kwargs)
+                      for view, request, kwargs in requests]
+
+    def sync_worker():
+        for view, request, kwargs in sync_requests:
+            finish(view(request, **kwargs))
+
+    async def gather():
+        return await asyncio.gather(*(
+            view(request, **kwargs)
+            for view, request, kwargs in async_requests))
+
+    def async_worker():
+        for response in asyncio.run(gather()):
+            finish(response)
+
+    results = {}
+    for case, func in (('sync', sync_worker), ('async', async_worker)):
+        metrics = measure(func, repeat)
+        # запросы потоков пула не видны в соединении основного потока
+        del metrics['queries']
+        metrics['rps'] = round(CONCURRENCY * 1000 / metrics['ms'], 1)
+        results[case] = metrics
+    return results
+
+
+def run(names, repeat=5):
+    """Запуск сценариев с откатом созданных данных."""
+    results = {}
+    for name in names:
+        with transaction.atomic():
+            results[name] = SCENARIOS[name](repeat)
+            transaction.set_rollback(True)
+    return results
+
+
+def save_baseline(results, path):
+    """Сохранение результатов; сценарии из других запусков остаются."""
+    try:
+        baseline = load_baseline(path)
+    except FileNotFoundError:
+        baseline = {}
+    baseline.update(results)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(baseline, file, ensure_ascii=False, indent=2,
+                  sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def compare(results, baseline):
+    """
+    Изменение метрик относительно базовых результатов в процентах:
+    {сценарий: {случай: {метрика: (было, стало, изменение)}}}.
+    Случаи, которых нет в базовых результатах, пропускаются.
+    """
+    changes = {}
+    for name, cases in results.items():
+        for case, metrics in cases.items():
+            old_metrics = baseline.get(name, {}).get(case)
+            if old_metrics is None:
+                continue
+            changes.setdefault(name, {})[case] = {
+                metric: (old_metrics[metric], value,
+                         round((value - old_metrics[metric])
+                               / old_metrics[metric] * 100, 1)
+                         if old_metrics[metric] else None)
+                for metric, value in metrics.items()
+                if old_metrics.get(metric) is not None and value is not None
+            }
+    return changes
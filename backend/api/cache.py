@@ -0,0 +1,197 @@
+"""
+Кэширование ответов API с версиями по моделям.
+Версия модели хранится в том же кэше и увеличивается сигналами
+при изменении данных, поэтому устаревшие записи просто перестают читаться.
+В кэше процесса (locmem) версия живет CACHE_VERSION_TIMEOUT секунд:
+изменения из других процессов учитываются после ее истечения.
+По тем же версиям строятся ETag и Last-Modified для условных запросов.
+"""
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from recipes.models import Recipe
+
+VERSION_KEY = 'version:{}'
+# поля рецепта, зависящие от пользователя: не попадают в общий кэш
+RECIPE_USER_FIELDS = ('is_favorited', 'is_in_shopping_cart')
+RECIPE_VERSIONS = ('recipe', 'tag', 'ingredient', 'user')
+
+
+def initial_version():
+    # после вытеснения ключа версии счетчик не должен начаться заново
+    return int(time.time() * 1000)
+
+
+def get_version_values(*names):
+    """Текущие версии моделей; новая версия - время в миллисекундах."""
+    keys = [VERSION_KEY.format(name) for name in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = initial_version()
+            if not cache.add(key, version,
+                             timeout=settings.CACHE_VERSION_TIMEOUT):
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def get_versions(*names):
+    """Строка с текущими версиями моделей для ключа кэша."""
+    return '.'.join(map(str, get_version_values(*names)))
+
+
+def bump_versions(*names):
+    """
+    Новая версия строго больше прежней и не меньше текущего времени,
+    поэтому версии служат и датой последнего изменения.
+    """
+    now = initial_version()
+    for name in names:
+        key = VERSION_KEY.format(name)
+        try:
+            version = cache.incr(key)
+        except ValueError:
+            version = None
+        if version is None or version < now:
+            cache.set(key, now, timeout=settings.CACHE_VERSION_TIMEOUT)
+
+
+def relations_version_name(user_id):
+    """Версия избранного, корзины и подписок пользователя."""
+    return f'relations:{user_id}'
+
+
+def recipe_cache_key(request, recipe_id):
+    """
+    Ключ общей части рецепта. Ссылки на изображения в ней абсолютные,
+    поэтому в ключ входят схема и хост запроса.
+    """
+    origin = md5(request.build_absolute_uri('/').encode()).hexdigest()
+    return (f'recipe:{recipe_id}:{origin}:'
+            f'{get_versions(*RECIPE_VERSIONS)}')
+
+
+def split_recipe(data):
+    """Общая часть представления рецепта без полей пользователя."""
+    shared = {key: value for key, value in data.items()
+              if key not in RECIPE_USER_FIELDS}
+    shared['author'] = {key: value for key, value in data['author'].items()
+                        if key != 'is_subscribed'}
+    return shared
+
+
+def merge_recipe(shared, flags):
+    """Представление рецепта для пользователя из общей части и флагов."""
+    data = dict(shared)
+    data['is_favorited'] = flags['is_favorited']
+    data['is_in_shopping_cart'] = flags['is_in_shopping_cart']
+    data['author'] = dict(shared['author'],
+                          is_subscribed=flags['author_is_subscribed'])
+    return data
+
+
+class ConditionalGetMixin:
+    """
+    Условные GET-запросы (If-None-Match, If-Modified-Since) для list
+    и retrieve. ETag и Last-Modified считаются по версиям моделей,
+    поэтому ответ 304 отдается без сериализации данных.
+    """
+    cache_versions = ()
+
+    def get_conditional_state(self, request, *args, **kwargs):
+        """
+        Части ETag и время последнего изменения (в миллисекундах)
+        или None, если условный ответ невозможен.
+        """
+        versions = get_version_values(*self.cache_versions)
+        return [request.get_full_path(), *versions], max(versions)
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        state = self.get_conditional_state(request, *args, **kwargs)
+        if state is None:
+            return handler(request, *args, **kwargs)
+        parts, last_modified = state
+        etag = quote_etag(
+            md5(':'.join(map(str, parts)).encode()).hexdigest())
+        last_modified //= 1000
+        if last_modified >= int(time.time()):
+            # Last-Modified с точностью до секунды не отличит следующее
+            # изменение в ту же секунду: до ее окончания только ETag
+            last_modified = None
+        # при If-None-Match заголовок If-Modified-Since не проверяется
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request,
+                                         *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request,
+                                         *args, **kwargs)
+
+
+class VersionedCacheMixin:
+    """
+    Кэширование list и retrieve для представлений без данных пользователя.
+    Ключ включает путь запроса и версии моделей из cache_versions.
+    """
+    cache_versions = ()
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        path = md5(request.get_full_path().encode()).hexdigest()
+        key = (f'response:{self.basename}:{path}:'
+               f'{get_versions(*self.cache_versions)}')
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request,
+                                    *args, **kwargs)
+
+
+class RecipeDetailCacheMixin:
+    """
+    Кэширование отдельного рецепта. В кэше хранится общая часть,
+    поля текущего пользователя добавляются одним запросом.
+    Запросы с параметрами (фильтры ?is_favorited= и другие) идут
+    мимо кэша: рецепт должен пройти filter_queryset.
+    """
+
+    def retrieve(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().retrieve(request, *args, **kwargs)
+        key = recipe_cache_key(request, kwargs['pk'])
+        shared = cache.get(key)
+        if shared is None:
+            response = super().retrieve(request, *args, **kwargs)
+            cache.set(key, split_recipe(response.data))
+            return response
+        flags = {'is_favorited': False, 'is_in_shopping_cart': False,
+                 'author_is_subscribed': False}
+        if request.user.is_authenticated:
+            flags = Recipe.objects.filter(pk=shared['id']).with_user_flags(
+                request.user).values(*flags).first() or flags
+        return Response(merge_recipe(shared, flags))
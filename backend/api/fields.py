@@ -0,0 +1,101 @@
+import uuid
+
+from django.core.files import File
+from drf_extra_fields.fields import Base64FieldMixin
+from PIL import Image, UnidentifiedImageError
+from rest_framework import serializers
+
+from .images import variant_names
+
+
+class Base64ImageUploadField(Base64FieldMixin, serializers.FileField):
+    """
+    Изображение в base64 без полного декодирования через Pillow в запросе.
+    Формат определяется по сигнатуре файла, целостность проверяется
+    verify(), файл сохраняется как есть, уменьшенные копии делает
+    фоновая обработка (api.images).
+    Принимает и уже декодированный файл от StreamingJSONParser.
+    """
+    ALLOWED_TYPES = ('jpeg', 'png', 'gif', 'webp')
+    # verify() не замечает обрезанные JPEG и GIF: они декодируются,
+    # JPEG - в уменьшенном виде (draft)
+    DECODED_TYPES = ('JPEG', 'GIF')
+    INVALID_FILE_MESSAGE = 'Загрузите корректное изображение.'
+    INVALID_TYPE_MESSAGE = 'Неподдерживаемый формат изображения.'
+    TOO_LARGE_MESSAGE = 'Слишком большое разрешение изображения.'
+    SIGNATURES = (
+        (b'\xff\xd8\xff', 'jpeg'),
+        (b'\x89PNG\r\n\x1a\n', 'png'),
+        (b'GIF87a', 'gif'),
+        (b'GIF89a', 'gif'),
+    )
+
+    def to_internal_value(self, data):
+        if not isinstance(data, File):
+            file = super().to_internal_value(data)
+        else:
+            data.seek(0)
+            extension = self.get_file_extension(None, data.read(12))
+            data.seek(0)
+            if extension not in self.ALLOWED_TYPES:
+                raise serializers.ValidationError(self.INVALID_TYPE_MESSAGE)
+            data.name = f'{uuid.uuid4()}.{extension}'
+            file = serializers.FileField.to_internal_value(self, data)
+        if file is not None:
+            self.verify_image(file)
+        return file
+
+    def verify_image(self, file):
+        try:
+            with Image.open(file) as image:
+                decode = image.format in self.DECODED_TYPES
+                image.verify()
+            if decode:
+                file.seek(0)
+                with Image.open(file) as image:
+                    image.draft('RGB', (1, 1))
+                    image.load()
+        except Image.DecompressionBombError:
+            raise serializers.ValidationError(self.TOO_LARGE_MESSAGE)
+        except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+            raise serializers.ValidationError(self.INVALID_FILE_MESSAGE)
+        finally:
+            file.seek(0)
+
+    def get_file_extension(self, filename, decoded_file):
+        if decoded_file[:4] == b'RIFF' and decoded_file[8:12] == b'WEBP':
+            return 'webp'
+        for signature, extension in self.SIGNATURES:
+            if decoded_file.startswith(signature):
+                return extension
+        return None
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """
+    Ссылки на уменьшенные копии изображения рецепта:
+    {вариант: {формат: ссылка}} или None, пока копии не готовы.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        if recipe.image_status != recipe.IMAGE_READY or not recipe.image:
+            return None
+        request = self.context.get('request')
+        storage = recipe.image.storage
+        return {
+            variant: {
+                extension: self.build_url(request, storage.url(name))
+                for extension, name in formats.items()
+            }
+            for variant, formats in variant_names(recipe.image.name).items()
+        }
+
+    @staticmethod
+    def build_url(request, url):
+        if request is None:
+            return url
+        return request.build_absolute_uri(url)
@@ -1,45 +1,131 @@
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import FilterSet, filters
-from rest_framework.filters import SearchFilter
+from rest_framework.exceptions import ValidationError
 
-from recipes.models import Recipe
+from recipes.models import Recipe, Tag
 
+TAG_IDS_CACHE_KEY = 'tag_ids_by_slug'
+# сортировка по популярности, совпадает с индексом recipe_popularity_idx
+POPULAR_ORDERING = ('-favorites_count', '-id')
 
-class IngredientSearchFilter(SearchFilter):
-    search_param = 'name'
+
+def get_tag_ids(slugs=()):
+    """
+    Словарь slug -> id всех тегов.
+    Хранится в кэше не дольше CACHE_TIMEOUT и сбрасывается при изменении
+    тегов. Словарь без какого-либо из слагов slugs перечитывается из базы:
+    тег мог добавить другой процесс (import_tags).
+    """
+    tag_ids = cache.get(TAG_IDS_CACHE_KEY)
+    if tag_ids is None or not tag_ids.keys() >= set(slugs):
+        tag_ids = dict(Tag.objects.values_list('slug', 'id'))
+        cache.set(TAG_IDS_CACHE_KEY, tag_ids)
+    return tag_ids
+
+
+def tag_choices():
+    return [(slug, slug) for slug in get_tag_ids()]
 
 
 class RecipeFilter(FilterSet):
     """
     Фильтрация рецептов.
     По автору, тегам, нахождению в избранном и списке покупок.
+    Поиск по названию и описанию (?search=) с сортировкой по релевантности.
+    Сортировка по числу добавлений в избранное: ?ordering=popular.
     """
     is_favorited = filters.BooleanFilter(method='filter_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(method='filter_is_in_shopping')
-    tags = filters.AllValuesMultipleFilter(field_name='tags__slug')
+    tags = filters.MultipleChoiceFilter(choices=tag_choices,
+                                        method='filter_tags')
+    search = filters.CharFilter(method='filter_search')
+    ordering = filters.ChoiceFilter(
+        choices=(('popular', 'По популярности'),),
+        method='filter_ordering'
+    )
 
     class Meta:
         model = Recipe
-        fields = ('is_favorited', 'is_in_shopping_cart', 'author', 'tags')
+        fields = ('is_favorited', 'is_in_shopping_cart', 'author', 'tags',
+                  'search', 'ordering')
+
+    def __init__(self, data=None, *args, **kwargs):
+        super().__init__(data, *args, **kwargs)
+        if data is None:
+            return
+        slugs = (data.getlist('tags') if hasattr(data, 'getlist')
+                 else data.get('tags'))
+        if slugs:
+            # варианты tags проверяются по словарю с запрошенными слагами
+            get_tag_ids(slugs)
 
     def filter_is_favorited(self, queryset, name, value):
         if value:
-            return queryset.filter(favorite__user=self.request.user)
+            return queryset.filter(is_favorited=True)
         return queryset
 
     def filter_is_in_shopping(self, queryset, name, value):
         if value:
-            return queryset.filter(shopping__user=self.request.user)
+            return queryset.filter(is_in_shopping_cart=True)
         return queryset
 
+    def filter_tags(self, queryset, name, value):
+        """
+        Рецепты хотя бы с одним из тегов.
+        Слаги переводятся в id по кэшу, и проверка идет одним
+        подзапросом с IN по связующей таблице, без JOIN и DISTINCT.
+        """
+        if not value:
+            return queryset
+        tag_ids = get_tag_ids(value)
+        return queryset.filter(Exists(Recipe.tags.through.objects.filter(
+            recipe_id=OuterRef('pk'),
+            tag_id__in=[tag_ids[slug] for slug in value]
+        )))
+
+    def filter_search(self, queryset, name, value):
+        value = value.strip()
+        if not value:
+            return queryset
+        return queryset.search(value).order_by('-rank', '-pub_date', '-id')
+
+    def filter_ordering(self, queryset, name, value):
+        return queryset.order_by(*POPULAR_ORDERING)
+
+
+def get_recipes_limit(request):
+    """
+    Значение параметра recipes_limit или None,
+    если параметр не передан или не является положительным числом.
+    """
+    limit = request.query_params.get('recipes_limit')
+    if limit is None or not limit.isdigit() or not int(limit):
+        return None
+    return int(limit)
+
+
+def get_ingredient_ids(request):
+    """
+    id ингредиентов из параметра ingredients:
+    ?ingredients=1,2 или ?ingredients=1&ingredients=2.
+    """
+    values = [value for param in request.query_params.getlist('ingredients')
+              for value in param.split(',') if value.strip()]
+    if not all(value.strip().isdigit() for value in values):
+        raise ValidationError(
+            {'ingredients': 'Ожидаются id ингредиентов через запятую.'})
+    return {int(value) for value in values}
+
 
 def recipes_limit(request, obj):
     """
     Ограничение количества выводимых рецептов.
     Используется при выводе подписок пользователя.
     """
-    limit = request.query_params.get('recipes_limit')
+    limit = get_recipes_limit(request)
     if limit:
-        recipes = obj.recipes.all()[:int(limit)]
+        recipes = obj.recipes.all()[:limit]
     else:
         recipes = obj.recipes.all()
     return recipes
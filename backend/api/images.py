@@ -0,0 +1,161 @@
+"""
+Фоновая обработка изображений рецептов.
+Загруженный файл сохраняется как есть, а уменьшенные копии
+(thumbnail, card, full) в WebP и JPEG готовит поток-обработчик
+с очередью в памяти процесса. Рецепты, не обработанные до перезапуска,
+дообрабатывает команда process_images.
+"""
+import logging
+import os
+import queue
+import threading
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from recipes.models import Recipe
+
+from .cache import bump_versions
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = 'recipes/variants'
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def variant_name(image_name, variant, extension):
+    """Имя копии строится по имени исходного файла."""
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    return f'{VARIANTS_DIR}/{stem}/{variant}.{extension}'
+
+
+def variant_names(image_name):
+    """{вариант: {расширение: имя файла}} для исходного файла."""
+    return {
+        variant: {extension: variant_name(image_name, variant, extension)
+                  for extension in FORMATS}
+        for variant in settings.IMAGE_VARIANTS
+    }
+
+
+def encode(image, extension):
+    if extension == 'jpeg' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    buffer = BytesIO()
+    image.save(buffer, FORMATS[extension],
+               quality=settings.IMAGE_VARIANT_QUALITY)
+    return buffer.getvalue()
+
+
+def make_variants(image_name, force=False):
+    """
+    Уменьшенные копии изображения в хранилище.
+    Имя исходного файла задается его содержимым,
+    поэтому готовые копии повторно не создаются.
+    """
+    names = [name for formats in variant_names(image_name).values()
+             for name in formats.values()]
+    if not force and all(map(default_storage.exists, names)):
+        return
+    storage = Recipe._meta.get_field('image').storage
+    with storage.open(image_name) as file:
+        with Image.open(file) as source:
+            source.load()
+            original = source.convert('RGBA')
+    for variant, size in settings.IMAGE_VARIANTS.items():
+        image = original.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        for extension in FORMATS:
+            replace_file(variant_name(image_name, variant, extension),
+                         encode(image, extension))
+
+
+def replace_file(name, content):
+    """
+    Запись файла через временное имя и переименование:
+    читатель видит либо прежний, либо новый файл целиком.
+    """
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        # хранилище без локальных путей: удаление и запись
+        default_storage.delete(name)
+        default_storage.save(name, ContentFile(content))
+        return
+    temp_name = default_storage.save(f'{name}.{uuid.uuid4().hex}.tmp',
+                                     ContentFile(content))
+    os.replace(default_storage.path(temp_name), path)
+
+
+def process_recipe(recipe_id, force=False):
+    """
+    Обработка изображения рецепта и смена его статуса.
+    Статус не меняется, если изображение успели заменить.
+    """
+    image_name = Recipe.objects.filter(pk=recipe_id).values_list(
+        'image', flat=True).first()
+    if not image_name:
+        return
+    try:
+        make_variants(image_name, force)
+        status = Recipe.IMAGE_READY
+    except (UnidentifiedImageError, Image.DecompressionBombError,
+            OSError, ValueError):
+        logger.warning('Не удалось обработать изображение %s', image_name)
+        status = Recipe.IMAGE_FAILED
+    if Recipe.objects.filter(pk=recipe_id, image=image_name).update(
+            image_status=status, updated_at=timezone.now()):
+        bump_versions('recipe')
+
+
+class ImagePipeline:
+    """
+    Очередь обработки изображений с одним потоком-обработчиком.
+    Поток запускается при первой задаче в каждом процессе.
+    При IMAGE_PIPELINE_ASYNC=False изображение обрабатывается сразу.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, recipe_id):
+        if not settings.IMAGE_PIPELINE_ASYNC:
+            process_recipe(recipe_id)
+            return
+        self.ensure_worker()
+        self._queue.put(recipe_id)
+
+    def ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self.run, name='image-pipeline', daemon=True)
+                self._worker.start()
+
+    def run(self):
+        while True:
+            recipe_id = self._queue.get()
+            try:
+                process_recipe(recipe_id)
+            except Exception:
+                logger.exception('Ошибка обработки рецепта %s', recipe_id)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def join(self):
+        """Ожидание обработки всех поставленных задач."""
+        self._queue.join()
+
+
+image_pipeline = ImagePipeline()
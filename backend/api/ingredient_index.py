@@ -0,0 +1,85 @@
+"""
+Индекс названий ингредиентов в памяти процесса.
+Отвечает на поиск по началу названия без обращения к базе данных.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from recipes.models import Ingredient
+
+# символ, больший любого символа в названии: граница диапазона префикса
+MAX_CHAR = '\U0010ffff'
+
+
+class IngredientIndex:
+    """
+    Отсортированный по названию (без учета регистра) список ингредиентов.
+    Строится при первом обращении, сбрасывается при изменении Ingredient.
+    Изменения из других процессов подхватываются по истечении ttl.
+    """
+
+    def __init__(self):
+        self._snapshot = ([], [])
+        self._built_at = None
+        self._generation = 0
+        self._built_generation = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name):
+        return name.casefold()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def is_fresh(self):
+        if self._built_generation != self._generation:
+            return False
+        ttl = settings.INGREDIENT_INDEX_TTL
+        return not ttl or time.monotonic() - self._built_at < ttl
+
+    def build(self):
+        # сброс во время построения не должен потеряться
+        generation = self._generation
+        entries = sorted(
+            (self.normalize(name), name, id, measurement_unit)
+            for id, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit').order_by()
+        )
+        # ключи и записи заменяются одним присваиванием,
+        # поэтому параллельный поиск видит согласованный снимок
+        self._snapshot = (
+            [entry[0] for entry in entries],
+            [{'id': id, 'name': name, 'measurement_unit': measurement_unit}
+             for _, name, id, measurement_unit in entries]
+        )
+        self._built_at = time.monotonic()
+        self._built_generation = generation
+
+    def ensure_built(self):
+        if self.is_fresh():
+            return
+        with self._lock:
+            if not self.is_fresh():
+                self.build()
+
+    def search(self, prefix, limit=None):
+        """
+        Ингредиенты, название которых начинается с prefix.
+        Точные совпадения идут первыми: ключ, равный префиксу,
+        всегда меньше остальных ключей с этим префиксом.
+        """
+        self.ensure_built()
+        keys, items = self._snapshot
+        key = self.normalize(prefix)
+        start = bisect_left(keys, key)
+        end = bisect_left(keys, key + MAX_CHAR, lo=start)
+        if limit is None:
+            limit = settings.INGREDIENT_SEARCH_LIMIT
+        return items[start:min(end, start + limit)]
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,83 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmarks import (SCENARIOS, compare, load_baseline, run,
+                            save_baseline)
+
+BASELINE_PATH = os.path.join(settings.BASE_DIR, 'benchmark-baseline.json')
+
+
+class Command(BaseCommand):
+    """
+    Замеры времени, количества запросов и памяти для API.
+    Данные сценариев создаются во временной транзакции и откатываются.
+    С --compare выводит изменения относительно сохраненных результатов,
+    с --max-regression завершается ошибкой при замедлении.
+    """
+    help = 'Запуск нагрузочных сценариев API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*',
+                            help='Сценарии (по умолчанию все).')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Количество повторов замера.')
+        parser.add_argument('--save', nargs='?', const=BASELINE_PATH,
+                            metavar='PATH',
+                            help='Сохранить результаты как базовые.')
+        parser.add_argument('--compare', nargs='?', const=BASELINE_PATH,
+                            metavar='PATH',
+                            help='Сравнить с базовыми результатами.')
+        parser.add_argument('--max-regression', type=float, metavar='PCT',
+                            help='Допустимое замедление в процентах; '
+                                 'число запросов расти не должно.')
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or list(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(
+                f'Неизвестные сценарии: {", ".join(sorted(unknown))}. '
+                f'Доступны: {", ".join(SCENARIOS)}')
+        baseline = None
+        if options['compare']:
+            try:
+                baseline = load_baseline(options['compare'])
+            except (OSError, ValueError) as error:
+                raise CommandError(f'Ошибка чтения базовых результатов: '
+                                   f'{error!r}')
+        results = run(names, options['repeat'])
+        for name, cases in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for case, metrics in cases.items():
+                line = ', '.join(f'{key}={value}'
+                                 for key, value in metrics.items())
+                self.stdout.write(f'  {case}: {line}')
+        if options['save']:
+            save_baseline(results, options['save'])
+            self.stdout.write(self.style.SUCCESS(
+                f'Результаты сохранены в {options["save"]}'))
+        if baseline is not None:
+            self.report(compare(results, baseline),
+                        options['max_regression'])
+
+    def report(self, changes, max_regression):
+        regressions = []
+        self.stdout.write(self.style.MIGRATE_HEADING('Сравнение'))
+        for name, cases in changes.items():
+            for case, metrics in cases.items():
+                self.stdout.write(f'  {name}.{case}: ' + ', '.join(
+                    f'{metric} {old} -> {new} ({change:+}%)'
+                    if change is not None else f'{metric} {old} -> {new}'
+                    for metric, (old, new, change) in metrics.items()))
+                old_ms, new_ms, ms_change = metrics.get(
+                    'ms', (None, None, None))
+                old_queries, new_queries, _ = metrics.get(
+                    'queries', (0, 0, None))
+                if max_regression is not None and (
+                        (ms_change or 0) > max_regression
+                        or new_queries > old_queries):
+                    regressions.append(f'{name}.{case}')
+        if regressions:
+            raise CommandError('Регрессия: ' + ', '.join(regressions))
@@ -0,0 +1,107 @@
+import os
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.images import VARIANTS_DIR, variant_names
+from recipes.models import MediaFile, Recipe
+
+IMAGES_DIR = 'recipes/images'
+
+
+class Command(BaseCommand):
+    """
+    Удаление изображений рецептов, на которые не осталось ссылок,
+    вместе с их уменьшенными копиями. Файлы моложе --min-age минут
+    не трогаются: они могут принадлежать незавершенной загрузке.
+    """
+    help = 'Удаление неиспользуемых изображений рецептов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60,
+                            help='Минимальный возраст файла в минутах.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только вывести, что будет удалено.')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.deleted = self.freed = 0
+        self.seen = set()
+        before = timezone.now() - timedelta(minutes=options['min_age'])
+        storage = Recipe._meta.get_field('image').storage
+        used = set(Recipe.objects.values_list('image', flat=True))
+
+        orphans = MediaFile.objects.orphans(before).exclude(name__in=used)
+        for name in orphans.values_list('name', flat=True):
+            self.delete_orphan(storage, name, before)
+
+        # файлы без записи MediaFile: загрузки до подсчета ссылок
+        # и сохраненные без рецепта
+        known = used | set(MediaFile.objects.values_list('name', flat=True))
+        for filename in self.list_files(storage, IMAGES_DIR):
+            name = f'{IMAGES_DIR}/{filename}'
+            if (name not in known
+                    and storage.get_modified_time(name) < before):
+                self.delete(storage, name)
+
+        stems = {os.path.splitext(os.path.basename(name))[0]
+                 for name in known}
+        for stem in self.list_dirs(default_storage, VARIANTS_DIR):
+            if stem not in stems:
+                for filename in self.list_files(
+                        default_storage, f'{VARIANTS_DIR}/{stem}'):
+                    self.delete_file(default_storage,
+                                     f'{VARIANTS_DIR}/{stem}/{filename}')
+
+        action = 'Будет удалено' if self.dry_run else 'Удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} файлов: {self.deleted}, '
+            f'{self.freed / 1024 / 1024:.1f} МБ'))
+
+    @staticmethod
+    def list_dirs(storage, path):
+        return storage.listdir(path)[0] if storage.exists(path) else []
+
+    @staticmethod
+    def list_files(storage, path):
+        return storage.listdir(path)[1] if storage.exists(path) else []
+
+    def delete_orphan(self, storage, name, before):
+        """
+        Повторная проверка под блокировкой строки MediaFile: за время
+        обхода на файл могла появиться ссылка, а повторная загрузка
+        того же файла обновляет время его изменения.
+        """
+        if self.dry_run:
+            self.delete(storage, name)
+            return
+        with transaction.atomic():
+            media_file = MediaFile.objects.select_for_update().orphans(
+                before).filter(name=name).first()
+            if media_file is None or (
+                    storage.exists(name)
+                    and storage.get_modified_time(name) >= before):
+                return
+            self.delete(storage, name)
+            media_file.delete()
+
+    def delete(self, storage, name):
+        """Изображение и его уменьшенные копии."""
+        self.delete_file(storage, name)
+        for formats in variant_names(name).values():
+            for variant in formats.values():
+                self.delete_file(default_storage, variant)
+
+    def delete_file(self, storage, name):
+        if name in self.seen or not storage.exists(name):
+            return
+        self.seen.add(name)
+        self.deleted += 1
+        self.freed += storage.size(name)
+        if self.dry_run:
+            self.stdout.write(name)
+        else:
+            storage.delete(name)
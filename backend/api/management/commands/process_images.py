@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from api.images import process_recipe
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    """
+    Обработка изображений рецептов, оставшихся в очереди
+    после перезапуска. С флагом --all копии создаются заново для всех.
+    """
+    help = 'Создание уменьшенных копий изображений рецептов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Обработать все рецепты.')
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.all()
+        if not options['all']:
+            recipes = recipes.filter(image_status=Recipe.IMAGE_PENDING)
+        recipe_ids = list(recipes.values_list('id', flat=True))
+        for recipe_id in recipe_ids:
+            process_recipe(recipe_id, force=options['all'])
+        failed = Recipe.objects.filter(
+            id__in=recipe_ids, image_status=Recipe.IMAGE_FAILED).count()
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано изображений: {len(recipe_ids)}, ошибок: {failed}'))
@@ -0,0 +1,159 @@
+"""
+Замеры обработки запросов: число и время SQL-запросов,
+время сериализации и общее время. Результат отдается в заголовке
+Server-Timing и пишется в лог api.metrics строкой JSON.
+Повторяющиеся запросы (признак N+1) определяются по тексту SQL
+без параметров. Включается настройкой REQUEST_METRICS.
+"""
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+current_metrics = ContextVar('request_metrics', default=None)
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def normalize_sql(sql):
+    """Шаблон запроса: списки IN и литералы заменены на ?."""
+    return LITERALS.sub('?', IN_LIST.sub('IN (?)', sql))
+
+
+class RequestMetrics:
+    """Счетчики одного запроса; обертка для connection.execute_wrapper."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializing = False
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements[sql] += 1
+
+    def duplicates(self, threshold):
+        """{шаблон SQL: количество} для повторившихся threshold раз."""
+        patterns = Counter()
+        # нормализуются только различные тексты запросов
+        for sql, count in self.statements.items():
+            patterns[normalize_sql(sql)] += count
+        return {sql: count for sql, count in patterns.most_common()
+                if count >= threshold}
+
+
+def track_queries():
+    """
+    Учет запросов SQL текущего потока в замерах запроса, если они идут.
+    Нужен для представлений, выполняемых в другом потоке
+    со своим соединением с базой данных.
+    """
+    metrics = current_metrics.get()
+    if metrics is None:
+        return nullcontext()
+    return connection.execute_wrapper(metrics)
+
+
+class TimedSerializerMixin:
+    """
+    Учет времени сериализации в замерах запроса.
+    Вложенные сериализаторы отдельно не замеряются.
+    """
+
+    def to_representation(self, instance):
+        metrics = current_metrics.get()
+        if metrics is None or metrics.serializing:
+            return super().to_representation(instance)
+        metrics.serializing = True
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializing = False
+            metrics.serializer_time += time.perf_counter() - start
+
+
+class RequestMetricsMiddleware:
+    """
+    Замеры каждого запроса. Без REQUEST_METRICS=True
+    Django не включает middleware в цепочку обработки.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        total = time.perf_counter() - start
+        response['Server-Timing'] = ', '.join((
+            f'db;dur={metrics.db_time * 1000:.1f};'
+            f'desc="{metrics.queries} queries"',
+            f'serializer;dur={metrics.serializer_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ))
+        if response.streaming:
+            response.streaming_content = self.measure_stream(
+                request, response, response.streaming_content, metrics,
+                start)
+        else:
+            self.log(request, response, metrics, total)
+        return response
+
+    def measure_stream(self, request, response, content, metrics, start):
+        """
+        Части потокового ответа (список покупок) читаются после выхода
+        из middleware, когда заголовок Server-Timing уже отправлен: он
+        учитывает только представление. Запросы SQL при чтении частей
+        учитываются здесь, строка лога с итогами пишется после передачи
+        последней части или обрыва соединения.
+        """
+        try:
+            with connection.execute_wrapper(metrics):
+                yield from content
+        finally:
+            self.log(request, response, metrics,
+                     time.perf_counter() - start)
+
+    @staticmethod
+    def log(request, response, metrics, total):
+        duplicates = metrics.duplicates(settings.REQUEST_METRICS_DUPLICATES)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': metrics.queries,
+            'db_ms': round(metrics.db_time * 1000, 1),
+            'serializer_ms': round(metrics.serializer_time * 1000, 1),
+            'total_ms': round(total * 1000, 1),
+        }
+        if duplicates:
+            record['duplicates'] = [{'sql': sql, 'count': count}
+                                    for sql, count in duplicates.items()]
+        logger.log(logging.WARNING if duplicates else logging.INFO,
+                   json.dumps(record, ensure_ascii=False))
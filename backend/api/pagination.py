@@ -1,5 +1,172 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинация по ключу (keyset) без OFFSET.
+    Страница выбирается условием по полям сортировки от позиции
+    в курсоре, поэтому глубокие страницы стоят столько же, сколько первая.
+    Общее количество записей считается только по запросу ?count=true.
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Неверный курсор.'
+    # типы значений позиции после json.loads: дата хранится строкой
+    position_types = (str, int, float)
+
+    def __init__(self, ordering, page_size):
+        self.ordering = ordering
+        self.page_size = page_size
+
+    @staticmethod
+    def get_key(instance, field):
+        return getattr(instance, field.lstrip('-'))
+
+    def encode_cursor(self, instance, reverse):
+        position = [self.get_key(instance, field) for field in self.ordering]
+        # str() сохраняет микросекунды даты, в отличие от DjangoJSONEncoder
+        raw = json.dumps([position, reverse], default=str)
+        cursor = urlsafe_b64encode(raw.encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   cursor)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            position, reverse = json.loads(urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not (self.is_valid_position(position)
+                and isinstance(reverse, bool)):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def is_valid_position(self, position):
+        """Позиция - список скалярных значений по числу полей сортировки."""
+        return (isinstance(position, list)
+                and len(position) == len(self.ordering)
+                and all(isinstance(value, self.position_types)
+                        and not isinstance(value, bool)
+                        for value in position))
+
+    def get_ordering(self, reverse):
+        if not reverse:
+            return self.ordering
+        return [field[1:] if field.startswith('-') else f'-{field}'
+                for field in self.ordering]
+
+    @staticmethod
+    def position_filter(ordering, position):
+        """
+        Условие "строго после позиции" для составного ключа:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        position, reverse = self.decode_cursor(request)
+        ordering = self.get_ordering(reverse)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            # значение позиции, не подходящее к типу поля, дает ошибку
+            # уже при построении условия, а не при выполнении запроса
+            try:
+                queryset = queryset.filter(
+                    self.position_filter(ordering, position))
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        self.results = results
+        return results
+
+    def get_next_link(self):
+        if not self.has_next or not self.results:
+            return None
+        return self.encode_cursor(self.results[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.results:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.results[0], True)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict()
+        if self.count is not None:
+            response['count'] = self.count
+        response['next'] = self.get_next_link()
+        response['previous'] = self.get_previous_link()
+        response['results'] = data
+        return Response(response)
 
 
 class CustomPageNumberPagination(PageNumberPagination):
+    """
+    Постраничная пагинация с параметром limit.
+    Для представлений с атрибутом keyset_ordering при наличии
+    параметра cursor включается пагинация по ключу.
+    """
     page_size_query_param = 'limit'
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = getattr(view, 'keyset_ordering', None)
+        self.keyset = None
+        if (ordering
+                and self.keyset_class.cursor_query_param
+                in request.query_params):
+            self.keyset = self.keyset_class(ordering,
+                                            self.get_page_size(request))
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class KeysetOnlyPagination(CustomPageNumberPagination):
+    """
+    Пагинация только по ключу: первая страница запрашивается без cursor.
+    Поля сортировки берутся из keyset_ordering представления.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.keyset_class(view.keyset_ordering,
+                                        self.get_page_size(request))
+        return self.keyset.paginate_queryset(queryset, request, view)
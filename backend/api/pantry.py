@@ -0,0 +1,239 @@
+"""
+Подбор рецептов по продуктам пользователя.
+Состав каждого рецепта хранится в памяти процесса битовым множеством:
+ингредиенту соответствует бит по его месту в таблице Ingredient.
+Число недостающих ингредиентов - popcount(рецепт & ~продукты)
+сразу для всех рецептов на массивах NumPy.
+"""
+import copy
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+
+from recipes.models import AmountIngredient, Ingredient, Recipe, Tag
+
+WORD_BITS = 64
+BLOCK_ROWS = 4096
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(words):
+    """Число единичных бит в каждом элементе массива uint64."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    words = words - ((words >> np.uint64(1)) & M1)
+    words = (words & M2) + ((words >> np.uint64(2)) & M2)
+    words = (words + (words >> np.uint64(4))) & M4
+    return (words * H01) >> np.uint64(56)
+
+
+def pairs_array(pairs):
+    return np.fromiter(chain.from_iterable(pairs.iterator()),
+                       dtype=np.int64).reshape(-1, 2)
+
+
+class BitMapping:
+    """Номера бит для id из таблицы (по возрастанию id)."""
+
+    def __init__(self, ids):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.words = max(1, -(-len(self.ids) // WORD_BITS))
+        self.all_bits = (1 << len(self.ids)) - 1
+
+    def positions(self, ids):
+        """Номера бит id, -1 для id, которых не было при построении."""
+        if not isinstance(ids, np.ndarray):
+            ids = list(ids)
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1)
+        bits = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return np.where(self.ids[bits] == ids, bits, -1)
+
+    def knows(self, ids):
+        return bool((self.positions(ids) >= 0).all())
+
+    def masks(self, rows, ids, count):
+        """Битовые множества строк по парам (строка, id)."""
+        masks = np.zeros((count, self.words), dtype=np.uint64)
+        bits = self.positions(ids)
+        known = bits >= 0
+        rows, bits = rows[known], bits[known]
+        np.bitwise_or.at(masks, (rows, bits // WORD_BITS), np.left_shift(
+            np.uint64(1), (bits % WORD_BITS).astype(np.uint64)))
+        return masks
+
+    def mask(self, ids):
+        """Битовое множество id как массив слов."""
+        ids = list(ids)
+        return self.masks(np.zeros(len(ids), dtype=np.int64), ids, 1)[0]
+
+    def to_int(self, ids):
+        """Битовое множество как целое число для измененных рецептов."""
+        return sum(1 << int(bit) for bit in self.positions(ids) if bit >= 0)
+
+
+class PantrySnapshot:
+    """
+    Битовые множества ингредиентов и тегов рецептов.
+    Измененные после построения рецепты хранятся в delta
+    ({recipe_id: (ингредиенты, теги)} целыми числами),
+    их строки в массивах выключены.
+    """
+
+    def __init__(self):
+        self.ingredients = BitMapping(Ingredient.objects.values_list(
+            'id', flat=True).order_by('id'))
+        self.tags = BitMapping(Tag.objects.values_list(
+            'id', flat=True).order_by('id'))
+        amounts = pairs_array(AmountIngredient.objects.values_list(
+            'recipe_id', 'ingredient_id').order_by())
+        recipe_tags = pairs_array(Recipe.tags.through.objects.values_list(
+            'recipe_id', 'tag_id').order_by())
+        self.recipe_ids = np.unique(amounts[:, 0])
+        count = len(self.recipe_ids)
+        self.masks = self.ingredients.masks(
+            np.searchsorted(self.recipe_ids, amounts[:, 0]),
+            amounts[:, 1], count)
+        # теги рецептов без ингредиентов не нужны
+        recipe_tags = recipe_tags[np.isin(recipe_tags[:, 0],
+                                          self.recipe_ids)]
+        self.tag_masks = self.tags.masks(
+            np.searchsorted(self.recipe_ids, recipe_tags[:, 0]),
+            recipe_tags[:, 1], count)
+        self.alive = np.ones(count, dtype=bool)
+        self.delta = {}
+
+    def changed(self, rows):
+        """
+        Копия снимка с новым составом и тегами рецептов
+        rows: {recipe_id: (ingredient_ids, tag_ids)}.
+        None, если встретились ингредиенты или теги новее снимка.
+        """
+        snapshot = copy.copy(self)
+        snapshot.alive = self.alive.copy()
+        snapshot.delta = dict(self.delta)
+        for recipe_id, (ingredient_ids, tag_ids) in rows.items():
+            if not (self.ingredients.knows(ingredient_ids)
+                    and self.tags.knows(tag_ids)):
+                return None
+            position = np.searchsorted(self.recipe_ids, recipe_id)
+            if (position < len(self.recipe_ids)
+                    and self.recipe_ids[position] == recipe_id):
+                snapshot.alive[position] = False
+            snapshot.delta.pop(recipe_id, None)
+            if ingredient_ids:
+                snapshot.delta[recipe_id] = (
+                    self.ingredients.to_int(ingredient_ids),
+                    self.tags.to_int(tag_ids))
+        return snapshot
+
+    def matching(self, ingredient_ids, max_missing=0, tag_ids=None):
+        """
+        Пары (id рецепта, число недостающих ингредиентов) для рецептов,
+        которым не хватает не больше max_missing ингредиентов из
+        ingredient_ids. С tag_ids - только рецепты хотя бы с одним тегом.
+        Сначала рецепты с меньшим числом недостающих, затем новые.
+        """
+        lacking = ~self.ingredients.mask(ingredient_ids)
+        rows = self.alive
+        if tag_ids:
+            rows = rows & (self.tag_masks & self.tags.mask(tag_ids)).any(
+                axis=1)
+        rows = np.flatnonzero(rows)
+        missing = np.empty(len(rows), dtype=np.int64)
+        # блоками, чтобы промежуточные массивы помещались в кэш процессора
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            missing[start:start + BLOCK_ROWS] = popcount(
+                self.masks[block] & lacking).sum(axis=1)
+        found = missing <= max_missing
+        result = list(zip(self.recipe_ids[rows[found]].tolist(),
+                          missing[found].tolist()))
+        lacking_int = (self.ingredients.all_bits
+                       & ~self.ingredients.to_int(ingredient_ids))
+        tags_int = self.tags.to_int(tag_ids or ())
+        for recipe_id, (mask, tags) in self.delta.items():
+            count = bin(mask & lacking_int).count('1')
+            if count <= max_missing and (not tag_ids or tags & tags_int):
+                result.append((recipe_id, count))
+        result.sort(key=lambda item: (item[1], -item[0]))
+        return result
+
+
+class PantryIndex:
+    """
+    Индекс рецептов по составу в памяти процесса.
+    Строится при первом обращении; рецепты, измененные в этом процессе,
+    перечитываются перед следующим поиском, после PANTRY_DELTA_LIMIT
+    изменений индекс строится заново.
+    Изменения из других процессов подхватываются по истечении ttl.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._built_at = None
+        self._generation = 0
+        self._built_generation = None
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def mark_changed(self, recipe_id):
+        self._changed.add(recipe_id)
+
+    def is_fresh(self):
+        if self._built_generation != self._generation:
+            return False
+        ttl = settings.PANTRY_INDEX_TTL
+        return not ttl or time.monotonic() - self._built_at < ttl
+
+    def build(self):
+        generation = self._generation
+        self._changed.clear()
+        self._snapshot = PantrySnapshot()
+        self._built_at = time.monotonic()
+        self._built_generation = generation
+
+    def apply_changes(self):
+        changed = set(self._changed)
+        self._changed -= changed
+        rows = {recipe_id: (set(), set()) for recipe_id in changed}
+        for recipe_id, ingredient_id in AmountIngredient.objects.filter(
+                recipe_id__in=changed).values_list(
+                    'recipe_id', 'ingredient_id'):
+            rows[recipe_id][0].add(ingredient_id)
+        for recipe_id, tag_id in Recipe.tags.through.objects.filter(
+                recipe_id__in=changed).values_list('recipe_id', 'tag_id'):
+            rows[recipe_id][1].add(tag_id)
+        snapshot = self._snapshot.changed(rows)
+        if (snapshot is None
+                or len(snapshot.delta) > settings.PANTRY_DELTA_LIMIT):
+            self.build()
+        else:
+            self._snapshot = snapshot
+
+    def get_snapshot(self):
+        if self.is_fresh() and not self._changed:
+            return self._snapshot
+        with self._lock:
+            if not self.is_fresh():
+                self.build()
+            elif self._changed:
+                self.apply_changes()
+            return self._snapshot
+
+    def matching(self, ingredient_ids, max_missing=0, tag_ids=None):
+        return self.get_snapshot().matching(ingredient_ids, max_missing,
+                                            tag_ids)
+
+
+pantry_index = PantryIndex()
@@ -0,0 +1,187 @@
+"""
+Разбор JSON с изображением без загрузки всей строки base64 в память.
+"""
+import base64
+import binascii
+import json
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+WHITESPACE = b' \t\r\n'
+# экранирование внутри строки base64: \/ - это /, переводы строк пропускаются
+ESCAPES = {ord('/'): b'/', ord('n'): b'', ord('r'): b''}
+
+
+class Base64FileWriter:
+    """
+    Декодирование base64 по частям во временный файл.
+    Файл хранится в памяти, пока не превысит IMAGE_UPLOAD_MEMORY_LIMIT.
+    Заголовок data:...;base64, отбрасывается.
+    """
+    max_header = 256
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=settings.IMAGE_UPLOAD_MEMORY_LIMIT)
+        self.size = 0
+        self.pending = b''
+        self.header = True
+
+    def write(self, data):
+        data = self.pending + data.translate(None, WHITESPACE)
+        if self.header:
+            if data.startswith(b'data:'[:len(data)]) and b',' not in data:
+                if len(data) > self.max_header:
+                    raise ParseError('Некорректная строка base64.')
+                self.pending = data
+                return
+            self.header = False
+            if data.startswith(b'data:'):
+                data = data[data.index(b',') + 1:]
+        end = len(data) // 4 * 4
+        self.pending = data[end:]
+        self.decode(data[:end])
+
+    def decode(self, data):
+        try:
+            decoded = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            raise ParseError('Некорректная строка base64.')
+        self.size += len(decoded)
+        if self.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+            raise ParseError('Слишком большое изображение.')
+        self.file.write(decoded)
+
+    def close(self, name):
+        if self.header and self.pending:
+            raise ParseError('Некорректная строка base64.')
+        self.decode(self.pending)
+        self.file.seek(0)
+        return UploadedFile(self.file, name=name, size=self.size)
+
+
+class StreamingJSONParser(JSONParser):
+    """
+    JSON-парсер, который читает тело запроса частями.
+    Строка base64 из поля file_field верхнего уровня декодируется
+    во временный файл, остальной документ (не больше
+    DATA_UPLOAD_MAX_MEMORY_SIZE) разбирается обычным json.
+    В данных вместо строки оказывается загруженный файл.
+    """
+    file_field = b'image'
+    chunk_size = 64 * 1024
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        self.rest = bytearray()
+        self.depth = 0
+        self.in_string = self.escape = self.key_string = False
+        self.key = None
+        self.expect_value = False
+        self.writer = None
+        self.file = None
+        while True:
+            chunk = stream.read(self.chunk_size) if stream else b''
+            if not chunk:
+                break
+            self.feed(chunk)
+            limit = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+            if limit is not None and len(self.rest) > limit:
+                raise ParseError('Слишком большой запрос.')
+        if self.writer is not None:
+            raise ParseError('JSON parse error - незакрытая строка.')
+        try:
+            data = json.loads(self.rest.decode(encoding))
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+        if self.file is not None:
+            data[self.file_field.decode()] = self.file
+        return data
+
+    def feed(self, chunk):
+        position = 0
+        while position < len(chunk):
+            if self.writer is not None:
+                position = self.feed_file(chunk, position)
+            elif self.in_string and not self.escape:
+                # строка копируется целиком до кавычки или обратной косой черты
+                end = self.string_end(chunk, position)
+                self.rest.extend(chunk[position:end])
+                if end < len(chunk):
+                    self.feed_byte(chunk[end])
+                position = end + 1
+            else:
+                self.feed_byte(chunk[position])
+                position += 1
+
+    @staticmethod
+    def string_end(chunk, position):
+        ends = [index for index in (chunk.find(b'"', position),
+                                    chunk.find(b'\\', position))
+                if index != -1]
+        return min(ends) if ends else len(chunk)
+
+    def feed_file(self, chunk, position):
+        """Часть строки base64 до кавычки или обратной косой черты."""
+        if self.escape:
+            self.escape = False
+            if chunk[position] not in ESCAPES:
+                raise ParseError('Некорректная строка base64.')
+            self.writer.write(ESCAPES[chunk[position]])
+            return position + 1
+        end = self.string_end(chunk, position)
+        self.writer.write(chunk[position:end])
+        if end == len(chunk):
+            return end
+        if chunk[end] == ord('\\'):
+            self.escape = True
+        else:
+            self.file = self.writer.close(self.file_field.decode())
+            self.writer = None
+        return end + 1
+
+    def feed_byte(self, byte):
+        if self.in_string:
+            self.feed_string_byte(byte)
+        else:
+            self.feed_structure_byte(byte)
+
+    def feed_string_byte(self, byte):
+        self.rest.append(byte)
+        if self.escape:
+            self.escape = False
+        elif byte == ord('\\'):
+            self.escape = True
+        elif byte == ord('"'):
+            self.in_string = False
+            if self.key_string:
+                self.key = bytes(self.rest[self.key_start:-1])
+
+    def feed_structure_byte(self, byte):
+        """Байт вне строк: отслеживание ключей верхнего уровня."""
+        if byte == ord('"') and self.expect_value:
+            # значение поля с файлом: в документе остается null
+            self.expect_value = False
+            self.rest.extend(b'null')
+            self.writer = Base64FileWriter()
+            return
+        self.rest.append(byte)
+        if byte == ord('"'):
+            self.in_string = True
+            self.key_string = self.depth == 1 and self.key is None
+            self.key_start = len(self.rest)
+        elif byte in b'{[':
+            self.depth += 1
+        elif byte in b']}':
+            self.depth -= 1
+        elif byte == ord(',') and self.depth == 1:
+            self.key = None
+        elif byte == ord(':') and self.depth == 1:
+            self.expect_value = self.key == self.file_field
+        elif byte not in WHITESPACE:
+            self.expect_value = False
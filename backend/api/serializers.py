@@ -1,11 +1,16 @@
+from django.conf import settings
+from django.db import transaction
 from djoser.serializers import UserCreateSerializer, UserSerializer
-from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
-from recipes.models import (AmountIngredient, Favorite, Ingredient,
-                            Recipe, ShoppingCart, Subscribe, Tag)
+from recipes.models import (AmountIngredient, Favorite, FeedEntry,
+                            Ingredient, Recipe, ShoppingCart,
+                            ShoppingCartIngredient, Subscribe, Tag)
 from users.models import User
+from .fields import Base64ImageUploadField, ImageVariantsField
 from .filters import recipes_limit
+from .images import image_pipeline
+from .metrics import TimedSerializerMixin
 
 
 class CustomUserCreateSerializer(UserCreateSerializer):
@@ -19,7 +24,7 @@ class CustomUserCreateSerializer(UserCreateSerializer):
                   'first_name', 'last_name', 'password')
 
 
-class CustomUserSerializer(UserSerializer):
+class CustomUserSerializer(TimedSerializerMixin, UserSerializer):
     """
     Сериализатор для модели User.
     Используется при выводе информации о пользователе.
@@ -32,19 +37,24 @@ class CustomUserSerializer(UserSerializer):
                   'first_name', 'last_name', 'is_subscribed')
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context.get('request').user
-        return (user.is_authenticated
+        # на себя подписаться нельзя: /api/users/me/ обходится без запроса
+        return (user.is_authenticated and user.pk != obj.pk
                 and Subscribe.objects.filter(user=user, author=obj).exists())
 
 
-class ShortRecipeSerializer(serializers.ModelSerializer):
+class ShortRecipeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели Recipe.
     Используется при выводе краткой информации о рецепте.
     """
+    images = ImageVariantsField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'images', 'cooking_time')
 
 
 class SubscribeSerializer(CustomUserSerializer):
@@ -62,15 +72,18 @@ class SubscribeSerializer(CustomUserSerializer):
                   'last_name', 'is_subscribed', 'recipes', 'recipes_count')
 
     def get_recipes(self, obj):
-        request = self.context.get('request')
-        recipes = recipes_limit(request, obj)
+        # SubscriptionsView загружает рецепты всех авторов страницы заранее
+        recipes = getattr(obj, 'latest_recipes', None)
+        if recipes is None:
+            request = self.context.get('request')
+            recipes = recipes_limit(request, obj)
         return ShortRecipeSerializer(recipes, many=True).data
 
     def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        return obj.recipes_count
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели Tag.
     Используется при выводе информации о "тэге".
@@ -80,7 +93,7 @@ class TagSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'color', 'slug')
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели Ingredient.
     Используется при выводе информации об ингредиенте.
@@ -105,7 +118,7 @@ class AmountIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели Recipe.
     Используется при выводе информации о рецепте.
@@ -116,20 +129,30 @@ class RecipeSerializer(serializers.ModelSerializer):
                                              many=True, source='amounts')
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    images = ImageVariantsField()
 
     class Meta:
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients',
                   'is_favorited', 'is_in_shopping_cart',
-                  'name', 'image', 'text', 'cooking_time')
+                  'name', 'image', 'images', 'text', 'cooking_time')
+
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed'):
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context.get('request').user
         return (user.is_authenticated
                 and Favorite.objects.filter(user=user,
                                             recipe=obj).exists())
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context.get('request').user
         return (user.is_authenticated
                 and ShoppingCart.objects.filter(user=user,
@@ -140,66 +163,127 @@ class AddIngredientSerializer(serializers.ModelSerializer):
     """
     Вложенный сериализатор по модели AmountIngredient.
     Связывает ингредиент (по id) и соответсвующее ему количество.
-    Используется через RecipeCreateUpdateSerializer.
+    Используется через RecipeCreateUpdateSerializer,
+    существование ингредиентов проверяется там одним запросом.
     """
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    id = serializers.IntegerField()
 
     class Meta:
         model = AmountIngredient
         fields = ('id', 'amount')
 
 
-class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
+class RecipeCreateUpdateSerializer(TimedSerializerMixin,
+                                   serializers.ModelSerializer):
     """
     Сериализатор для модели Recipe.
     Используется при вводе и редактировании информации о рецепте.
     """
     ingredients = AddIngredientSerializer(many=True)
-    image = Base64ImageField()
+    image = Base64ImageUploadField()
 
     class Meta:
         model = Recipe
         fields = ('ingredients', 'tags', 'image',
                   'name', 'text', 'cooking_time')
 
-    def validate(self, data):
-        ingredients = data.get('ingredients')
-        ingredients_unique = []
-        for ingredient in ingredients:
-            id = ingredient.get('id')
-            if id in ingredients_unique:
-                raise serializers.ValidationError({
-                    'ingredients': 'Ингредиенты не должны повторяться!'})
-            ingredients_unique.append(id)
-        return data
+    def validate_ingredients(self, ingredients):
+        ids = {ingredient['id'] for ingredient in ingredients}
+        if len(ids) != len(ingredients):
+            raise serializers.ValidationError(
+                'Ингредиенты не должны повторяться!')
+        missing = ids - set(Ingredient.objects.filter(
+            id__in=ids).values_list('id', flat=True))
+        if missing:
+            raise serializers.ValidationError(
+                f'Ингредиенты не найдены: {sorted(missing)}')
+        return ingredients
 
     @staticmethod
     def create_ingredients(ingredients, recipe):
-        for ingredient in ingredients:
-            AmountIngredient.objects.create(
+        AmountIngredient.objects.bulk_create(
+            AmountIngredient(
                 recipe=recipe,
-                ingredient=ingredient.get('id'),
-                amount=ingredient.get('amount')
+                ingredient_id=ingredient['id'],
+                amount=ingredient['amount']
             )
+            for ingredient in ingredients
+        )
 
+    @staticmethod
+    def update_ingredients(ingredients, recipe):
+        """
+        Применение изменений состава рецепта: добавление,
+        изменение количества и удаление строк пакетными запросами.
+        Возвращает прежний и новый состав {ingredient_id: amount}
+        без удаленных строк: их вычитает из корзин сигнал post_delete.
+        """
+        current = {amount.ingredient_id: amount
+                   for amount in recipe.amounts.all()}
+        new_amounts = {ingredient['id']: ingredient['amount']
+                       for ingredient in ingredients}
+        old_amounts = {ingredient_id: amount.amount
+                       for ingredient_id, amount in current.items()}
+        to_update = []
+        for ingredient_id, amount in current.items():
+            if ingredient_id in new_amounts:
+                if amount.amount != new_amounts[ingredient_id]:
+                    amount.amount = new_amounts[ingredient_id]
+                    to_update.append(amount)
+        AmountIngredient.objects.bulk_create(
+            AmountIngredient(recipe=recipe, ingredient_id=ingredient_id,
+                             amount=amount)
+            for ingredient_id, amount in new_amounts.items()
+            if ingredient_id not in current
+        )
+        AmountIngredient.objects.bulk_update(to_update, ['amount'])
+        removed = current.keys() - new_amounts.keys()
+        if removed:
+            AmountIngredient.objects.filter(
+                recipe=recipe, ingredient_id__in=removed).delete()
+        for ingredient_id in removed:
+            del old_amounts[ingredient_id]
+        return old_amounts, new_amounts
+
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
         tags = validated_data.pop('tags')
         recipe = Recipe.objects.create(**validated_data)
         recipe.tags.set(tags)
         self.create_ingredients(ingredients, recipe)
+        FeedEntry.objects.add_recipe(recipe)
+        transaction.on_commit(lambda: image_pipeline.enqueue(recipe.id))
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         if 'ingredients' in validated_data:
             ingredients = validated_data.pop('ingredients')
-            instance.ingredients.clear()
-            self.create_ingredients(ingredients, instance)
+            old_amounts, new_amounts = self.update_ingredients(
+                ingredients, instance)
+            ShoppingCartIngredient.objects.update_recipe(
+                instance, old_amounts, new_amounts)
         if 'tags' in validated_data:
             tags = validated_data.pop('tags')
             instance.tags.set(tags)
+        if 'image' in validated_data:
+            instance.image_status = Recipe.IMAGE_PENDING
+            transaction.on_commit(
+                lambda: image_pipeline.enqueue(instance.id))
         return super().update(instance, validated_data)
 
     def to_representation(self, instance):
-        context = {'request': self.context.get('request')}
-        return RecipeSerializer(instance, context=context).data
+        request = self.context.get('request')
+        instance = Recipe.objects.with_related().with_user_flags(
+            request.user).get(pk=instance.pk)
+        return RecipeSerializer(instance, context={'request': request}).data
+
+
+class RelationIdsSerializer(serializers.Serializer):
+    """
+    Список id для массового добавления и удаления связей.
+    """
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False,
+        max_length=settings.BULK_RELATIONS_LIMIT)
@@ -0,0 +1,166 @@
+"""
+Формирование списка покупок.
+Строки берутся одним запросом к сводной корзине и отдаются потоком
+через StreamingHttpResponse в формате txt, csv или pdf.
+"""
+import csv
+from datetime import date
+from io import BytesIO
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+from recipes.models import ShoppingCartIngredient
+
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+except ImportError:
+    canvas = None
+
+TITLE = 'Foodgram\nСписок покупок:\n\n'
+EMPTY_CART = 'В корзине нет товаров!\n'
+CSV_HEADER = ('Ингредиент', 'Количество', 'Единицы измерения')
+PDF_FONT = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+PDF_CHUNK_SIZE = 64 * 1024
+
+
+class ShoppingListRenderer(BaseRenderer):
+    """
+    Базовый рендерер списка покупок.
+    Сам список отдается потоком в обход рендерера,
+    через рендерер выводятся только текстовые сообщения.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            data = '\n'.join(str(value) for value in data.values())
+        return str(data).encode('utf-8')
+
+
+class PlainTextRenderer(ShoppingListRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(ShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(ShoppingListRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+
+
+def get_renderers():
+    """Доступные форматы. PDF доступен при установленном reportlab."""
+    renderers = [PlainTextRenderer, CSVRenderer]
+    if canvas is not None:
+        renderers.append(PDFRenderer)
+    return renderers
+
+
+def get_ingredients(user):
+    """
+    Итератор по сводному списку ингредиентов:
+    (название, единицы измерения, суммарное количество).
+    Данные читаются из заранее рассчитанной корзины пользователя.
+    """
+    return ShoppingCartIngredient.objects.filter(user=user).values_list(
+        'ingredient__name', 'ingredient__measurement_unit',
+        'amount').order_by('ingredient__name').iterator()
+
+
+def footer():
+    return f'\nДата формирования: {date.today()}'
+
+
+def text_rows(ingredients):
+    yield TITLE
+    empty = True
+    for name, measurement_unit, total in ingredients:
+        empty = False
+        yield f'{name} - {total} {measurement_unit}\n'
+    if empty:
+        yield EMPTY_CART
+    yield footer()
+
+
+class Echo:
+    """Псевдобуфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def csv_rows(ingredients):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for name, measurement_unit, total in ingredients:
+        yield writer.writerow((name, total, measurement_unit))
+
+
+def text_lines(ingredients):
+    """Построчное представление текстового списка покупок."""
+    for chunk in text_rows(ingredients):
+        if chunk.endswith('\n'):
+            chunk = chunk[:-1]
+        yield from chunk.split('\n')
+
+
+def pdf_chunks(ingredients):
+    """
+    Документ собирается постранично в буфер и отдается частями.
+    Размер буфера ограничен числом различных ингредиентов,
+    а не количеством рецептов в корзине.
+    """
+    pdfmetrics.registerFont(TTFont(PDF_FONT, settings.SHOPPING_LIST_PDF_FONT))
+    buffer = BytesIO()
+    document = canvas.Canvas(buffer, pagesize=A4)
+    height = A4[1]
+    line_height = PDF_FONT_SIZE * 1.5
+
+    def new_page():
+        document.setFont(PDF_FONT, PDF_FONT_SIZE)
+        return height - PDF_MARGIN
+
+    position = new_page()
+    for line in text_lines(ingredients):
+        if position < PDF_MARGIN:
+            document.showPage()
+            position = new_page()
+        document.drawString(PDF_MARGIN, position, line)
+        position -= line_height
+    document.save()
+    buffer.seek(0)
+    return iter(lambda: buffer.read(PDF_CHUNK_SIZE), b'')
+
+
+STREAMS = {
+    'txt': text_rows,
+    'csv': csv_rows,
+    'pdf': pdf_chunks,
+}
+
+
+def shopping_list_response(ingredients, renderer):
+    """
+    Потоковый ответ с файлом списка покупок в выбранном формате.
+    Для пустой корзины отдается документ того же формата без строк.
+    """
+    content_type = renderer.media_type
+    if renderer.charset:
+        content_type += f'; charset={renderer.charset}'
+    response = StreamingHttpResponse(STREAMS[renderer.format](ingredients),
+                                     content_type=content_type)
+    filename = f'shopping_cart.{renderer.format}'
+    response['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
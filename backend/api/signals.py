@@ -0,0 +1,161 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.models import (AmountIngredient, Favorite, Ingredient, Recipe,
+                            ShoppingCart, Subscribe, Tag)
+from recipes.signals import bulk_changed
+from users.models import User
+
+from .authentication import invalidate_tokens
+from .cache import bump_versions, relations_version_name
+from .filters import TAG_IDS_CACHE_KEY
+from .ingredient_index import ingredient_index
+from .pantry import pantry_index
+from .similarity import recipe_matrix
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Ingredient)
+def invalidate_ingredient_index(**kwargs):
+    """
+    Сброс индекса ингредиентов при их изменении.
+    Повторный сброс после фиксации транзакции не дает другим потокам
+    закрепить в индексе данные, прочитанные до нее.
+    """
+    ingredient_index.invalidate()
+    transaction.on_commit(ingredient_index.invalidate)
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Tag)
+def invalidate_tag_ids(**kwargs):
+    """Сброс кэша id тегов при их изменении."""
+    cache.delete(TAG_IDS_CACHE_KEY)
+    transaction.on_commit(lambda: cache.delete(TAG_IDS_CACHE_KEY))
+
+
+def bump_on_commit(*names):
+    """
+    Смена версий сразу и после фиксации транзакции:
+    запись, сохраненная в кэш до фиксации, не переживет ее.
+    """
+    bump_versions(*names)
+    transaction.on_commit(lambda: bump_versions(*names))
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Tag)
+def bump_tag_version(**kwargs):
+    bump_on_commit('tag')
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Ingredient)
+def bump_ingredient_version(**kwargs):
+    bump_on_commit('ingredient')
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Recipe)
+@receiver([post_save, post_delete], sender=AmountIngredient)
+def bump_recipe_version(**kwargs):
+    bump_on_commit('recipe')
+
+
+def mark_recipe_changed(recipe_id, indexes):
+    """
+    Рецепт перечитывается индексами при следующем поиске.
+    Ингредиенты и теги нового рецепта сохраняются после него,
+    поэтому рецепт отмечается еще раз после фиксации транзакции.
+    """
+    def mark():
+        for index in indexes:
+            index.mark_changed(recipe_id)
+    mark()
+    transaction.on_commit(mark)
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+@receiver([post_save, post_delete], sender=AmountIngredient)
+def update_recipe_indexes(instance, **kwargs):
+    recipe_id = instance.pk if isinstance(instance, Recipe) else (
+        instance.recipe_id)
+    mark_recipe_changed(recipe_id, (recipe_matrix, pantry_index))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def update_pantry_tags(instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        mark_recipe_changed(instance.pk, (pantry_index,))
+    elif pk_set:
+        for recipe_id in pk_set:
+            mark_recipe_changed(recipe_id, (pantry_index,))
+    else:
+        # очистка тега со стороны Tag без списка рецептов
+        pantry_index.invalidate()
+
+
+@receiver(bulk_changed, sender=Recipe)
+def invalidate_recipe_indexes(**kwargs):
+    for index in (recipe_matrix, pantry_index):
+        index.invalidate()
+        transaction.on_commit(index.invalidate)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def bump_recipe_tags_version(action, **kwargs):
+    if action.startswith('post_'):
+        bump_on_commit('recipe')
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=User)
+def bump_user_version(update_fields=None, **kwargs):
+    """Данные автора входят в рецепт; вход в систему их не меняет."""
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    bump_on_commit('user')
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+@receiver([post_save, post_delete], sender=ShoppingCart)
+@receiver([post_save, post_delete], sender=Subscribe)
+def bump_relations_version(instance, **kwargs):
+    """Флаги is_favorited и подобные входят в ETag пользователя."""
+    bump_on_commit(relations_version_name(instance.user_id))
+
+
+@receiver(bulk_changed, sender=Favorite)
+@receiver(bulk_changed, sender=ShoppingCart)
+@receiver(bulk_changed, sender=Subscribe)
+def bump_bulk_relations_version(user_ids=(), **kwargs):
+    """Массовые изменения связей передают id пользователей в user_ids."""
+    if user_ids:
+        bump_on_commit(*map(relations_version_name, user_ids))
+
+
+@receiver([post_save, post_delete, bulk_changed], sender=Favorite)
+def bump_popularity_version(**kwargs):
+    """Сортировка по популярности зависит от избранного всех пользователей."""
+    bump_on_commit('popularity')
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(instance, **kwargs):
+    """Выход из системы (auth/token/logout) удаляет токен."""
+    invalidate_tokens(instance.key)
+    transaction.on_commit(lambda: invalidate_tokens(instance.key))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(instance, update_fields=None, **kwargs):
+    """
+    Смена пароля, деактивация и другие изменения пользователя
+    сбрасывают его данные, сохраненные в кэше токенов.
+    """
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    keys = list(Token.objects.filter(user_id=instance.pk).values_list(
+        'key', flat=True))
+    if keys:
+        invalidate_tokens(*keys)
+        transaction.on_commit(lambda: invalidate_tokens(*keys))
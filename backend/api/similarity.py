@@ -0,0 +1,216 @@
+"""
+Похожие рецепты по общим ингредиентам.
+Связь рецепт-ингредиент хранится в памяти процесса разреженной
+матрицей CSR и ее транспонированной копией на массивах NumPy.
+Число общих ингредиентов со всеми рецептами считается одним bincount
+по спискам рецептов запрошенных ингредиентов, без самосоединений в SQL.
+"""
+import copy
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+
+from recipes.models import AmountIngredient
+
+METRICS = ('jaccard', 'cosine')
+
+
+class MatrixSnapshot:
+    """
+    Неизменяемый снимок матрицы.
+    Строки - рецепты по возрастанию id, столбцы - ингредиенты.
+    Измененные после построения рецепты хранятся в delta
+    ({recipe_id: frozenset(ingredient_id)}), их строки в CSR выключены.
+    """
+
+    def __init__(self, recipes, ingredients):
+        """recipes и ingredients - id рецепта и ингредиента каждой связи."""
+        order = np.lexsort((ingredients, recipes))
+        recipes, ingredients = recipes[order], ingredients[order]
+        self.recipe_ids, counts = np.unique(recipes, return_counts=True)
+        self.column_ids, self.indices = np.unique(ingredients,
+                                                  return_inverse=True)
+        self.indices = self.indices.astype(np.int32).ravel()
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+        self.sizes = counts
+        rows = np.repeat(np.arange(len(self.recipe_ids)), counts)
+        column_order = np.argsort(self.indices, kind='stable')
+        self.column_rows = rows[column_order]
+        self.column_indptr = np.concatenate(([0], np.cumsum(np.bincount(
+            self.indices, minlength=len(self.column_ids)))))
+        self.alive = np.ones(len(self.recipe_ids), dtype=bool)
+        self.delta = {}
+
+    @classmethod
+    def from_database(cls):
+        pairs = AmountIngredient.objects.values_list(
+            'recipe_id', 'ingredient_id').order_by()
+        data = np.fromiter(chain.from_iterable(pairs.iterator()),
+                           dtype=np.int64).reshape(-1, 2)
+        return cls(data[:, 0], data[:, 1])
+
+    def row(self, recipe_id):
+        position = np.searchsorted(self.recipe_ids, recipe_id)
+        if (position < len(self.recipe_ids)
+                and self.recipe_ids[position] == recipe_id):
+            return position
+        return None
+
+    def ingredients_of(self, recipe_id):
+        if recipe_id in self.delta:
+            return self.delta[recipe_id]
+        row = self.row(recipe_id)
+        if row is None or not self.alive[row]:
+            return frozenset()
+        return frozenset(self.column_ids[
+            self.indices[self.indptr[row]:self.indptr[row + 1]]].tolist())
+
+    def set_row(self, recipe_id, ingredient_ids):
+        """Новый состав рецепта; пустой - рецепт удален."""
+        row = self.row(recipe_id)
+        if row is not None:
+            self.alive[row] = False
+        self.delta.pop(recipe_id, None)
+        if ingredient_ids:
+            self.delta[recipe_id] = frozenset(ingredient_ids)
+
+    def changed(self, rows):
+        """Копия снимка с новым составом рецептов rows."""
+        snapshot = copy.copy(self)
+        snapshot.alive = self.alive.copy()
+        snapshot.delta = dict(self.delta)
+        for recipe_id, ingredient_ids in rows.items():
+            snapshot.set_row(recipe_id, ingredient_ids)
+        if len(snapshot.delta) > settings.SIMILARITY_DELTA_LIMIT:
+            return snapshot.compacted()
+        return snapshot
+
+    def compacted(self):
+        """Перестроение CSR с учетом delta без обращения к базе данных."""
+        entries = np.repeat(self.alive, self.sizes)
+        recipes = [np.repeat(self.recipe_ids, self.sizes)[entries]]
+        ingredients = [self.column_ids[self.indices][entries]]
+        for recipe_id, ingredient_ids in self.delta.items():
+            recipes.append(np.full(len(ingredient_ids), recipe_id))
+            ingredients.append(np.fromiter(ingredient_ids, dtype=np.int64))
+        return MatrixSnapshot(np.concatenate(recipes),
+                              np.concatenate(ingredients))
+
+    @staticmethod
+    def score(overlap, sizes, query_size, metric):
+        if metric == 'cosine':
+            return overlap / np.sqrt(sizes * query_size)
+        return overlap / (sizes + query_size - overlap)
+
+    def top(self, ingredient_ids, limit, metric, exclude=None):
+        """
+        До limit пар (id рецепта, сходство) с наибольшим сходством
+        с набором ингредиентов; при равенстве новые рецепты первыми.
+        """
+        query = frozenset(ingredient_ids)
+        if not query or limit <= 0:
+            return []
+        query_ids = np.fromiter(query, dtype=np.int64)
+        columns = np.searchsorted(self.column_ids, query_ids)
+        found = columns < len(self.column_ids)
+        columns, query_ids = columns[found], query_ids[found]
+        columns = columns[self.column_ids[columns] == query_ids]
+        postings = [self.column_rows[self.column_indptr[column]:
+                                     self.column_indptr[column + 1]]
+                    for column in columns]
+        overlap = np.bincount(
+            np.concatenate(postings) if postings else np.array([], int),
+            minlength=len(self.recipe_ids))
+        valid = (overlap > 0) & self.alive
+        row = self.row(exclude) if exclude is not None else None
+        if row is not None:
+            valid[row] = False
+        candidates = np.flatnonzero(valid)
+        scores = self.score(overlap[candidates], self.sizes[candidates],
+                            len(query), metric)
+        if len(candidates) > limit:
+            # все рецепты со сходством не ниже limit-го, с учетом равных
+            threshold = np.partition(scores, -limit)[-limit]
+            keep = scores >= threshold
+            candidates, scores = candidates[keep], scores[keep]
+        ranked = list(zip(self.recipe_ids[candidates].tolist(),
+                          scores.tolist()))
+        for recipe_id, row_ingredients in self.delta.items():
+            common = len(row_ingredients & query)
+            if common and recipe_id != exclude:
+                ranked.append((recipe_id, float(self.score(
+                    common, len(row_ingredients), len(query), metric))))
+        ranked.sort(key=lambda item: (-item[1], -item[0]))
+        return ranked[:limit]
+
+
+class RecipeMatrix:
+    """
+    Матрица рецептов в памяти процесса.
+    Строится при первом обращении; рецепты, измененные в этом процессе,
+    перечитываются одним запросом перед следующим поиском.
+    Изменения из других процессов подхватываются по истечении ttl.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._built_at = None
+        self._generation = 0
+        self._built_generation = None
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def mark_changed(self, recipe_id):
+        self._changed.add(recipe_id)
+
+    def is_fresh(self):
+        if self._built_generation != self._generation:
+            return False
+        ttl = settings.SIMILARITY_INDEX_TTL
+        return not ttl or time.monotonic() - self._built_at < ttl
+
+    def build(self):
+        generation = self._generation
+        self._changed.clear()
+        self._snapshot = MatrixSnapshot.from_database()
+        self._built_at = time.monotonic()
+        self._built_generation = generation
+
+    def apply_changes(self):
+        changed = set(self._changed)
+        self._changed -= changed
+        rows = {recipe_id: set() for recipe_id in changed}
+        for recipe_id, ingredient_id in AmountIngredient.objects.filter(
+                recipe_id__in=changed).values_list(
+                    'recipe_id', 'ingredient_id'):
+            rows[recipe_id].add(ingredient_id)
+        self._snapshot = self._snapshot.changed(rows)
+
+    def get_snapshot(self):
+        if self.is_fresh() and not self._changed:
+            return self._snapshot
+        with self._lock:
+            if not self.is_fresh():
+                self.build()
+            elif self._changed:
+                self.apply_changes()
+            return self._snapshot
+
+    def similar(self, recipe_id, limit, metric='jaccard'):
+        """Рецепты, похожие на recipe_id по составу."""
+        snapshot = self.get_snapshot()
+        return snapshot.top(snapshot.ingredients_of(recipe_id), limit,
+                            metric, exclude=recipe_id)
+
+    def by_ingredients(self, ingredient_ids, limit, metric='jaccard'):
+        """Рецепты, ближе всего подходящие к набору ингредиентов."""
+        return self.get_snapshot().top(ingredient_ids, limit, metric)
+
+
+recipe_matrix = RecipeMatrix()
@@ -1,8 +1,59 @@
-from django.test import TestCase, Client
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
 
-from recipes.models import Tag, Ingredient
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count, F
+from django.test import (Client, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
+from rest_framework.test import (APIClient, APIRequestFactory,
+                                 force_authenticate)
+
+from api.async_views import (StreamingASGIHandler, async_urlpatterns,
+                             async_view)
+from api.authentication import (CACHED_USER_FIELDS, REVOCATIONS_CACHE_KEY,
+                                local_token_cache, revocations,
+                                token_cache_key)
+from api.cache import VERSION_KEY, bump_versions
+from api.images import process_recipe, variant_names
+from api.ingredient_index import ingredient_index
+from api.metrics import RequestMetrics, normalize_sql
+from api.pantry import PantrySnapshot, pantry_index, popcount
+from api.parsers import StreamingJSONParser
+from api.similarity import MatrixSnapshot, recipe_matrix
+from api.urls import router
+from api.views import RecipeViewSet, TagViewSet
+from recipes.counters import mismatches
+from recipes.dataset import DatasetGenerator
+from recipes.importers import iter_json
+from recipes.models import (AmountIngredient, Favorite, FeedEntry, Ingredient,
+                            MediaFile, Recipe, ShoppingCart,
+                            ShoppingCartIngredient, Subscribe, Tag)
 from users.models import User
 
+SMALL_GIF = ('data:image/gif;base64,R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAA'
+             'AAABAAEAAAICRAEAOw==')
+
 
 class URLTests(TestCase):
     @classmethod
@@ -91,3 +142,2011 @@ class URLTests(TestCase):
         )
         # проверка генерации токена
         self.assertEqual(response.status_code, 200)
+
+
+class RecipeQueriesTests(TestCase):
+    """
+    Проверка фиксированного количества запросов
+    при выводе списка рецептов и отдельного рецепта.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@ya.ru')
+        cls.author = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.tags = [
+            Tag.objects.create(name=f'Тег {i}', color='#FF8000',
+                               slug=f'tag{i}')
+            for i in range(3)
+        ]
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {i}',
+                                      measurement_unit='г')
+            for i in range(5)
+        ]
+        Subscribe.objects.create(user=cls.user, author=cls.author)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(RecipeQueriesTests.user)
+
+    def create_recipes(self, count):
+        for i in range(count):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {i}', text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg',
+                author=RecipeQueriesTests.author
+            )
+            recipe.tags.set(RecipeQueriesTests.tags)
+            for ingredient in RecipeQueriesTests.ingredients:
+                AmountIngredient.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=i + 1)
+            Favorite.objects.create(user=RecipeQueriesTests.user,
+                                    recipe=recipe)
+        return recipe
+
+    def test_list_queries_do_not_depend_on_page_size(self):
+        """Количество запросов не зависит от размера страницы."""
+        self.create_recipes(50)
+        # COUNT, рецепты с автором и флагами, теги, ингредиенты
+        for limit in (6, 50):
+            with self.subTest(limit=limit):
+                with self.assertNumQueries(4):
+                    response = self.client.get(
+                        f'/api/recipes/?limit={limit}')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), limit)
+        recipe = response.data['results'][0]
+        self.assertTrue(recipe['is_favorited'])
+        self.assertFalse(recipe['is_in_shopping_cart'])
+        self.assertTrue(recipe['author']['is_subscribed'])
+        self.assertEqual(len(recipe['ingredients']), 5)
+        self.assertEqual(len(recipe['tags']), 3)
+
+    def test_list_queries_guest(self):
+        """Для анонимного пользователя флаги не запрашиваются."""
+        self.create_recipes(10)
+        with self.assertNumQueries(4):
+            response = APIClient().get('/api/recipes/?limit=10')
+        recipe = response.data['results'][0]
+        self.assertFalse(recipe['is_favorited'])
+        self.assertFalse(recipe['author']['is_subscribed'])
+
+    def test_retrieve_queries(self):
+        """Вывод отдельного рецепта фиксированным числом запросов."""
+        recipe = self.create_recipes(1)
+        # updated_at для ETag, рецепт с автором и флагами, теги, ингредиенты
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorited'])
+
+    def test_tags_filter(self):
+        """
+        Фильтр по тегам проверяет слаги по кэшу
+        и не добавляет запросов после его заполнения.
+        """
+        self.create_recipes(3)
+        other = Tag.objects.create(name='Другой', color='#000000',
+                                   slug='other')
+        url = '/api/recipes/?tags=tag0&tags=other'
+        self.client.get(url)
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(response.data['count'], 3)
+        response = self.client.get(f'/api/recipes/?tags={other.slug}')
+        self.assertEqual(response.data['count'], 0)
+        response = self.client.get('/api/recipes/?tags=unknown')
+        self.assertEqual(response.status_code, 400)
+
+    def test_tag_added_by_other_process(self):
+        """Тег, добавленный без сигналов, находится по слагу из базы."""
+        self.create_recipes(1)
+        self.client.get('/api/recipes/?tags=tag0')
+        Tag.objects.bulk_create([
+            Tag(name='Новый', color='#00FF00', slug='new')])
+        Recipe.objects.first().tags.add(Tag.objects.get(slug='new'))
+        response = self.client.get('/api/recipes/?tags=new')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        response = self.client.get(
+            '/api/recipes/pantry/?ingredients=1&missing=10&tags=new')
+        self.assertEqual(response.status_code, 200)
+
+    def test_keyset_pagination(self):
+        """
+        Пагинация по курсору обходит все рецепты без пропусков,
+        в том числе при совпадающих датах публикации.
+        Глубокие страницы стоят столько же запросов, сколько первая.
+        """
+        self.create_recipes(10)
+        Recipe.objects.filter(id__lte=5).update(
+            pub_date=Recipe.objects.get(id=5).pub_date)
+        expected = list(Recipe.objects.values_list('id', flat=True))
+        received = []
+        url = '/api/recipes/?limit=3&cursor='
+        while url:
+            with self.assertNumQueries(3):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            received += [recipe['id'] for recipe in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(received, expected)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            expected[-4:-1])
+        response = self.client.get('/api/recipes/?cursor=&count=true')
+        self.assertEqual(response.data['count'], 10)
+        response = self.client.get('/api/recipes/?cursor=broken')
+        self.assertEqual(response.status_code, 404)
+
+    def test_keyset_pagination_invalid_position(self):
+        """Курсор с позицией неподходящего вида или типа дает 404."""
+        self.create_recipes(2)
+        positions = (
+            ['garbage', 1], [[1, 2], 'x'], ['2020-01-01T00:00:00', 'abc'],
+            [True, 1], [1], {'a': 1, 'b': 2}, 'text',
+        )
+        for position in positions:
+            for reverse in (False, 1):
+                raw = json.dumps([position, reverse]).encode()
+                cursor = base64.urlsafe_b64encode(raw).decode()
+                with self.subTest(position=position, reverse=reverse):
+                    response = self.client.get(
+                        f'/api/recipes/?cursor={cursor}')
+                    self.assertEqual(response.status_code, 404)
+
+
+class ShoppingListTests(TestCase):
+    """Проверка скачивания списка покупок в разных форматах."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@ya.ru')
+        cls.ingredient = Ingredient.objects.create(
+            name='Мука', measurement_unit='г')
+        for amount in (100, 250):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {amount}', text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg', author=cls.user
+            )
+            AmountIngredient.objects.create(
+                recipe=recipe, ingredient=cls.ingredient, amount=amount)
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+        ShoppingCartIngredient.objects.rebuild()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(ShoppingListTests.user)
+
+    def download(self, file_format=None):
+        url = '/api/recipes/download_shopping_cart/'
+        if file_format:
+            url += f'?format={file_format}'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_txt(self):
+        with self.assertNumQueries(1):
+            response = self.download()
+            content = b''.join(response.streaming_content).decode()
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('Мука - 350 г', content)
+
+    def test_csv(self):
+        response = self.download('csv')
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('shopping_cart.csv', response['Content-Disposition'])
+        self.assertIn('Мука,350,г', content)
+
+    def test_pdf(self):
+        response = self.download('pdf')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(content.startswith(b'%PDF'))
+
+    def test_empty_cart(self):
+        """Пустая корзина отдается документом запрошенного формата."""
+        ShoppingCart.objects.all().delete()
+        ShoppingCartIngredient.objects.rebuild()
+        content = b''.join(self.download().streaming_content).decode()
+        self.assertIn('В корзине нет товаров!', content)
+        response = self.download('csv')
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(content.splitlines(),
+                         ['Ингредиент,Количество,Единицы измерения'])
+        response = self.download('pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(b''.join(response.streaming_content).startswith(
+            b'%PDF'))
+
+
+class ShoppingCartIngredientTests(TestCase):
+    """Проверка поддержки сводной корзины в актуальном состоянии."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='buyer', email='buyer@ya.ru')
+        cls.flour, cls.sugar, cls.salt = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Мука', 'Сахар', 'Соль')
+        )
+        cls.tag = Tag.objects.create(name='Обед', color='#FF8000',
+                                     slug='lunch')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(ShoppingCartIngredientTests.user)
+
+    def create_recipe(self, amounts):
+        recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/images/test.jpg',
+            author=ShoppingCartIngredientTests.user
+        )
+        for ingredient, amount in amounts.items():
+            AmountIngredient.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=amount)
+        return recipe
+
+    def cart(self):
+        return dict(ShoppingCartIngredient.objects.values_list(
+            'ingredient__name', 'amount'))
+
+    def test_add_remove_update(self):
+        cls = ShoppingCartIngredientTests
+        first = self.create_recipe({cls.flour: 100, cls.sugar: 10})
+        second = self.create_recipe({cls.flour: 50})
+        for recipe in (first, second):
+            response = self.client.post(
+                f'/api/recipes/{recipe.id}/shopping_cart/')
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.cart(), {'Мука': 150, 'Сахар': 10})
+
+        response = self.client.patch(
+            f'/api/recipes/{first.id}/',
+            {'ingredients': [{'id': cls.flour.id, 'amount': 200},
+                             {'id': cls.salt.id, 'amount': 5}],
+             'tags': [cls.tag.id]},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.cart(), {'Мука': 250, 'Соль': 5})
+
+        response = self.client.delete(
+            f'/api/recipes/{second.id}/shopping_cart/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.cart(), {'Мука': 200, 'Соль': 5})
+
+        response = self.client.delete(f'/api/recipes/{first.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.cart(), {})
+
+    def test_rebuild_command(self):
+        cls = ShoppingCartIngredientTests
+        recipe = self.create_recipe({cls.flour: 100})
+        # пакетная вставка минует сигналы, как при импорте данных
+        ShoppingCart.objects.bulk_create(
+            [ShoppingCart(user=cls.user, recipe=recipe)])
+        out = StringIO()
+        call_command('rebuild_shopping_carts', '--check', stdout=out)
+        self.assertIn('Расхождения', out.getvalue())
+        self.assertEqual(self.cart(), {})
+        call_command('rebuild_shopping_carts', stdout=StringIO())
+        self.assertEqual(self.cart(), {'Мука': 100})
+
+    def test_shared_recipe(self):
+        """Рецепт в корзинах двух пользователей не задваивает суммы."""
+        cls = ShoppingCartIngredientTests
+        other = User.objects.create_user(username='other', email='o@ya.ru')
+        recipe = self.create_recipe({cls.flour: 100, cls.sugar: 10})
+        for user in (cls.user, other):
+            self.client.force_authenticate(user)
+            response = self.client.post(
+                f'/api/recipes/{recipe.id}/shopping_cart/')
+            self.assertEqual(response.status_code, 201)
+        expected = {
+            (user.id, ingredient.id): amount
+            for user in (cls.user, other)
+            for ingredient, amount in ((cls.flour, 100), (cls.sugar, 10))
+        }
+        manager = ShoppingCartIngredient.objects
+        self.assertEqual(manager.stored(), expected)
+        self.assertEqual(manager.calculate(), expected)
+        self.assertEqual(manager.calculate([other.id]), {
+            key: amount for key, amount in expected.items()
+            if key[0] == other.id})
+        manager.rebuild()
+        self.assertEqual(manager.stored(), expected)
+
+    def test_changes_outside_api(self):
+        """Изменения через ORM (админка, каскадное удаление)."""
+        cls = ShoppingCartIngredientTests
+        other = User.objects.create_user(username='other', email='o@ya.ru')
+        first = self.create_recipe({cls.flour: 100, cls.sugar: 10})
+        second = self.create_recipe({cls.flour: 50})
+        manager = ShoppingCartIngredient.objects
+
+        def check():
+            self.assertEqual(manager.stored(), manager.calculate())
+
+        for user in (cls.user, other):
+            ShoppingCart.objects.create(user=user, recipe=first)
+        cart = ShoppingCart.objects.create(user=cls.user, recipe=second)
+        check()
+        self.assertEqual(manager.stored([cls.user.id]), {
+            (cls.user.id, cls.flour.id): 150,
+            (cls.user.id, cls.sugar.id): 10})
+        ShoppingCart.objects.filter(user=other, recipe=first).first().delete()
+        check()
+        cart.recipe = first
+        cart.user = other
+        cart.save()
+        check()
+        amount = first.amounts.get(ingredient=cls.flour)
+        amount.amount = 300
+        amount.save()
+        AmountIngredient.objects.create(recipe=first, ingredient=cls.salt,
+                                        amount=5)
+        first.amounts.filter(ingredient=cls.sugar).delete()
+        check()
+        second.delete()
+        check()
+        first.delete()
+        check()
+        self.assertEqual(self.cart(), {})
+
+
+class IngredientSearchTests(TestCase):
+    """Проверка поиска ингредиентов по индексу в памяти."""
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('Молоко', 'молоко топленое', 'Молочный шоколад',
+                     'Мука', 'Миндаль'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def setUp(self):
+        ingredient_index.invalidate()
+
+    def search(self, name):
+        response = self.client.get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()]
+
+    def test_prefix_case_insensitive(self):
+        self.assertEqual(self.search('МОЛО'), [
+            'Молоко', 'молоко топленое', 'Молочный шоколад'])
+        self.assertEqual(self.search('мук'), ['Мука'])
+        self.assertEqual(self.search('сыр'), [])
+
+    def test_exact_match_first(self):
+        self.assertEqual(self.search('молоко')[0], 'Молоко')
+
+    def test_limit_and_no_queries(self):
+        self.search('м')
+        with self.settings(INGREDIENT_SEARCH_LIMIT=2):
+            with self.assertNumQueries(0):
+                self.assertEqual(len(self.search('м')), 2)
+
+    def test_refresh_on_change(self):
+        self.assertEqual(self.search('мёд'), [])
+        Ingredient.objects.create(name='Мёд', measurement_unit='г')
+        self.assertEqual(self.search('мёд'), ['Мёд'])
+
+
+class RecipeSearchTests(TestCase):
+    """Проверка поиска рецептов (?search=)."""
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        for name, text in (('Суп с борщом', 'Описание'),
+                           ('Борщ', 'Классический рецепт'),
+                           ('Салат', 'Подавать к борщ')):
+            Recipe.objects.create(name=name, text=text, cooking_time=10,
+                                  image='recipes/images/test.jpg',
+                                  author=author)
+        Recipe.objects.create(name='Компот', text='Описание',
+                              cooking_time=10,
+                              image='recipes/images/test.jpg',
+                              author=author)
+
+    def test_search_ranking(self):
+        response = self.client.get('/api/recipes/', {'search': 'Борщ'})
+        self.assertEqual(response.status_code, 200)
+        names = [recipe['name'] for recipe in response.json()['results']]
+        self.assertEqual(names[0], 'Борщ')
+        self.assertNotIn('Компот', names)
+
+    def test_search_with_cursor(self):
+        response = self.client.get('/api/recipes/',
+                                   {'search': 'Борщ', 'cursor': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.json())
+        response = self.client.get('/api/recipes/', {
+            'search': 'Борщ', 'ordering': 'popular', 'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/recipes/',
+                                   {'search': ' ', 'cursor': ''})
+        self.assertEqual(response.status_code, 200)
+
+    def test_empty_search(self):
+        response = self.client.get('/api/recipes/', {'search': ' '})
+        self.assertEqual(response.json()['count'], 4)
+
+
+class ResponseCacheTests(TestCase):
+    """Проверка версионного кэша ответов."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.reader = User.objects.create_user(
+            username='reader', email='reader@ya.ru')
+        cls.tag = Tag.objects.create(name='Обед', color='#FF8000',
+                                     slug='lunch')
+        cls.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/images/test.jpg', author=cls.author
+        )
+        cls.recipe.tags.set([cls.tag])
+        Favorite.objects.create(user=cls.reader, recipe=cls.recipe)
+        Subscribe.objects.create(user=cls.reader, author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        self.url = f'/api/recipes/{ResponseCacheTests.recipe.id}/'
+
+    def test_tags_cached_and_invalidated(self):
+        self.client.get('/api/tags/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/tags/')
+        self.assertEqual(len(response.json()), 1)
+        Tag.objects.create(name='Ужин', color='#000000', slug='dinner')
+        response = self.client.get('/api/tags/')
+        self.assertEqual(len(response.json()), 2)
+
+    def test_recipe_detail_user_fields_not_shared(self):
+        reader = APIClient()
+        reader.force_authenticate(ResponseCacheTests.reader)
+        response = reader.get(self.url)
+        self.assertTrue(response.data['is_favorited'])
+        # только updated_at для ETag
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertFalse(response.data['is_favorited'])
+        self.assertFalse(response.data['author']['is_subscribed'])
+        with self.assertNumQueries(2):
+            response = reader.get(self.url)
+        self.assertTrue(response.data['is_favorited'])
+        self.assertTrue(response.data['author']['is_subscribed'])
+        self.assertFalse(response.data['is_in_shopping_cart'])
+
+    def test_recipe_detail_invalidated(self):
+        self.client.get(self.url)
+        recipe = ResponseCacheTests.recipe
+        recipe.name = 'Новое название'
+        recipe.save()
+        self.assertEqual(self.client.get(self.url).data['name'],
+                         'Новое название')
+        ResponseCacheTests.tag.name = 'Полдник'
+        ResponseCacheTests.tag.save()
+        self.assertEqual(self.client.get(self.url).data['tags'][0]['name'],
+                         'Полдник')
+
+    def test_recipe_detail_filters_and_host(self):
+        """Фильтры применяются и при записи в кэше; ссылки с хостом."""
+        self.client.get(self.url)
+        response = self.client.get(self.url + '?is_favorited=1')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(self.url, HTTP_HOST='other.example.com')
+        self.assertTrue(response.data['image'].startswith(
+            'http://other.example.com/'))
+        response = self.client.get(self.url)
+        self.assertTrue(response.data['image'].startswith(
+            'http://testserver/'))
+
+
+class ConditionalGetTests(TestCase):
+    """Проверка ответов 304 по ETag и Last-Modified."""
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@ya.ru')
+        cls.tag = Tag.objects.create(name='Обед', color='#FF8000',
+                                     slug='lunch')
+        cls.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/images/test.jpg', author=cls.user
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(ConditionalGetTests.user)
+
+    def test_not_modified_without_queries(self):
+        for url in ('/api/tags/', '/api/ingredients/', '/api/recipes/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                with self.assertNumQueries(0):
+                    response = self.client.get(
+                        url, HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(response.status_code, 304)
+                self.assertFalse(response.content)
+
+    def test_ingredient_search_not_modified(self):
+        url = '/api/ingredients/?name=со'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            cached = self.client.get(url,
+                                     HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        Ingredient.objects.create(name='Соль', measurement_unit='г')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['name'], 'Соль')
+
+    def test_if_modified_since(self):
+        """
+        Last-Modified отдается, только когда секунда изменения прошла:
+        иначе следующее изменение в ту же секунду было бы не видно.
+        """
+        self.assertNotIn('Last-Modified', self.client.get('/api/tags/'))
+        cache.set(VERSION_KEY.format('tag'), (int(time.time()) - 10) * 1000)
+        response = self.client.get('/api/tags/')
+        last_modified = response['Last-Modified']
+        response = self.client.get(
+            '/api/tags/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        bump_versions('tag')
+        response = self.client.get(
+            '/api/tags/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(CACHE_VERSION_TIMEOUT=0.05)
+    def test_versions_expire(self):
+        """
+        Версии в кэше процесса истекают, поэтому изменения из других
+        процессов меняют ETag не позже CACHE_VERSION_TIMEOUT.
+        """
+        etag = self.client.get('/api/tags/')['ETag']
+        time.sleep(0.1)
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_changes(self):
+        url = f'/api/recipes/{ConditionalGetTests.recipe.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Favorite.objects.create(user=ConditionalGetTests.user,
+                                recipe=ConditionalGetTests.recipe)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorited'])
+        self.assertNotEqual(
+            APIClient().get(url)['ETag'], response['ETag'])
+
+        etag = self.client.get('/api/tags/')['ETag']
+        Tag.objects.create(name='Ужин', color='#000000', slug='dinner')
+        response = self.client.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RecipeWriteQueriesTests(TestCase):
+    """
+    Проверка количества запросов при создании и изменении рецепта:
+    не зависит от числа ингредиентов.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.tag = Tag.objects.create(name='Обед', color='#FF8000',
+                                     slug='lunch')
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'Ингредиент {i}', measurement_unit='г')
+            for i in range(60)
+        )
+        cls.ingredient_ids = list(
+            Ingredient.objects.values_list('id', flat=True))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(RecipeWriteQueriesTests.user)
+
+    def payload(self, count, amount=10):
+        return {
+            'ingredients': [
+                {'id': ingredient_id, 'amount': amount}
+                for ingredient_id
+                in RecipeWriteQueriesTests.ingredient_ids[:count]
+            ],
+            'tags': [RecipeWriteQueriesTests.tag.id],
+            'image': SMALL_GIF,
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 10,
+        }
+
+    def count_queries(self, method, url, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = method(url, data, format='json')
+        self.assertIn(response.status_code, (200, 201))
+        return len(queries), response
+
+    def test_create_and_update(self):
+        # первая загрузка изображения добавляет запись MediaFile
+        self.client.post('/api/recipes/', self.payload(1), format='json')
+        small, _ = self.count_queries(self.client.post, '/api/recipes/',
+                                      self.payload(5))
+        large, response = self.count_queries(
+            self.client.post, '/api/recipes/', self.payload(50))
+        self.assertEqual(small, large)
+        self.assertLess(large, 15)
+
+        url = f"/api/recipes/{response.data['id']}/"
+        data = self.payload(50)
+        data['ingredients'][0]['amount'] = 99
+        data['ingredients'][1:3] = [
+            {'id': ingredient_id, 'amount': 1}
+            for ingredient_id in RecipeWriteQueriesTests.ingredient_ids[55:57]
+        ]
+        count, response = self.count_queries(self.client.patch, url, data)
+        self.assertLess(count, 20)
+        amounts = dict(AmountIngredient.objects.filter(
+            recipe_id=response.data['id']).values_list(
+            'ingredient_id', 'amount'))
+        self.assertEqual(amounts, {
+            ingredient['id']: ingredient['amount']
+            for ingredient in data['ingredients']
+        })
+
+    def test_duplicates_and_missing(self):
+        data = self.payload(2)
+        data['ingredients'].append(data['ingredients'][0])
+        response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        data = self.payload(2)
+        data['ingredients'][0]['id'] = 0
+        response = self.client.post('/api/recipes/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class SubscriptionsQueriesTests(TestCase):
+    """
+    Список подписок: число запросов не зависит от количества авторов,
+    recipes_limit ограничивает рецепты каждого автора.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='follower', email='follower@ya.ru')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(SubscriptionsQueriesTests.user)
+
+    def subscribe(self, start, count):
+        for i in range(start, start + count):
+            author = User.objects.create_user(
+                username=f'author{i}', email=f'author{i}@ya.ru')
+            Subscribe.objects.create(user=SubscriptionsQueriesTests.user,
+                                     author=author)
+            Recipe.objects.bulk_create(
+                Recipe(name=f'Рецепт {j}', text='Описание', cooking_time=10,
+                       image='recipes/images/test.jpg', author=author)
+                for j in range(i % 4 + 1)
+            )
+            call_command('recount', stdout=StringIO())
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/subscriptions/',
+                                       {'limit': 50, **params})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data['results']
+
+    def test_queries_do_not_depend_on_authors(self):
+        self.subscribe(0, 2)
+        small, _ = self.get(recipes_limit=2)
+        self.subscribe(2, 10)
+        large, results = self.get(recipes_limit=2)
+        self.assertEqual(small, large)
+        self.assertEqual(len(results), 12)
+        for author in results:
+            recipes = Recipe.objects.filter(author_id=author['id'])
+            self.assertTrue(author['is_subscribed'])
+            self.assertEqual(author['recipes_count'], recipes.count())
+            self.assertEqual(
+                [recipe['id'] for recipe in author['recipes']],
+                list(recipes.values_list('id', flat=True)[:2]))
+
+    def test_without_limit(self):
+        self.subscribe(0, 4)
+        for recipes_limit in ('', 'abc'):
+            _, results = self.get(recipes_limit=recipes_limit)
+            for author in results:
+                self.assertEqual(len(author['recipes']),
+                                 author['recipes_count'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class FeedTests(TestCase):
+    """
+    Лента подписок: обе стратегии дают одинаковый результат,
+    страницы выбираются по курсору.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@ya.ru')
+        cls.authors = [
+            User.objects.create_user(username=f'author{i}',
+                                     email=f'author{i}@ya.ru')
+            for i in range(3)
+        ]
+        cls.other = User.objects.create_user(
+            username='other', email='other@ya.ru')
+        cls.ingredient = Ingredient.objects.create(name='Соль',
+                                                   measurement_unit='г')
+        cls.tag = Tag.objects.create(name='Завтрак', color='#FF8000',
+                                     slug='breakfast')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(FeedTests.user)
+
+    def publish(self, author, count):
+        client = APIClient()
+        client.force_authenticate(author)
+        for i in range(count):
+            response = client.post('/api/recipes/', {
+                'name': f'Рецепт {i}', 'text': 'Описание',
+                'cooking_time': 10, 'image': SMALL_GIF,
+                'tags': [FeedTests.tag.id],
+                'ingredients': [{'id': FeedTests.ingredient.id,
+                                 'amount': 1}],
+            }, format='json')
+            self.assertEqual(response.status_code, 201)
+
+    def read_feed(self):
+        ids, url = [], '/api/recipes/feed/?limit=4'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(recipe['id'] for recipe in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def check_feed(self):
+        self.client.post(f'/api/users/{FeedTests.authors[0].id}/subscribe/')
+        self.publish(FeedTests.authors[0], 3)
+        self.publish(FeedTests.other, 2)
+        self.client.post(f'/api/users/{FeedTests.authors[1].id}/subscribe/')
+        self.publish(FeedTests.authors[1], 4)
+        self.client.post(f'/api/users/{FeedTests.authors[2].id}/subscribe/')
+        self.assertEqual(self.read_feed(), list(Recipe.objects.filter(
+            author__in=FeedTests.authors[:2]).values_list('id', flat=True)))
+        self.client.delete(
+            f'/api/users/{FeedTests.authors[0].id}/subscribe/')
+        self.assertEqual(self.read_feed(), list(Recipe.objects.filter(
+            author=FeedTests.authors[1]).values_list('id', flat=True)))
+
+    def test_fan_out_on_read(self):
+        self.check_feed()
+        self.assertFalse(FeedEntry.objects.exists())
+
+    @override_settings(FEED_STRATEGY='write')
+    def test_fan_out_on_write(self):
+        self.check_feed()
+        self.assertEqual(FeedEntry.objects.count(), 4)
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feeds', stdout=StringIO())
+        self.assertEqual(FeedEntry.objects.count(), 4)
+
+    def test_anonymous(self):
+        response = APIClient().get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, 401)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CountersTests(TestCase):
+    """
+    Хранимые счетчики меняются вместе со связями,
+    команда recount исправляет расхождения.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@ya.ru')
+        cls.author = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.ingredient = Ingredient.objects.create(name='Соль',
+                                                   measurement_unit='г')
+        cls.tag = Tag.objects.create(name='Ужин', color='#FF8000',
+                                     slug='dinner')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(CountersTests.user)
+        self.author_client = APIClient()
+        self.author_client.force_authenticate(CountersTests.author)
+
+    def create_recipe(self, name):
+        response = self.author_client.post('/api/recipes/', {
+            'name': name, 'text': 'Описание', 'cooking_time': 10,
+            'image': SMALL_GIF, 'tags': [CountersTests.tag.id],
+            'ingredients': [{'id': CountersTests.ingredient.id,
+                             'amount': 1}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Recipe.objects.get(id=response.data['id'])
+
+    def test_relations_and_recipes(self):
+        first = self.create_recipe('Первый')
+        second = self.create_recipe('Второй')
+        author = CountersTests.author
+        for url in (f'/api/recipes/{second.id}/favorite/',
+                    f'/api/recipes/{second.id}/shopping_cart/',
+                    f'/api/users/{author.id}/subscribe/'):
+            self.client.post(url)
+            self.client.post(url)
+        second.refresh_from_db()
+        author.refresh_from_db()
+        self.assertEqual((second.favorites_count, second.in_carts_count),
+                         (1, 1))
+        self.assertEqual((author.recipes_count, author.subscribers_count),
+                         (2, 1))
+
+        self.client.delete(f'/api/recipes/{second.id}/favorite/')
+        self.client.delete(f'/api/users/{author.id}/subscribe/')
+        self.author_client.delete(f'/api/recipes/{first.id}/')
+        second.refresh_from_db()
+        author.refresh_from_db()
+        self.assertEqual(second.favorites_count, 0)
+        self.assertEqual((author.recipes_count, author.subscribers_count),
+                         (1, 0))
+
+    def test_popular_ordering(self):
+        recipes = [self.create_recipe(f'Рецепт {i}') for i in range(3)]
+        self.client.post(f'/api/recipes/{recipes[0].id}/favorite/')
+        response = self.client.get('/api/recipes/?ordering=popular')
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [recipes[0].id, recipes[2].id, recipes[1].id])
+        response = self.client.get(
+            '/api/recipes/?ordering=popular&limit=2&cursor=')
+        response = self.client.get(response.data['next'])
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [recipes[1].id])
+
+    def test_admin_changes(self):
+        recipe = self.create_recipe('Рецепт')
+        admin = User.objects.create_superuser(
+            username='admin', email='admin@ya.ru', password='admin')
+        client = Client()
+        client.force_login(admin)
+        Favorite.objects.create(user=CountersTests.user, recipe=recipe)
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        response = client.post(f'/admin/recipes/recipe/{recipe.id}/delete/',
+                               {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Recipe.objects.filter(id=recipe.id).exists())
+        self.assertEqual(User.objects.get(
+            id=CountersTests.author.id).recipes_count, 0)
+        self.assertEqual(mismatches(), dict.fromkeys(mismatches(), 0))
+
+    def test_cascade_delete(self):
+        recipe = self.create_recipe('Рецепт')
+        reader = User.objects.create_user(username='guest',
+                                          email='guest@ya.ru')
+        Favorite.objects.create(user=reader, recipe=recipe)
+        ShoppingCart.objects.create(user=reader, recipe=recipe)
+        Subscribe.objects.create(user=reader, author=CountersTests.author)
+        reader.delete()
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.favorites_count, recipe.in_carts_count),
+                         (0, 0))
+        self.assertEqual(User.objects.get(
+            id=CountersTests.author.id).subscribers_count, 0)
+        User.objects.filter(id=CountersTests.author.id).delete()
+        self.assertEqual(mismatches(), dict.fromkeys(mismatches(), 0))
+
+    def test_recount_command(self):
+        recipe = self.create_recipe('Рецепт')
+        # bulk_create без сигналов: счетчик расходится с данными
+        Favorite.objects.bulk_create(
+            [Favorite(user=CountersTests.user, recipe=recipe)])
+        User.objects.filter(id=CountersTests.author.id).update(
+            recipes_count=5)
+        out = StringIO()
+        call_command('recount', '--check', stdout=out)
+        self.assertIn('favorites_count (1)', out.getvalue())
+        self.assertIn('recipes_count (1)', out.getvalue())
+        call_command('recount', stdout=StringIO())
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(Recipe.objects.filter(author__recipes_count=1)
+                         .count(), 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_PIPELINE_ASYNC=False)
+class ImagePipelineTests(TestCase):
+    """
+    Изображение сохраняется без обработки в запросе,
+    уменьшенные копии создаются после фиксации транзакции.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.ingredient = Ingredient.objects.create(name='Соль',
+                                                   measurement_unit='г')
+        cls.tag = Tag.objects.create(name='Ужин', color='#FF8000',
+                                     slug='dinner')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(ImagePipelineTests.user)
+
+    @staticmethod
+    def image_data(content):
+        return 'data:image/png;base64,' + base64.b64encode(content).decode()
+
+    @staticmethod
+    def png(width, height):
+        buffer = BytesIO()
+        Image.new('RGB', (width, height), (200, 80, 0)).save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def create_recipe(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/recipes/', {
+                'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 10,
+                'image': image, 'tags': [ImagePipelineTests.tag.id],
+                'ingredients': [{'id': ImagePipelineTests.ingredient.id,
+                                 'amount': 1}],
+            }, format='json')
+
+    def test_variants(self):
+        response = self.create_recipe(self.image_data(self.png(2000, 1000)))
+        self.assertEqual(response.status_code, 201)
+        recipe = Recipe.objects.get(id=response.data['id'])
+        self.assertEqual(recipe.image_status, Recipe.IMAGE_READY)
+        for variant, formats in variant_names(recipe.image.name).items():
+            size = settings.IMAGE_VARIANTS[variant]
+            for name in formats.values():
+                with Image.open(default_storage.open(name)) as image:
+                    self.assertEqual(image.size, (size, size // 2))
+        response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertTrue(response.data['images']['card']['webp'].endswith(
+            'card.webp'))
+
+    def test_invalid_images(self):
+        """Поврежденные и обрезанные файлы отклоняются в запросе."""
+        buffer = BytesIO()
+        Image.new('RGB', (300, 200), (0, 80, 200)).save(buffer, 'JPEG')
+        jpeg = buffer.getvalue()
+        for content in (b'not an image', self.png(10, 10)[:40],
+                        self.png(10, 10)[:-10], jpeg[:len(jpeg) // 2]):
+            with self.subTest(size=len(content)):
+                response = self.create_recipe(self.image_data(content))
+                self.assertEqual(response.status_code, 400)
+        response = self.create_recipe(self.image_data(jpeg))
+        self.assertEqual(response.status_code, 201)
+
+    def test_decompression_bomb(self):
+        """Слишком большое разрешение: 400 в запросе, FAILED в обработке."""
+        response = self.create_recipe(self.image_data(self.png(50, 50)))
+        recipe_id = response.data['id']
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 100
+        try:
+            response = self.create_recipe(self.image_data(self.png(40, 40)))
+            self.assertEqual(response.status_code, 400)
+            with self.assertLogs('api.images', 'WARNING'):
+                process_recipe(recipe_id, force=True)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+        self.assertEqual(Recipe.objects.get(id=recipe_id).image_status,
+                         Recipe.IMAGE_FAILED)
+
+    def test_process_images_command(self):
+        response = self.create_recipe(self.image_data(self.png(50, 50)))
+        Recipe.objects.update(image_status=Recipe.IMAGE_PENDING)
+        out = StringIO()
+        call_command('process_images', stdout=out)
+        self.assertIn('Обработано изображений: 1', out.getvalue())
+        self.assertEqual(Recipe.objects.get(
+            id=response.data['id']).image_status, Recipe.IMAGE_READY)
+        # копии перезаписываются через временные файлы
+        recipe = Recipe.objects.get(id=response.data['id'])
+        process_recipe(recipe.id, force=True)
+        directory = os.path.dirname(
+            variant_names(recipe.image.name)['card']['webp'])
+        files = default_storage.listdir(directory)[1]
+        self.assertEqual(len(files), 2 * len(settings.IMAGE_VARIANTS))
+        self.assertFalse([name for name in files if name.endswith('.tmp')])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_PIPELINE_ASYNC=False)
+class MediaStorageTests(TestCase):
+    """
+    Изображения хранятся по хэшу содержимого без повторов,
+    файлы без ссылок удаляет команда gc_media.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='author', email='author@ya.ru')
+        cls.ingredient = Ingredient.objects.create(name='Соль',
+                                                   measurement_unit='г')
+        cls.tag = Tag.objects.create(name='Ужин', color='#FF8000',
+                                     slug='dinner')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(MediaStorageTests.user)
+
+    def save_recipe(self, image, recipe_id=None):
+        data = {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 10,
+            'image': image, 'tags': [MediaStorageTests.tag.id],
+            'ingredients': [{'id': MediaStorageTests.ingredient.id,
+                             'amount': 1}],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            if recipe_id is None:
+                response = self.client.post('/api/recipes/', data,
+                                            format='json')
+            else:
+                response = self.client.patch(f'/api/recipes/{recipe_id}/',
+                                             data, format='json')
+        return Recipe.objects.get(id=response.data['id'])
+
+    @staticmethod
+    def references():
+        return dict(MediaFile.objects.values_list('name', 'ref_count'))
+
+    def test_deduplication_and_gc(self):
+        first = self.save_recipe(SMALL_GIF)
+        second = self.save_recipe(SMALL_GIF)
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertEqual(self.references(), {name: 2})
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT,
+                                                 'recipes/images')),
+                         [os.path.basename(name)])
+
+        buffer = BytesIO()
+        Image.new('RGB', (4, 4)).save(buffer, 'PNG')
+        other = 'data:image/png;base64,' + base64.b64encode(
+            buffer.getvalue()).decode()
+        second = self.save_recipe(other, second.id)
+        self.client.delete(f'/api/recipes/{first.id}/')
+        self.assertEqual(self.references(),
+                         {name: 0, second.image.name: 1})
+
+        call_command('gc_media', '--min-age', '0', stdout=StringIO())
+        self.assertFalse(default_storage.exists(name))
+        for formats in variant_names(name).values():
+            for variant in formats.values():
+                self.assertFalse(default_storage.exists(variant))
+        self.assertTrue(default_storage.exists(second.image.name))
+        self.assertEqual(self.references(), {second.image.name: 1})
+
+    def test_concurrent_save_keeps_hashed_name(self):
+        """
+        Запрос, который не застал файл, а затем проиграл гонку записи
+        тому же содержимому, получает имя по хэшу без суффикса.
+        """
+        storage = Recipe._meta.get_field('image').storage
+        name = storage.save('recipes/images/race.gif',
+                            ContentFile(b'GIF89a-race'))
+        storage.touch = lambda name: False
+        try:
+            self.assertEqual(storage.save('recipes/images/other.gif',
+                                          ContentFile(b'GIF89a-race')),
+                             name)
+        finally:
+            del storage.touch
+        self.assertEqual(storage.listdir('recipes/images')[1],
+                         [os.path.basename(name)])
+        with self.assertRaises(FileExistsError):
+            storage.get_available_name(name)
+        storage.delete(name)
+
+    def test_gc_skips_reuploaded_file(self):
+        """
+        Повторная загрузка файла без ссылок обновляет время его изменения,
+        и gc_media не удаляет его до сохранения рецепта.
+        """
+        recipe = self.save_recipe(SMALL_GIF)
+        name = recipe.image.name
+        self.client.delete(f'/api/recipes/{recipe.id}/')
+        storage = Recipe._meta.get_field('image').storage
+        old = time.time() - 2 * 60 * 60
+        os.utime(storage.path(name), (old, old))
+        MediaFile.objects.filter(name=name).update(
+            updated_at=timezone.now() - timedelta(hours=2))
+        with storage.open(name) as file:
+            self.assertEqual(storage.save(name, file), name)
+        call_command('gc_media', '--min-age', '60', stdout=StringIO())
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(self.references(), {name: 0})
+        os.utime(storage.path(name), (old, old))
+        call_command('gc_media', '--min-age', '60', stdout=StringIO())
+        self.assertFalse(storage.exists(name))
+        self.assertEqual(self.references(), {})
+
+
+class StreamingJSONParserTests(TestCase):
+    """
+    Разбор JSON по частям: строка base64 поля image попадает
+    во временный файл, остальные данные не меняются.
+    """
+    def parse(self, body, chunk_size=7):
+        parser = StreamingJSONParser()
+        parser.chunk_size = chunk_size
+        return parser.parse(BytesIO(body.encode()))
+
+    def test_image_streamed_to_file(self):
+        content = bytes(range(256)) * 20
+        encoded = base64.b64encode(content).decode()
+        data = {'name': 'Рецепт "image"', 'image': 'x',
+                'ingredients': [{'id': 1, 'image': 'вложенное'}],
+                'text': 'image: \\ / "'}
+        body = json.dumps(data).replace(
+            '"x"', '"data:image/png;base64,' + encoded.replace('/', '\\/')
+            + '"')
+        for chunk_size in (1, 7, 4096):
+            parsed = self.parse(body, chunk_size)
+            image = parsed.pop('image')
+            self.assertEqual(image.read(), content)
+            self.assertEqual(image.size, len(content))
+            self.assertEqual(parsed, {key: value for key, value
+                                      in data.items() if key != 'image'})
+
+    @override_settings(IMAGE_UPLOAD_MEMORY_LIMIT=100)
+    def test_memory_limit(self):
+        encoded = base64.b64encode(b'1' * 1000).decode()
+        image = self.parse(json.dumps({'image': encoded}))['image']
+        self.assertTrue(image.file._rolled)
+        self.assertEqual(image.read(), b'1' * 1000)
+
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=100)
+    def test_errors(self):
+        for body in ('{"image": "' + 'A' * 200 + '"}',
+                     '{"image": "!!!!"}',
+                     '{"image": "QUJD',
+                     '{"name": }'):
+            with self.assertRaises(ParseError):
+                self.parse(body)
+        self.assertEqual(self.parse('{"image": null}'), {'image': None})
+
+
+@override_settings(TOKEN_CACHE_SHARED=True)
+class CachedTokenAuthenticationTests(TestCase):
+    """
+    Пользователь по токену берется из кэша без запроса к базе
+    и сбрасывается при выходе, смене пароля и деактивации.
+    Общий кэш здесь - locmem процесса тестов.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='reader', email='reader@ya.ru', password='Old-pass-123')
+
+    def setUp(self):
+        cache.clear()
+        local_token_cache.clear()
+        revocations.reset()
+        self.client = APIClient()
+        response = self.client.post('/api/auth/token/login/', {
+            'email': 'reader@ya.ru', 'password': 'Old-pass-123'})
+        self.key = response.data['auth_token']
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.key}')
+
+    def get(self, url='/api/users/me/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, len(queries)
+
+    def test_no_token_query(self):
+        url = '/api/recipes/download_shopping_cart/'
+        response, first = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        local_token_cache.clear()
+        for _ in range(2):
+            response, cached = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(cached, first - 1)
+
+    def test_me_without_queries(self):
+        for shared in (True, False):
+            with self.subTest(shared=shared), self.settings(
+                    TOKEN_CACHE_SHARED=shared):
+                local_token_cache.clear()
+                self.get()
+                response, queries = self.get()
+                self.assertEqual(queries, 0)
+                self.assertEqual(response.data['email'], 'reader@ya.ru')
+                self.assertFalse(response.data['is_subscribed'])
+
+    def test_cached_fields(self):
+        self.get()
+        fields = cache.get(token_cache_key(self.key))
+        self.assertEqual(set(fields), set(CACHED_USER_FIELDS))
+        self.assertEqual(fields['id'], CachedTokenAuthenticationTests.user.id)
+        self.assertEqual(local_token_cache.get(self.key), (fields, 0))
+
+    @override_settings(TOKEN_CACHE_REVOCATION_INTERVAL=60)
+    def test_revocations_read_once_per_interval(self):
+        self.get()
+        # отзыв какого-то токена в другом процессе
+        cache.set(REVOCATIONS_CACHE_KEY, 100)
+        response, queries = self.get()
+        self.assertEqual((response.status_code, queries), (200, 0))
+        self.assertEqual(local_token_cache.get(self.key)[1], 0)
+        revocations.reset()
+        self.assertEqual(self.get()[0].status_code, 200)
+        self.assertEqual(local_token_cache.get(self.key)[1], 100)
+
+    def test_revoked_in_other_process(self):
+        """Запись LRU другого процесса не действует после отзыва токена."""
+        self.get()
+        entry = local_token_cache.get(self.key)
+        self.client.post('/api/auth/token/logout/')
+        local_token_cache.set(self.key, entry)
+        # другой процесс читает счетчик отзывов через интервал
+        revocations.reset()
+        self.assertEqual(self.get()[0].status_code, 401)
+
+    @override_settings(TOKEN_CACHE_SHARED=False)
+    def test_local_only(self):
+        self.get()
+        self.assertIsNotNone(local_token_cache.get(self.key))
+        self.assertIsNone(cache.get(token_cache_key(self.key)))
+        self.client.post('/api/auth/token/logout/')
+        self.assertEqual(self.get()[0].status_code, 401)
+
+    @override_settings(TOKEN_CACHE=False)
+    def test_disabled(self):
+        self.get()
+        self.assertIsNone(local_token_cache.get(self.key))
+        self.assertIsNone(cache.get(token_cache_key(self.key)))
+
+    def test_logout(self):
+        self.get()
+        self.client.post('/api/auth/token/logout/')
+        self.assertEqual(self.get()[0].status_code, 401)
+
+    def test_password_change_and_deactivation(self):
+        self.get()
+        response = self.client.post('/api/users/set_password/', {
+            'current_password': 'Old-pass-123',
+            'new_password': 'New-pass-456'})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post('/api/users/set_password/', {
+            'current_password': 'New-pass-456',
+            'new_password': 'Other-pass-789'})
+        self.assertEqual(response.status_code, 204)
+        user = User.objects.get(id=CachedTokenAuthenticationTests.user.id)
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.get()[0].status_code, 401)
+
+
+class ImportCommandsTests(TestCase):
+    """
+    Загрузка справочников: потоковый разбор CSV и JSON,
+    повторная загрузка не создает дублей.
+    """
+    def import_data(self, command, *args):
+        out = StringIO()
+        call_command(command, *args, stdout=out)
+        return out.getvalue()
+
+    def test_iter_json(self):
+        items = [{'name': f'Продукт {index}, "сорт"', 'measurement_unit': 'г'}
+                 for index in range(50)]
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(list(iter_json(
+                StringIO(' ' + json.dumps(items) + '\n'), chunk_size)),
+                items)
+        self.assertEqual(list(iter_json(StringIO('[]'))), [])
+        for body in ('{}', '[{"name": 1}', '[{"name": }]'):
+            with self.assertRaises(ValueError):
+                list(iter_json(StringIO(body), 3))
+
+    def test_import_ingredients(self):
+        csv_path = os.path.join(settings.BASE_DIR, 'data', 'ingredients.csv')
+        with open(csv_path, encoding='utf-8') as file:
+            total = sum(1 for line in file if line.strip())
+        ingredient_index.search('')
+        out = self.import_data('import_ingredients', csv_path,
+                               '--batch-size', '500')
+        self.assertIn(f'Прочитано: {total}, добавлено: {total}', out)
+        self.assertEqual(Ingredient.objects.count(), total)
+        self.assertTrue(Ingredient.objects.filter(
+            name='Абрикосовое варенье').exists())
+        self.assertEqual(len(ingredient_index.search('абрикос')),
+                         Ingredient.objects.filter(
+                             name__startswith='Абрикос').count())
+        out = self.import_data('import_ingredients')
+        self.assertIn('добавлено: 0', out)
+        self.assertEqual(Ingredient.objects.count(), total)
+
+    def test_import_tags_updates_existing(self):
+        Tag.objects.create(name='Старый завтрак', color='#000000',
+                           slug='breakfast')
+        out = self.import_data('import_tags')
+        self.assertIn('Прочитано: 3, добавлено: 2, уже были: 1', out)
+        tag = Tag.objects.get(slug='breakfast')
+        self.assertEqual((tag.name, tag.color), ('Завтрак', '#FF8000'))
+
+    def test_bad_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            file.write('[{"name": "Соль"}]')
+            file.flush()
+            with self.assertRaises(CommandError):
+                self.import_data('import_ingredients', file.name)
+            with self.assertRaises(CommandError):
+                self.import_data('import_ingredients', file.name + '.xml')
+        self.assertFalse(Ingredient.objects.exists())
+
+
+class DatasetTests(TestCase):
+    """
+    Синтетические данные: размеры, согласованность производных
+    данных и сравнение результатов замеров с базовыми.
+    """
+    def test_generate(self):
+        created = DatasetGenerator(
+            users=6, recipes=4, favorites=3, carts=2, subscriptions=2,
+            image='recipes/images/test.jpg', seed=1).generate()
+        self.assertEqual(created['Пользователи'], 6)
+        self.assertEqual(created['Рецепты'], 24)
+        self.assertEqual(Favorite.objects.count(), 18)
+        self.assertEqual(ShoppingCart.objects.count(), 12)
+        self.assertGreaterEqual(Ingredient.objects.count(), 30)
+        for recipe in Recipe.objects.annotate(total=Count('amounts')):
+            self.assertTrue(5 <= recipe.total <= 30)
+        self.assertFalse(any(mismatches().values()))
+        self.assertEqual(ShoppingCartIngredient.objects.stored(),
+                         ShoppingCartIngredient.objects.calculate())
+        self.assertFalse(Subscribe.objects.filter(
+            user=F('author')).exists())
+
+    def test_benchmark_baseline(self):
+        path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        call_command('benchmark', 'ingredient_search', '--repeat', '1',
+                     '--save', path, stdout=StringIO())
+        with open(path, encoding='utf-8') as file:
+            baseline = json.load(file)
+        self.assertEqual(set(baseline['ingredient_search']),
+                         {'database', 'index'})
+        baseline['ingredient_search']['database'].update(ms=0.0001,
+                                                         queries=0)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file)
+        out = StringIO()
+        with self.assertRaisesMessage(CommandError,
+                                      'ingredient_search.database'):
+            call_command('benchmark', 'ingredient_search', '--repeat', '1',
+                         '--compare', path, '--max-regression', '1000',
+                         stdout=out)
+        self.assertIn('queries 0 -> 1', out.getvalue())
+
+
+class RequestMetricsTests(TestCase):
+    """
+    Замеры запросов: заголовок Server-Timing, строка лога
+    и поиск повторяющихся запросов SQL.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author',
+                                          email='author@ya.ru')
+        tag = Tag.objects.create(name='Тег', color='#FF8000', slug='tag')
+        for i in range(3):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {i}', text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg', author=author)
+            recipe.tags.set([tag])
+
+    def test_disabled_by_default(self):
+        response = Client().get('/api/recipes/')
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(REQUEST_METRICS=True)
+    def test_server_timing_and_log(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.assertLogs('api.metrics', 'INFO') as logs:
+                response = Client().get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+        self.assertIn('serializer;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], '/api/recipes/')
+        self.assertEqual(record['queries'], len(queries))
+        self.assertGreater(record['serializer_ms'], 0)
+        self.assertNotIn('duplicates', record)
+
+    @override_settings(REQUEST_METRICS=True)
+    def test_streaming_response(self):
+        """Запросы при чтении потокового ответа попадают в лог."""
+        token = Token.objects.create(
+            user=User.objects.get(username='author'))
+        with self.assertLogs('api.metrics', 'INFO') as logs:
+            response = Client().get('/api/recipes/download_shopping_cart/',
+                                    HTTP_AUTHORIZATION=f'Token {token.key}')
+            self.assertTrue(response.streaming)
+            self.assertEqual(logs.records, [])
+            with CaptureQueriesContext(connection) as queries:
+                content = b''.join(response.streaming_content)
+        self.assertIn('Список покупок'.encode(), content)
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['path'],
+                         '/api/recipes/download_shopping_cart/')
+        self.assertGreaterEqual(record['queries'], len(queries))
+        self.assertGreater(len(queries), 0)
+
+    def test_duplicates(self):
+        self.assertEqual(
+            normalize_sql("SELECT * FROM t WHERE id IN (%s, %s) "
+                          "AND name = 'x' LIMIT 21"),
+            'SELECT * FROM t WHERE id IN (?) AND name = ? LIMIT ?')
+        metrics = RequestMetrics()
+
+        def execute(sql, params, many, context):
+            return None
+
+        for count in range(1, 6):
+            metrics(execute, 'SELECT * FROM t WHERE id IN ('
+                    + ', '.join(['%s'] * count) + ')', [], False, {})
+        metrics(execute, 'SELECT 1', [], False, {})
+        self.assertEqual(metrics.queries, 6)
+        self.assertEqual(metrics.duplicates(5),
+                         {'SELECT * FROM t WHERE id IN (?)': 5})
+
+
+class SimilarRecipesTests(TestCase):
+    """
+    Похожие рецепты и подбор по продуктам через матрицу
+    рецепт-ингредиент, включая ее обновление при изменениях.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author',
+                                          email='author@ya.ru')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {i}',
+                                      measurement_unit='г')
+            for i in range(6)
+        ]
+        cls.recipes = {}
+        for name, positions in (('a', (0, 1, 2)), ('b', (0, 1, 2, 3)),
+                                ('c', (0, 4)), ('d', (5,))):
+            recipe = Recipe.objects.create(
+                name=name, text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg', author=author)
+            for position in positions:
+                AmountIngredient.objects.create(
+                    recipe=recipe, ingredient=cls.ingredients[position],
+                    amount=1)
+            cls.recipes[name] = recipe
+
+    def setUp(self):
+        recipe_matrix.invalidate()
+
+    def names(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [recipe['name'] for recipe in response.data]
+
+    def similar(self, name, **params):
+        return self.names(self.client.get(
+            f'/api/recipes/{self.recipes[name].id}/similar/', params))
+
+    def test_similar(self):
+        self.assertEqual(self.similar('a'), ['b', 'c'])
+        self.assertEqual(self.similar('a', limit=1, metric='cosine'), ['b'])
+        self.assertEqual(self.similar('d'), [])
+        response = self.client.get(
+            f'/api/recipes/{self.recipes["a"].id}/similar/',
+            {'metric': 'euclid'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/recipes/0/similar/').status_code, 404)
+
+    def test_by_ingredients(self):
+        ids = f'{self.ingredients[0].id},{self.ingredients[4].id}'
+        self.assertEqual(self.names(self.client.get(
+            '/api/recipes/by_ingredients/', {'ingredients': ids})),
+            ['c', 'a', 'b'])
+        response = self.client.get('/api/recipes/by_ingredients/',
+                                   {'ingredients': '1,x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_incremental_update(self):
+        for delta_limit in (1000, 0):
+            recipe_matrix.invalidate()
+            with self.settings(SIMILARITY_DELTA_LIMIT=delta_limit):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.assertEqual(self.similar('a'), ['b', 'c'])
+                    amount = AmountIngredient.objects.create(
+                        recipe=self.recipes['d'],
+                        ingredient=self.ingredients[0], amount=1)
+                    self.assertEqual(self.similar('a'), ['b', 'd', 'c'])
+                    amount.delete()
+                    self.assertEqual(self.similar('a'), ['b', 'c'])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        rows = {recipe_id: set(rng.sample(range(1, 40), rng.randint(1, 8)))
+                for recipe_id in range(1, 300)}
+        pairs = [(recipe_id, ingredient_id)
+                 for recipe_id, row in rows.items() for ingredient_id in row]
+        snapshot = MatrixSnapshot(*(np.array(column) for column
+                                    in zip(*pairs)))
+        snapshot = snapshot.changed({5: {1, 2, 3}, 7: set(), 1000: {1, 2}})
+        rows.update({5: {1, 2, 3}, 1000: {1, 2}})
+        del rows[7]
+        query = {1, 2, 3, 4}
+        for metric, score in (
+                ('jaccard', lambda row: len(row & query)
+                 / len(row | query)),
+                ('cosine', lambda row: len(row & query)
+                 / (len(row) * len(query)) ** 0.5)):
+            expected = sorted(
+                ((recipe_id, score(row)) for recipe_id, row in rows.items()
+                 if row & query),
+                key=lambda item: (-item[1], -item[0]))[:15]
+            result = snapshot.top(query, 15, metric)
+            self.assertEqual([recipe_id for recipe_id, _ in result],
+                             [recipe_id for recipe_id, _ in expected])
+            self.assertEqual(snapshot.compacted().top(query, 15, metric),
+                             result)
+
+
+class PantryTests(TestCase):
+    """
+    Подбор рецептов по продуктам: полное и частичное совпадение,
+    фильтр по тегам и обновление индекса при изменении рецептов.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(username='author',
+                                          email='author@ya.ru')
+        cls.tags = [Tag.objects.create(name=f'Тег {i}', color='#FF8000',
+                                       slug=f'tag{i}') for i in range(2)]
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {i}',
+                                      measurement_unit='г')
+            for i in range(6)
+        ]
+        cls.recipes = {}
+        for name, positions, tag in (('a', (0, 1, 2), 0),
+                                     ('b', (0, 1, 2, 3), 1),
+                                     ('c', (0, 4), 0), ('d', (5,), 1)):
+            recipe = Recipe.objects.create(
+                name=name, text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg', author=author)
+            recipe.tags.set([cls.tags[tag]])
+            for position in positions:
+                AmountIngredient.objects.create(
+                    recipe=recipe, ingredient=cls.ingredients[position],
+                    amount=1)
+            cls.recipes[name] = recipe
+
+    def setUp(self):
+        pantry_index.invalidate()
+
+    def pantry(self, positions, **params):
+        response = self.client.get('/api/recipes/pantry/', {
+            'ingredients': ','.join(str(self.ingredients[position].id)
+                                    for position in positions),
+            **params})
+        self.assertEqual(response.status_code, 200)
+        return [(recipe['name'], recipe['missing_ingredients'])
+                for recipe in response.data['results']]
+
+    def test_pantry(self):
+        self.assertEqual(self.pantry((0, 1, 2)), [('a', 0)])
+        self.assertEqual(self.pantry((0, 1, 2), missing=1),
+                         [('a', 0), ('d', 1), ('c', 1), ('b', 1)])
+        self.assertEqual(self.pantry((0, 1, 2), missing=1, tags='tag1'),
+                         [('d', 1), ('b', 1)])
+        self.assertEqual(self.pantry((0, 1, 2), missing=1, limit=1),
+                         [('a', 0)])
+        for params in ({'missing': '-1'}, {'tags': 'unknown'},
+                       {'ingredients': 'x'}):
+            response = self.client.get('/api/recipes/pantry/', params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_refresh_on_change(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.pantry((5,)), [('d', 0)])
+            AmountIngredient.objects.create(
+                recipe=self.recipes['d'], ingredient=self.ingredients[0],
+                amount=1)
+            self.recipes['a'].tags.set([self.tags[1]])
+            self.assertEqual(self.pantry((0, 5), missing=2, tags='tag1'),
+                             [('d', 0), ('a', 2)])
+            ingredient = Ingredient.objects.create(name='Новый',
+                                                   measurement_unit='г')
+            AmountIngredient.objects.create(
+                recipe=self.recipes['c'], ingredient=ingredient, amount=1)
+            self.recipes['b'].delete()
+            self.assertEqual(self.pantry((0, 4), missing=1),
+                             [('d', 1), ('c', 1)])
+
+    def test_matches_brute_force(self):
+        words = np.array([0, 1, 2 ** 64 - 1, 0x8000000000000001],
+                         dtype=np.uint64)
+        self.assertEqual(popcount(words).tolist(), [0, 1, 64, 2])
+        rng = random.Random(1)
+        ingredient_ids = [ingredient.id for ingredient in self.ingredients]
+        for recipe in Recipe.objects.all():
+            recipe.delete()
+        rows = {}
+        for index in range(40):
+            recipe = Recipe.objects.create(
+                name=str(index), text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg',
+                author=User.objects.get(username='author'))
+            rows[recipe.id] = set(rng.sample(ingredient_ids,
+                                             rng.randint(1, 4)))
+            AmountIngredient.objects.bulk_create(
+                AmountIngredient(recipe=recipe, ingredient_id=ingredient_id,
+                                 amount=1)
+                for ingredient_id in rows[recipe.id])
+        snapshot = PantrySnapshot()
+        changed_id = min(rows)
+        rows[changed_id] = set(ingredient_ids[:3])
+        snapshot = snapshot.changed({changed_id: (rows[changed_id], set())})
+        pantry = set(ingredient_ids[:3])
+        for max_missing in range(3):
+            expected = sorted(
+                ((recipe_id, len(row - pantry))
+                 for recipe_id, row in rows.items()
+                 if len(row - pantry) <= max_missing),
+                key=lambda item: (item[1], -item[0]))
+            self.assertEqual(snapshot.matching(pantry, max_missing),
+                             expected)
+
+
+@override_settings(FEED_STRATEGY='write')
+class BulkRelationsTests(TestCase):
+    """
+    Массовое добавление и удаление связей: итог по каждому id,
+    счетчики, корзина и лента, число запросов не зависит от числа id.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='reader',
+                                            email='reader@ya.ru')
+        cls.author = User.objects.create_user(username='author',
+                                              email='author@ya.ru')
+        ingredients = [Ingredient.objects.create(name=f'Ингредиент {i}',
+                                                 measurement_unit='г')
+                       for i in range(3)]
+        cls.recipes = []
+        for i in range(4):
+            recipe = Recipe.objects.create(
+                name=f'Рецепт {i}', text='Описание', cooking_time=10,
+                image='recipes/images/test.jpg', author=cls.author)
+            for ingredient in ingredients[:i % 3 + 1]:
+                AmountIngredient.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=i + 1)
+            cls.recipes.append(recipe)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(BulkRelationsTests.user)
+
+    def send(self, method, url, ids):
+        response = getattr(self.client, method)(url, {'ids': ids},
+                                                format='json')
+        self.assertEqual(response.status_code, 200)
+        return [(result['id'], result['status'])
+                for result in response.data['results']]
+
+    def test_shopping_cart(self):
+        url = '/api/recipes/shopping_cart/'
+        first, second, third, _ = (recipe.id for recipe in self.recipes)
+        missing = third + 100
+        self.assertEqual(
+            self.send('post', url, [first, second, first, missing]),
+            [(first, 201), (second, 201), (missing, 404)])
+        self.assertEqual(self.send('post', url, [first, third]),
+                         [(first, 400), (third, 201)])
+        self.assertEqual(self.send('delete', url, [second, missing]),
+                         [(second, 204), (missing, 404)])
+        self.assertEqual(self.send('delete', url, [second]), [(second, 400)])
+        self.assertEqual(
+            set(ShoppingCart.objects.values_list('recipe_id', flat=True)),
+            {first, third})
+        self.assertEqual(ShoppingCartIngredient.objects.stored(),
+                         ShoppingCartIngredient.objects.calculate())
+        self.assertEqual(
+            list(Recipe.objects.order_by('id').values_list(
+                'in_carts_count', flat=True)), [1, 0, 1, 0])
+
+    def test_favorites_queries(self):
+        url = '/api/recipes/favorite/'
+        ids = [recipe.id for recipe in self.recipes]
+        with CaptureQueriesContext(connection) as one:
+            self.send('post', url, ids[:1])
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(self.send('post', url, ids[1:]),
+                             [(id, 201) for id in ids[1:]])
+        self.assertEqual(len(one), len(many))
+        self.assertEqual(self.send('post', url, ids[:1]), [(ids[0], 400)])
+        self.assertEqual(set(Recipe.objects.values_list(
+            'favorites_count', flat=True)), {1})
+        self.send('delete', url, ids)
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(set(Recipe.objects.values_list(
+            'favorites_count', flat=True)), {0})
+
+    def test_subscribe(self):
+        url = '/api/users/subscribe/'
+        user, author = BulkRelationsTests.user, BulkRelationsTests.author
+        self.assertEqual(self.send('post', url, [user.id, author.id]),
+                         [(user.id, 400), (author.id, 201)])
+        self.assertEqual(FeedEntry.objects.filter(user=user).count(), 4)
+        author.refresh_from_db()
+        self.assertEqual(author.subscribers_count, 1)
+        self.assertEqual(self.send('delete', url, [author.id]),
+                         [(author.id, 204)])
+        self.assertFalse(FeedEntry.objects.filter(user=user).exists())
+
+    def test_invalid(self):
+        for data in ({}, {'ids': []}, {'ids': ['x']}, {'ids': [0]}):
+            response = self.client.post('/api/recipes/favorite/', data,
+                                        format='json')
+            self.assertEqual(response.status_code, 400)
+        response = APIClient().post('/api/recipes/favorite/',
+                                    {'ids': [1]}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+
+class ConcurrentRelationsTests(TransactionTestCase):
+    """
+    Одновременные запросы на одну связь: создает и удаляет ее
+    ровно один запрос, остальные получают 400, счетчик сходится.
+    """
+    THREADS = 8
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader',
+                                             email='reader@ya.ru')
+        self.author = User.objects.create_user(username='author',
+                                               email='author@ya.ru')
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/images/test.jpg', author=self.author)
+
+    def race(self, method, url):
+        """Коды ответов на одновременные запросы из нескольких потоков."""
+        barrier = threading.Barrier(self.THREADS)
+        codes = []
+
+        def send():
+            client = APIClient()
+            client.force_authenticate(self.user)
+            try:
+                barrier.wait()
+                codes.append(getattr(client, method)(url).status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=send)
+                   for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(codes)
+
+    def test_favorite(self):
+        url = f'/api/recipes/{self.recipe.id}/favorite/'
+        self.assertEqual(self.race('post', url),
+                         [201] + [400] * (self.THREADS - 1))
+        self.recipe.refresh_from_db()
+        self.assertEqual(Favorite.objects.count(), 1)
+        self.assertEqual(self.recipe.favorites_count, 1)
+        self.assertEqual(self.race('delete', url),
+                         [204] + [400] * (self.THREADS - 1))
+        self.recipe.refresh_from_db()
+        self.assertEqual(Favorite.objects.count(), 0)
+        self.assertEqual(self.recipe.favorites_count, 0)
+
+    def test_shopping_cart(self):
+        url = f'/api/recipes/{self.recipe.id}/shopping_cart/'
+        self.assertEqual(self.race('post', url),
+                         [201] + [400] * (self.THREADS - 1))
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.in_carts_count, 1)
+        self.assertEqual(self.race('delete', url),
+                         [204] + [400] * (self.THREADS - 1))
+        self.assertFalse(ShoppingCart.objects.exists())
+
+    def test_subscribe(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        self.assertEqual(self.race('post', url),
+                         [201] + [400] * (self.THREADS - 1))
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.subscribers_count, 1)
+        self.assertEqual(self.race('delete', url),
+                         [204] + [400] * (self.THREADS - 1))
+        self.assertFalse(Subscribe.objects.exists())
+
+
+class AsyncViewsTests(TransactionTestCase):
+    """
+    Асинхронные обертки представлений для ASGI: тот же ответ,
+    выполнение в пуле потоков, потоковый ответ читается в пуле по частям.
+    Данные зафиксированы: потоки пула работают со своими соединениями.
+    """
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='reader',
+                                             email='reader@ya.ru')
+        self.tag = Tag.objects.create(name='Ужин', color='#FF8000',
+                                      slug='dinner')
+        ingredient = Ingredient.objects.create(name='Соль',
+                                               measurement_unit='г')
+        self.recipe = Recipe.objects.create(
+            name='Рецепт', text='Описание', cooking_time=10,
+            image='recipes/images/test.jpg', author=self.user)
+        self.recipe.tags.set([self.tag])
+        AmountIngredient.objects.create(recipe=self.recipe,
+                                        ingredient=ingredient, amount=5)
+        ShoppingCart.objects.create(user=self.user, recipe=self.recipe)
+        ShoppingCartIngredient.objects.rebuild()
+
+    def request(self, path):
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, self.user)
+        return request
+
+    @staticmethod
+    def content(response):
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        response.render()
+        return response.content
+
+    def test_same_responses(self):
+        for view, path, kwargs in (
+            (TagViewSet.as_view({'get': 'list'}), '/api/tags/', {}),
+            (RecipeViewSet.as_view({'get': 'retrieve'}),
+             f'/api/recipes/{self.recipe.id}/', {'pk': self.recipe.id}),
+            (RecipeViewSet.as_view(
+                {'get': 'download_shopping_cart'},
+                **RecipeViewSet.download_shopping_cart.kwargs),
+             '/api/recipes/download_shopping_cart/', {}),
+        ):
+            with self.subTest(path=path):
+                expected = view(self.request(path), **kwargs)
+                response = async_to_sync(async_view(view))(
+                    self.request(path), **kwargs)
+                self.assertEqual(response.status_code, 200)
+                content = self.content(response)
+                if response.streaming:
+                    self.assertIn('Соль', content.decode())
+                    self.assertEqual(content, self.content(expected))
+                else:
+                    self.assertEqual(json.loads(content),
+                                     json.loads(self.content(expected)))
+
+    def test_asgi_streaming(self):
+        token = Token.objects.create(user=self.user)
+        scope = {
+            'type': 'http', 'method': 'GET', 'query_string': b'',
+            'path': '/api/recipes/download_shopping_cart/',
+            'headers': [(b'host', b'testserver'),
+                        (b'authorization', f'Token {token.key}'.encode())],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        async def send(message):
+            messages.append(message)
+
+        async_to_sync(StreamingASGIHandler())(scope, receive, send)
+        self.assertEqual(messages[0]['status'], 200)
+        bodies = [message['body'] for message in messages[1:-1]]
+        # части отправляются по мере чтения, а не одним сообщением
+        self.assertGreater(len(bodies), 1)
+        self.assertIn('Соль', b''.join(bodies).decode())
+        self.assertEqual(messages[-1], {'type': 'http.response.body'})
+
+    def test_thread_pool(self):
+        threads = []
+
+        def view(request):
+            threads.append(threading.current_thread().name)
+            return TagViewSet.as_view({'get': 'list'})(request)
+
+        async def gather():
+            return await asyncio.gather(*(
+                async_view(view)(self.request('/api/tags/'))
+                for _ in range(4)))
+
+        responses = async_to_sync(gather)()
+        self.assertEqual([response.status_code for response in responses],
+                         [200] * 4)
+        self.assertTrue(all(name.startswith('async-view')
+                            for name in threads))
+
+    def test_writes_outside_pool(self):
+        threads = []
+
+        def view(request):
+            threads.append(threading.current_thread().name)
+            return RecipeViewSet.as_view({'post': 'create'})(request)
+
+        request = APIRequestFactory().post('/api/recipes/', {},
+                                           format='json')
+        force_authenticate(request, self.user)
+        response = async_to_sync(async_view(view))(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0].startswith('async-view'))
+
+    def test_urlpatterns(self):
+        patterns = {pattern.name: pattern
+                    for pattern in async_urlpatterns(router.urls)}
+        for name in ('tag-list', 'recipe-detail',
+                     'recipe-download-shopping-cart'):
+            self.assertTrue(asyncio.iscoroutinefunction(
+                patterns[name].callback))
+        self.assertIs(patterns['recipe-list'].callback.cls, RecipeViewSet)
+        self.assertFalse(asyncio.iscoroutinefunction(
+            patterns['recipe-feed'].callback))
@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import (CustomUserViewSet, FavoriteView, IngredientViewSet,
-                    RecipeViewSet, ShoppingCartView, SubscribeView,
-                    SubscriptionsView, TagViewSet)
+from .async_views import async_urlpatterns
+from .views import (BulkFavoriteView, BulkShoppingCartView,
+                    BulkSubscribeView, CustomUserViewSet, FavoriteView,
+                    IngredientViewSet, RecipeViewSet, ShoppingCartView,
+                    SubscribeView, SubscriptionsView, TagViewSet)
 
 router = DefaultRouter()
 router.register('tags', TagViewSet)
@@ -11,12 +14,19 @@ router.register('ingredients', IngredientViewSet, basename='ingredient')
 router.register('recipes', RecipeViewSet)
 router.register('users', CustomUserViewSet)
 
+router_urls = router.urls
+if settings.ASYNC_VIEWS:
+    router_urls = async_urlpatterns(router_urls)
+
 urlpatterns = [
+    path('recipes/favorite/', BulkFavoriteView.as_view()),
+    path('recipes/shopping_cart/', BulkShoppingCartView.as_view()),
+    path('users/subscribe/', BulkSubscribeView.as_view()),
     path('recipes/<int:recipe_id>/favorite/', FavoriteView.as_view()),
     path('recipes/<int:recipe_id>/shopping_cart/', ShoppingCartView.as_view()),
     path('users/subscriptions/', SubscriptionsView.as_view()),
     path('users/<int:user_id>/subscribe/', SubscribeView.as_view()),
-    path('', include(router.urls)),
+    path('', include(router_urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
 ]
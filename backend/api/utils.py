@@ -1,42 +1,212 @@
-from django.core.exceptions import ObjectDoesNotExist
-from django.shortcuts import get_object_or_404
+import sqlite3
+
+from django.db import IntegrityError, connection, transaction
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 
+from recipes.counters import change_relation_counter, change_relation_counters
+from recipes.signals import bulk_changed
+
+RELATION_EXISTS = 'Связь уже существует!'
+RELATION_MISSING = 'Отсутствует предварительная связь!'
+
 
+@transaction.atomic
 def create_relations(request, obj, related_model, name_serializer, field):
     """
     Универсальная функция для создания связей между моделями.
+    Связь создается одним запросом INSERT; повторный или параллельный
+    запрос на ту же связь получает ответ 400, а не ошибку уникальности.
+    Счетчик связей объекта obj меняется в той же транзакции.
     """
-    kwargs = record_kwargs(request, obj, field)
-    created_obj, created = related_model.objects.get_or_create(**kwargs)
-    if created:
+    if insert_relations(request.user, type(obj), related_model, field,
+                        [obj.pk]):
+        change_relation_counter(related_model, obj, 1)
+        relations_changed(related_model, request.user)
         serializer = name_serializer(obj, context={'request': request})
         return Response(serializer.data,
                         status=status.HTTP_201_CREATED)
-    return Response({"errors": "Связь уже существует!"},
+    return Response({"errors": RELATION_EXISTS},
                     status=status.HTTP_400_BAD_REQUEST)
 
 
+@transaction.atomic
 def delete_relations(request, id, model, related_model, field):
     """
     Универсальная функция для удаления связей между моделями.
+    Связь удаляется одним запросом DELETE; существование объекта
+    проверяется, только если удалять было нечего.
     """
-    obj = get_object_or_404(model, id=id)
-    kwargs = record_kwargs(request, obj, field)
-    try:
-        related_model.objects.get(**kwargs).delete()
+    if delete_relation_rows(request.user, related_model, field, [id]):
+        change_relation_counter(related_model, model(id=id), -1)
+        relations_changed(related_model, request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
-    except ObjectDoesNotExist:
-        return Response({"errors": "Отсутствует предварительная связь!"},
-                        status=status.HTTP_400_BAD_REQUEST)
+    if not model.objects.filter(id=id).exists():
+        raise NotFound
+    return Response({"errors": RELATION_MISSING},
+                    status=status.HTTP_400_BAD_REQUEST)
+
+
+def supports_returning():
+    """
+    INSERT ... ON CONFLICT DO NOTHING и RETURNING:
+    PostgreSQL и SQLite начиная с 3.35.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    return (connection.vendor == 'sqlite'
+            and sqlite3.sqlite_version_info >= (3, 35))
+
+
+def relation_columns(related_model, field):
+    """Таблица связей и ее столбцы пользователя и объекта в кавычках."""
+    quote = connection.ops.quote_name
+    meta = related_model._meta
+    return (quote(meta.db_table), quote(meta.get_field('user').column),
+            quote(meta.get_field(field).column))
+
+
+def insert_relations(user, model, related_model, field, ids):
+    """
+    Создание связей пользователя с объектами ids, существующими в базе.
+    Результат - id объектов, связи с которыми создал именно этот запрос:
+    уже существующие и созданные параллельно связи в него не попадают.
+    """
+    if not ids:
+        return set()
+    if not supports_returning():
+        return insert_relations_one_by_one(user, model, related_model,
+                                           field, ids)
+    table, user_column, column = relation_columns(related_model, field)
+    quote = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(ids))
+    # INSERT ... SELECT пропускает несуществующие объекты,
+    # WHERE обязателен для SQLite при ON CONFLICT после SELECT
+    sql = (f'INSERT INTO {table} ({user_column}, {column}) '
+           f'SELECT %s, {quote(model._meta.pk.column)} '
+           f'FROM {quote(model._meta.db_table)} '
+           f'WHERE {quote(model._meta.pk.column)} IN ({placeholders}) '
+           f'ON CONFLICT DO NOTHING RETURNING {column}')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user.id, *ids])
+        return {row[0] for row in cursor.fetchall()}
+
+
+def insert_relations_one_by_one(user, model, related_model, field, ids):
+    """Без ON CONFLICT: каждая связь в своей точке сохранения."""
+    created = set()
+    for id in model.objects.filter(id__in=ids).values_list('id', flat=True):
+        try:
+            with transaction.atomic():
+                related_model.objects.bulk_create(
+                    [related_model(user=user, **{f'{field}_id': id})])
+        except IntegrityError:
+            continue
+        created.add(id)
+    return created
+
+
+def delete_relation_rows(user, related_model, field, ids):
+    """
+    Удаление связей пользователя с объектами ids.
+    Результат - id объектов, связи с которыми удалил этот запрос.
+    """
+    if not ids:
+        return set()
+    table, user_column, column = relation_columns(related_model, field)
+    sql = f'DELETE FROM {table} WHERE {user_column} = %s AND {column} '
+    with connection.cursor() as cursor:
+        if len(ids) == 1:
+            cursor.execute(sql + '= %s', [user.id, ids[0]])
+            return set(ids) if cursor.rowcount else set()
+        if supports_returning():
+            placeholders = ', '.join(['%s'] * len(ids))
+            cursor.execute(
+                sql + f'IN ({placeholders}) RETURNING {column}',
+                [user.id, *ids])
+            return {row[0] for row in cursor.fetchall()}
+        deleted = set()
+        for id in ids:
+            cursor.execute(sql + '= %s', [user.id, id])
+            if cursor.rowcount:
+                deleted.add(id)
+        return deleted
+
+
+def relations_changed(related_model, user):
+    """
+    Связи меняются запросами SQL без сигналов post_save и post_delete,
+    получатели bulk_changed сбрасывают версии кэша пользователя.
+    """
+    bulk_changed.send(sender=related_model, user_ids=[user.id])
+
+
+def relation_result(id, status_code, **errors):
+    """Итог по одному id с кодом ответа, как у запроса на этот id."""
+    return {'id': id, 'status': status_code, **errors}
+
+
+def missing_result(id):
+    return relation_result(id, status.HTTP_404_NOT_FOUND,
+                           detail=str(NotFound.default_detail))
+
+
+@transaction.atomic
+def bulk_create_relations(user, ids, model, related_model, field,
+                          rejected=None):
+    """
+    Создание связей пользователя с объектами ids одним запросом.
+    rejected: {id: текст ошибки} для объектов, связь с которыми запрещена.
+    Результат: итоги по каждому id и список id созданных связей.
+    """
+    rejected = rejected or {}
+    ids = list(dict.fromkeys(ids))
+    created = insert_relations(user, model, related_model, field,
+                               [id for id in ids if id not in rejected])
+    rest = [id for id in ids if id not in created]
+    # отличить отсутствующие объекты от существующих связей
+    found = set(model.objects.filter(id__in=rest).values_list(
+        'id', flat=True)) if rest else set()
+    created = [id for id in ids if id in created]
+    if created:
+        change_relation_counters(related_model, model, created, 1)
+        relations_changed(related_model, user)
+    results = []
+    for id in ids:
+        if id in created:
+            results.append(relation_result(id, status.HTTP_201_CREATED))
+        elif id not in found:
+            results.append(missing_result(id))
+        else:
+            results.append(relation_result(
+                id, status.HTTP_400_BAD_REQUEST,
+                errors=rejected.get(id, RELATION_EXISTS)))
+    return results, created
 
 
-def record_kwargs(request, obj, field):
+@transaction.atomic
+def bulk_delete_relations(user, ids, model, related_model, field):
     """
-    Формирование словаря для передачи в менеджер модели.
+    Удаление связей пользователя с объектами ids одним запросом.
+    Результат: итоги по каждому id и список id удаленных связей.
     """
-    kwargs = {}
-    kwargs['user'] = request.user
-    kwargs[field] = obj
-    return kwargs
+    ids = list(dict.fromkeys(ids))
+    deleted = delete_relation_rows(user, related_model, field, ids)
+    rest = [id for id in ids if id not in deleted]
+    found = set(model.objects.filter(id__in=rest).values_list(
+        'id', flat=True)) if rest else set()
+    deleted = [id for id in ids if id in deleted]
+    if deleted:
+        change_relation_counters(related_model, model, deleted, -1)
+        relations_changed(related_model, user)
+    results = []
+    for id in ids:
+        if id in deleted:
+            results.append(relation_result(id, status.HTTP_204_NO_CONTENT))
+        elif id not in found:
+            results.append(missing_result(id))
+        else:
+            results.append(relation_result(
+                id, status.HTTP_400_BAD_REQUEST, errors=RELATION_MISSING))
+    return results, deleted
@@ -1,39 +1,66 @@
-from datetime import date
-
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField, Value
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
 from rest_framework import generics, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import (SAFE_METHODS, IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from recipes.models import (AmountIngredient, Favorite, Ingredient, Recipe,
-                            ShoppingCart, Subscribe, Tag)
+from recipes.models import (Favorite, FeedEntry, Ingredient, Recipe,
+                            ShoppingCart, ShoppingCartIngredient, Subscribe,
+                            Tag)
 from users.models import User
 
-from .filters import IngredientSearchFilter, RecipeFilter
+from . import shopping_list
+from .cache import (RECIPE_VERSIONS, ConditionalGetMixin,
+                    RecipeDetailCacheMixin, VersionedCacheMixin,
+                    get_version_values, relations_version_name)
+from .filters import (POPULAR_ORDERING, RecipeFilter, get_ingredient_ids,
+                      get_recipes_limit, get_tag_ids)
+from .ingredient_index import ingredient_index
+from .pagination import KeysetOnlyPagination, KeysetPagination
+from .pantry import pantry_index
+from .parsers import StreamingJSONParser
 from .permissions import IsAuthorOrReadOnly
 from .serializers import (IngredientSerializer, RecipeCreateUpdateSerializer,
-                          RecipeSerializer, ShortRecipeSerializer,
-                          SubscribeSerializer, TagSerializer)
-from .utils import create_relations, delete_relations
+                          RecipeSerializer, RelationIdsSerializer,
+                          ShortRecipeSerializer, SubscribeSerializer,
+                          TagSerializer)
+from .similarity import METRICS, recipe_matrix
+from .utils import (bulk_create_relations, bulk_delete_relations,
+                    create_relations, delete_relations)
+
+CURSOR_WITH_SEARCH = ('Пагинация по курсору с поиском (search) доступна '
+                      'только при ?ordering=popular.')
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, RecipeDetailCacheMixin,
+                    viewsets.ModelViewSet):
     """
     Представление для рецептов.
     Фильтрация по автору, тегам, нахождению в избранном и списке покупок.
-    Через download_shopping_cart можно скачать txt список покупок.
+    Через download_shopping_cart можно скачать список покупок
+    в формате txt, csv или pdf.
     """
     queryset = Recipe.objects.all()
     permission_classes = [IsAuthorOrReadOnly, IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = RecipeFilter
+    keyset_ordering = ('-pub_date', '-id')
+    lookup_value_regex = r'\d+'
+    parser_classes = (StreamingJSONParser, FormParser, MultiPartParser)
+
+    def get_queryset(self):
+        return Recipe.objects.with_related().with_user_flags(
+            self.request.user)
 
     def get_serializer_class(self):
         if self.request.method in SAFE_METHODS:
@@ -43,48 +70,182 @@ class RecipeViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    def get_conditional_state(self, request, *args, **kwargs):
+        """
+        Список зависит от версий рецептов и связанных моделей,
+        отдельный рецепт - от его updated_at. Флаги пользователя
+        учитываются через версию его избранного, корзины и подписок.
+        """
+        names = list(RECIPE_VERSIONS)
+        if self.action == 'retrieve':
+            names.remove('recipe')
+        elif request.query_params.get('ordering') == 'popular':
+            names.append('popularity')
+        if request.user.is_authenticated:
+            names.append(relations_version_name(request.user.id))
+        versions = get_version_values(*names)
+        parts = [request.get_full_path(), request.user.id, *versions]
+        if self.action == 'retrieve':
+            updated_at = Recipe.objects.filter(pk=kwargs['pk']).values_list(
+                'updated_at', flat=True).first()
+            if updated_at is None:
+                return None
+            updated_at = int(updated_at.timestamp() * 1000)
+            parts.append(updated_at)
+            versions.append(updated_at)
+        return parts, max(versions)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response,
+                                             *args, **kwargs)
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def paginate_queryset(self, queryset):
+        params = self.request.query_params
+        if params.get('ordering') == 'popular':
+            self.keyset_ordering = POPULAR_ORDERING
+        elif (params.get('search', '').strip()
+              and KeysetPagination.cursor_query_param in params):
+            # ключ по релевантности (вычисляемое дробное число) ненадежен,
+            # а сортировка по дате потеряла бы порядок поиска
+            raise ValidationError({'cursor': CURSOR_WITH_SEARCH})
+        return super().paginate_queryset(queryset)
+
+    @action(detail=False, methods=['get'],
+            permission_classes=[IsAuthenticated],
+            pagination_class=KeysetOnlyPagination)
+    def feed(self, request):
+        """
+        Рецепты авторов из подписок пользователя, от новых к старым.
+        При FEED_STRATEGY=write лента читается из таблицы FeedEntry.
+        """
+        recipes = self.get_queryset()
+        if FeedEntry.objects.enabled():
+            recipes = recipes.timeline(request.user)
+            self.keyset_ordering = ('-feed_pub_date', '-id')
+        else:
+            recipes = recipes.feed(request.user)
+        page = self.paginate_queryset(recipes)
+        serializer = RecipeSerializer(page, many=True,
+                                      context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    def similarity_params(self):
+        """Параметры limit (не больше 100) и metric (jaccard или cosine)."""
+        limit = self.request.query_params.get('limit', '')
+        metric = self.request.query_params.get('metric', METRICS[0])
+        if metric not in METRICS:
+            raise ValidationError(
+                {'metric': f'Допустимые значения: {", ".join(METRICS)}.'})
+        limit = (min(int(limit), 100) if limit.isdigit()
+                 else settings.SIMILAR_RECIPES_LIMIT)
+        return limit, metric
+
+    def ranked_response(self, ranked):
+        """Рецепты в порядке убывания сходства."""
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _ in ranked])
+        serializer = RecipeSerializer(
+            [recipes[recipe_id] for recipe_id, _ in ranked
+             if recipe_id in recipes],
+            many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk):
+        """Рецепты с наиболее похожим составом ингредиентов."""
+        recipe = get_object_or_404(Recipe, pk=pk)
+        return self.ranked_response(
+            recipe_matrix.similar(recipe.id, *self.similarity_params()))
+
+    @action(detail=False, methods=['get'])
+    def by_ingredients(self, request):
+        """
+        Что приготовить из продуктов: рецепты, состав которых
+        ближе всего к набору ?ingredients=1,2,3.
+        """
+        return self.ranked_response(recipe_matrix.by_ingredients(
+            get_ingredient_ids(request), *self.similarity_params()))
+
+    @action(detail=False, methods=['get'])
+    def pantry(self, request):
+        """
+        Рецепты из продуктов ?ingredients=1,2,3: целиком или с не более
+        чем ?missing=K недостающими ингредиентами, с фильтром ?tags=
+        как в списке рецептов. Сначала рецепты с меньшим числом
+        недостающих ингредиентов (поле missing_ingredients).
+        """
+        missing = request.query_params.get('missing', '0')
+        if not missing.isdigit():
+            raise ValidationError(
+                {'missing': 'Ожидается неотрицательное число.'})
+        filterset = self.filterset_class(
+            {'tags': request.query_params.getlist('tags')},
+            queryset=Recipe.objects.none(), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.errors)
+        slugs = filterset.form.cleaned_data['tags']
+        tag_ids = get_tag_ids(slugs)
+        ranked = pantry_index.matching(
+            get_ingredient_ids(request), int(missing),
+            [tag_ids[slug] for slug in slugs])
+        page = self.paginator.paginate_queryset(ranked, request)
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _ in page])
+        page = [(recipes[recipe_id], count) for recipe_id, count in page
+                if recipe_id in recipes]
+        data = RecipeSerializer([recipe for recipe, _ in page], many=True,
+                                context=self.get_serializer_context()).data
+        for item, (_, count) in zip(data, page):
+            item['missing_ingredients'] = count
+        return self.paginator.get_paginated_response(data)
+
     @action(detail=False, methods=['get'],
-            permission_classes=[IsAuthenticated])
+            permission_classes=[IsAuthenticated],
+            renderer_classes=shopping_list.get_renderers())
     def download_shopping_cart(self, request):
-        """Вывод файла с консолидированным количеством ингредиентов."""
-        user = request.user
-        if not user.shopping.exists():
-            return Response('В корзине нет товаров!')
-        shopping_list = 'Foodgram\nСписок покупок:\n\n'
-        ingredients = AmountIngredient.objects.filter(
-            recipe__shopping__user=user).values(
-            'ingredient__name', 'ingredient__measurement_unit').annotate(
-            Sum('amount')).order_by('ingredient__name')
-        for item in ingredients:
-            shopping_list += (f"{item['ingredient__name']} - "
-                              f"{item['amount__sum']} "
-                              f"{item['ingredient__measurement_unit']}\n")
-        shopping_list += f'\nДата формирования: {date.today()}'
-        response = HttpResponse(shopping_list, content_type='text/plain')
-        filename = 'shopping_cart.txt'
-        response['Content-Disposition'] = f'attachment; filename={filename}'
-        return response
+        """
+        Вывод файла с консолидированным количеством ингредиентов.
+        Формат выбирается параметром ?format=txt|csv|pdf.
+        """
+        return shopping_list.shopping_list_response(
+            shopping_list.get_ingredients(request.user),
+            request.accepted_renderer)
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, VersionedCacheMixin,
+                        viewsets.ReadOnlyModelViewSet):
     """
     Представление для ингредиентов.
-    Поиск по первому вхождению в поле name.
+    Поиск по началу названия (?name=) через индекс в памяти:
+    без учета регистра, точные совпадения первыми.
     """
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
-    filter_backends = [IngredientSearchFilter]
-    search_fields = ('^name',)
+    cache_versions = ('ingredient',)
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('name'):
+            return self.conditional_response(self.search, request,
+                                             *args, **kwargs)
+        return super().list(request, *args, **kwargs)
 
+    def search(self, request, *args, **kwargs):
+        return Response(ingredient_index.search(
+            request.query_params['name']))
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+
+class TagViewSet(ConditionalGetMixin, VersionedCacheMixin,
+                 viewsets.ReadOnlyModelViewSet):
     """
     Представление для тегов.
     """
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
+    cache_versions = ('tag',)
 
 
 class SubscribeView(APIView):
@@ -93,14 +254,25 @@ class SubscribeView(APIView):
     """
     def post(self, request, user_id):
         author = get_object_or_404(User, id=user_id)
-        if author != request.user:
-            return create_relations(request, author, Subscribe,
-                                    SubscribeSerializer, 'author')
-        return Response({"errors": "Самому на себя подписаться нельзя!"},
-                        status=status.HTTP_400_BAD_REQUEST)
+        if author == request.user:
+            return Response({"errors": "Самому на себя подписаться нельзя!"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # транзакция начинается с записи: в SQLite чтение перед ней
+        # не дало бы дождаться параллельных транзакций
+        with transaction.atomic():
+            response = create_relations(request, author, Subscribe,
+                                        SubscribeSerializer, 'author')
+            if response.status_code == status.HTTP_201_CREATED:
+                FeedEntry.objects.subscribe(request.user, author)
+        return response
 
+    @transaction.atomic
     def delete(self, request, user_id):
-        return delete_relations(request, user_id, User, Subscribe, 'author')
+        response = delete_relations(request, user_id,
+                                    User, Subscribe, 'author')
+        if response.status_code == status.HTTP_204_NO_CONTENT:
+            FeedEntry.objects.unsubscribe(request.user, User(id=user_id))
+        return response
 
 
 class FavoriteView(APIView):
@@ -123,12 +295,104 @@ class ShoppingCartView(APIView):
     """
     def post(self, request, recipe_id):
         recipe = get_object_or_404(Recipe, id=recipe_id)
-        return create_relations(request, recipe, ShoppingCart,
-                                ShortRecipeSerializer, 'recipe')
+        with transaction.atomic():
+            response = create_relations(request, recipe, ShoppingCart,
+                                        ShortRecipeSerializer, 'recipe')
+            if response.status_code == status.HTTP_201_CREATED:
+                ShoppingCartIngredient.objects.add_recipe(request.user,
+                                                          recipe)
+        return response
 
+    @transaction.atomic
     def delete(self, request, recipe_id):
-        return delete_relations(request, recipe_id,
-                                Recipe, ShoppingCart, 'recipe')
+        response = delete_relations(request, recipe_id,
+                                    Recipe, ShoppingCart, 'recipe')
+        if response.status_code == status.HTTP_204_NO_CONTENT:
+            ShoppingCartIngredient.objects.remove_recipe(
+                request.user, Recipe(id=recipe_id))
+        return response
+
+
+class BulkRelationView(APIView):
+    """
+    Добавление и удаление связей сразу для списка id
+    (тело запроса {"ids": [...]}). В ответе итог по каждому id
+    с кодом и ошибкой, которые вернул бы запрос на этот id.
+    """
+    model = Recipe
+    related_model = None
+    field = 'recipe'
+
+    def get_ids(self):
+        serializer = RelationIdsSerializer(data=self.request.data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['ids']
+
+    def get_rejected(self):
+        """{id: текст ошибки} для объектов, связь с которыми запрещена."""
+        return {}
+
+    def created(self, ids):
+        pass
+
+    def deleted(self, ids):
+        pass
+
+    @transaction.atomic
+    def post(self, request):
+        results, created = bulk_create_relations(
+            request.user, self.get_ids(), self.model, self.related_model,
+            self.field, self.get_rejected())
+        if created:
+            self.created(created)
+        return Response({'results': results})
+
+    @transaction.atomic
+    def delete(self, request):
+        results, deleted = bulk_delete_relations(
+            request.user, self.get_ids(), self.model, self.related_model,
+            self.field)
+        if deleted:
+            self.deleted(deleted)
+        return Response({'results': results})
+
+
+class BulkSubscribeView(BulkRelationView):
+    """
+    Подписка на нескольких авторов.
+    """
+    model = User
+    related_model = Subscribe
+    field = 'author'
+
+    def get_rejected(self):
+        return {self.request.user.id: 'Самому на себя подписаться нельзя!'}
+
+    def created(self, ids):
+        FeedEntry.objects.subscribe_many(self.request.user, ids)
+
+    def deleted(self, ids):
+        FeedEntry.objects.unsubscribe_many(self.request.user, ids)
+
+
+class BulkFavoriteView(BulkRelationView):
+    """
+    Добавление нескольких рецептов в избранное.
+    """
+    related_model = Favorite
+
+
+class BulkShoppingCartView(BulkRelationView):
+    """
+    Добавление нескольких рецептов в список покупок.
+    """
+    related_model = ShoppingCart
+
+    def created(self, ids):
+        ShoppingCartIngredient.objects.add_recipes(self.request.user, ids)
+
+    def deleted(self, ids):
+        ShoppingCartIngredient.objects.remove_recipes(self.request.user, ids)
 
 
 class SubscriptionsView(generics.ListAPIView):
@@ -137,9 +401,30 @@ class SubscriptionsView(generics.ListAPIView):
     """
     serializer_class = SubscribeSerializer
     permission_classes = [IsAuthenticated]
+    keyset_ordering = ('id',)
 
     def get_queryset(self):
-        return User.objects.filter(subscribers__user=self.request.user)
+        return User.objects.filter(
+            subscribers__user=self.request.user
+        ).annotate(
+            is_subscribed=Value(True, BooleanField())
+        ).order_by('id')
+
+    def paginate_queryset(self, queryset):
+        """
+        Рецепты авторов страницы загружаются одним запросом
+        с учетом recipes_limit.
+        """
+        page = super().paginate_queryset(queryset)
+        if page is None:
+            return page
+        recipes = {author.id: [] for author in page}
+        for recipe in Recipe.objects.latest_by_authors(
+                list(recipes), get_recipes_limit(self.request)):
+            recipes[recipe.author_id].append(recipe)
+        for author in page:
+            author.latest_recipes = recipes[author.id]
+        return page
 
 
 class CustomUserViewSet(UserViewSet):
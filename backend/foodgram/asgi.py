@@ -0,0 +1,23 @@
+"""
+ASGI config for foodgram project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
+# под ASGI представления чтения по умолчанию асинхронные (api.async_views)
+os.environ.setdefault('ASYNC_VIEWS', 'True')
+
+django.setup(set_prefix=False)
+
+# потоковые ответы читаются в пуле потоков, а не в цикле событий
+from api.async_views import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
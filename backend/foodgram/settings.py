@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -48,7 +49,7 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.CustomPageNumberPagination',
     'PAGE_SIZE': 6,
@@ -70,6 +71,7 @@ DJOSER = {
 }
 
 MIDDLEWARE = [
+    'api.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -109,6 +111,42 @@ DATABASES = {
         'PORT': os.getenv('DB_PORT')
     }
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # тестовая база SQLite в файле: в памяти параллельные транзакции
+    # не ждут блокировок друг друга (ConcurrentRelationsTests)
+    DATABASES['default']['TEST'] = {
+        'NAME': os.getenv('DB_TEST_NAME',
+                          os.path.join(tempfile.gettempdir(),
+                                       'test_foodgram.sqlite3')),
+    }
+    DATABASES['default']['OPTIONS'] = {'timeout': 20}
+
+# Бэкенд кэша: locmem (по умолчанию), file, redis (нужен django-redis)
+# или полный путь к классу бэкенда.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django_redis.cache.RedisCache',
+}
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+        'TIMEOUT': int(os.getenv('CACHE_TIMEOUT', 300)),
+    }
+}
+if CACHE_BACKEND in ('locmem', 'file'):
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 10000)),
+    }
+# locmem виден только своему процессу: версии моделей в нем не видят
+# изменений из других воркеров и команд, поэтому хранятся ограниченное время
+CACHE_SHARED = (CACHES['default']['BACKEND']
+                != CACHE_BACKENDS['locmem'])
+CACHE_VERSION_TIMEOUT = (None if CACHE_SHARED else
+                         int(os.getenv('CACHE_VERSION_TIMEOUT', 30)))
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -144,3 +182,81 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'users.User'
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
+# Поиск ингредиентов по индексу в памяти процесса
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 50))
+INGREDIENT_INDEX_TTL = int(os.getenv('INGREDIENT_INDEX_TTL', 300))
+
+# Лента подписок: read - запрос по подпискам, write - таблица FeedEntry,
+# заполняемая при публикации (после переключения: rebuild_feeds)
+FEED_STRATEGY = os.getenv('FEED_STRATEGY', 'read')
+FEED_BATCH_SIZE = int(os.getenv('FEED_BATCH_SIZE', 1000))
+
+# Уменьшенные копии изображений рецептов: вариант -> наибольшая сторона
+IMAGE_VARIANTS = {'thumbnail': 160, 'card': 480, 'full': 1280}
+IMAGE_VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', 82))
+IMAGE_PIPELINE_ASYNC = os.getenv('IMAGE_PIPELINE_ASYNC', 'True') == 'True'
+
+# Загрузка изображения в JSON: декодированный файл держится в памяти
+# до IMAGE_UPLOAD_MEMORY_LIMIT байт, дальше пишется во временный файл
+IMAGE_UPLOAD_MEMORY_LIMIT = int(os.getenv('IMAGE_UPLOAD_MEMORY_LIMIT',
+                                          1024 * 1024))
+IMAGE_UPLOAD_MAX_SIZE = int(os.getenv('IMAGE_UPLOAD_MAX_SIZE',
+                                      10 * 1024 * 1024))
+
+# Кэш аутентификации по токену: LRU в процессе и общий кэш (секунды).
+# Без общего бэкенда кэша работает только LRU: отзыв токена в других
+# процессах действует через TOKEN_CACHE_LOCAL_TTL секунд. С общим кэшем -
+# через TOKEN_CACHE_REVOCATION_INTERVAL секунд: так часто процесс читает
+# счетчик отзывов токенов
+TOKEN_CACHE = os.getenv('TOKEN_CACHE', 'True') == 'True'
+TOKEN_CACHE_LOCAL_TTL = int(os.getenv('TOKEN_CACHE_LOCAL_TTL', 5))
+TOKEN_CACHE_LOCAL_SIZE = int(os.getenv('TOKEN_CACHE_LOCAL_SIZE', 1024))
+TOKEN_CACHE_SHARED = (CACHE_SHARED
+                      and os.getenv('TOKEN_CACHE_SHARED', 'True') == 'True')
+TOKEN_CACHE_REVOCATION_INTERVAL = float(
+    os.getenv('TOKEN_CACHE_REVOCATION_INTERVAL', 1))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 60))
+
+# Похожие рецепты: матрица рецепт-ингредиент в памяти процесса
+SIMILAR_RECIPES_LIMIT = int(os.getenv('SIMILAR_RECIPES_LIMIT', 10))
+SIMILARITY_INDEX_TTL = int(os.getenv('SIMILARITY_INDEX_TTL', 300))
+# после стольких измененных рецептов матрица уплотняется
+SIMILARITY_DELTA_LIMIT = int(os.getenv('SIMILARITY_DELTA_LIMIT', 1000))
+
+# Подбор рецептов по продуктам: битовые множества составов в памяти
+PANTRY_INDEX_TTL = int(os.getenv('PANTRY_INDEX_TTL', 300))
+PANTRY_DELTA_LIMIT = int(os.getenv('PANTRY_DELTA_LIMIT', 1000))
+
+# Массовое добавление и удаление связей: наибольшее число id в запросе
+BULK_RELATIONS_LIMIT = int(os.getenv('BULK_RELATIONS_LIMIT', 500))
+
+# Запуск под ASGI (foodgram/asgi.py): представления чтения выполняются
+# асинхронно в пуле из ASYNC_VIEW_THREADS потоков на процесс
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+ASYNC_VIEW_THREADS = int(os.getenv('ASYNC_VIEW_THREADS', 10))
+
+# Замеры запросов: заголовок Server-Timing и строка JSON в логе api.metrics;
+# запрос SQL, повторенный REQUEST_METRICS_DUPLICATES раз, считается N+1
+REQUEST_METRICS = os.getenv('REQUEST_METRICS', 'False') == 'True'
+REQUEST_METRICS_DUPLICATES = int(os.getenv('REQUEST_METRICS_DUPLICATES', 5))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,11 @@
+"""
+Запуск в режиме ASGI: gunicorn -c gunicorn_asgi.py
+Воркеры uvicorn; параметры задаются переменными окружения.
+"""
+import os
+
+wsgi_app = 'foodgram.asgi:application'
+worker_class = 'uvicorn.workers.UvicornWorker'
+bind = os.getenv('GUNICORN_BIND', '0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
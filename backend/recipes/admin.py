@@ -1,7 +1,8 @@
 from django.contrib import admin
 
-from .models import (AmountIngredient, Favorite, Ingredient, Recipe,
-                     ShoppingCart, Subscribe, Tag)
+from .models import (AmountIngredient, Favorite, FeedEntry, Ingredient,
+                     MediaFile, Recipe, ShoppingCart, ShoppingCartIngredient,
+                     Subscribe, Tag)
 
 
 class IngredientAdmin(admin.ModelAdmin):
@@ -29,11 +30,13 @@ class TagsInLine(admin.TabularInline):
 class RecipeAdmin(admin.ModelAdmin):
 
     def added_to_favorites_amount(self, obj):
-        return Favorite.objects.filter(recipe=obj).count()
+        return obj.favorites_count
 
     added_to_favorites_amount.short_description = 'Добавлений в избранное'
+    added_to_favorites_amount.admin_order_field = 'favorites_count'
 
     list_display = ('id', 'name', 'author', 'added_to_favorites_amount')
+    list_select_related = ('author',)
     list_filter = ('name', 'author', 'tags')
     inlines = (AmountIngredientInline, TagsInLine,)
     exclude = ('tags',)
@@ -50,9 +53,27 @@ class ShoppingCartAdmin(admin.ModelAdmin):
     search_fields = ('user', 'recipe')
 
 
+class ShoppingCartIngredientAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'ingredient', 'amount')
+    search_fields = ('user__username', 'ingredient__name')
+
+
+class FeedEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'recipe', 'pub_date')
+    search_fields = ('user__username', 'recipe__name')
+
+
+class MediaFileAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'ref_count', 'updated_at')
+    search_fields = ('name',)
+
+
 admin.site.register(Tag, TagAdmin)
 admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(Favorite, FavoriteAdmin)
 admin.site.register(ShoppingCart, ShoppingCartAdmin)
 admin.site.register(Subscribe, SubscribeAdmin)
+admin.site.register(ShoppingCartIngredient, ShoppingCartIngredientAdmin)
+admin.site.register(FeedEntry, FeedEntryAdmin)
+admin.site.register(MediaFile, MediaFileAdmin)
@@ -0,0 +1,90 @@
+"""
+Хранимые счетчики рецептов и пользователей.
+Изменяются атомарно через F() при создании и удалении связей
+(получатели сигналов recipes.signals, а для запросов API без сигналов -
+сами представления), сверяются с исходными данными командой recount.
+"""
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from users.models import User
+
+from .models import Favorite, Recipe, ShoppingCart, Subscribe
+
+# модель со счетчиком, поле счетчика, связь и ее поле-ссылка на модель
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscribers_count', Subscribe, 'author'),
+)
+# счетчик объекта, который меняется при создании и удалении связи
+RELATION_COUNTERS = {
+    Favorite: 'favorites_count',
+    ShoppingCart: 'in_carts_count',
+    Subscribe: 'subscribers_count',
+}
+
+
+def shifted(field, delta):
+    """
+    Новое значение счетчика без чтения текущего.
+    Счетчик не уходит ниже нуля, если разошелся с данными
+    (например, после изменений через админку).
+    """
+    return Greatest(F(field) + delta, 0)
+
+
+def increment(instance, field, delta=1):
+    """Изменение счетчика в базе данных без чтения текущего значения."""
+    type(instance).objects.filter(pk=instance.pk).update(
+        **{field: shifted(field, delta)})
+
+
+def change_counters(instance, delta):
+    """
+    Изменение счетчиков объектов, на которые ссылается instance:
+    автора рецепта, рецепта в избранном и корзине, автора подписки.
+    """
+    for model, field, related_model, link in COUNTERS:
+        if type(instance) is related_model:
+            increment(model(pk=getattr(instance, f'{link}_id')), field,
+                      delta)
+
+
+def change_relation_counter(related_model, instance, delta):
+    field = RELATION_COUNTERS.get(related_model)
+    if field is not None:
+        increment(instance, field, delta)
+
+
+def change_relation_counters(related_model, model, ids, delta):
+    """Изменение счетчика связей сразу у объектов ids одним запросом."""
+    field = RELATION_COUNTERS.get(related_model)
+    if field is not None and ids:
+        model.objects.filter(pk__in=ids).update(
+            **{field: shifted(field, delta)})
+
+
+def actual_count(related_model, link):
+    """Подзапрос с фактическим количеством связей объекта."""
+    return Coalesce(Subquery(
+        related_model.objects.filter(**{link: OuterRef('pk')}).order_by()
+        .values(link).annotate(total=Count('pk')).values('total')
+    ), 0)
+
+
+def mismatches():
+    """Количество объектов с неверным значением каждого счетчика."""
+    return {
+        f'{model._meta.model_name}.{field}': model.objects.annotate(
+            actual=actual_count(related_model, link)
+        ).exclude(**{field: F('actual')}).count()
+        for model, field, related_model, link in COUNTERS
+    }
+
+
+def recount():
+    """Пересчет всех счетчиков по исходным данным."""
+    for model, field, related_model, link in COUNTERS:
+        model.objects.update(**{field: actual_count(related_model, link)})
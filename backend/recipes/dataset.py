@@ -0,0 +1,208 @@
+"""
+Синтетические данные для нагрузочных замеров: пользователи,
+рецепты с 5-30 ингредиентами, теги, избранное, корзины и подписки.
+Записи вставляются пачками через bulk_create, производные данные
+(счетчики, корзины, ленты) пересчитываются в конце.
+"""
+import random
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F, Max
+from PIL import Image
+
+from users.models import User
+
+from .counters import recount
+from .importers import batches
+from .models import (AmountIngredient, Favorite, FeedEntry, Ingredient,
+                     MediaFile, Recipe, ShoppingCart, ShoppingCartIngredient,
+                     Subscribe, Tag)
+from .signals import bulk_changed
+
+INGREDIENTS_PER_RECIPE = (5, 30)
+TAGS_PER_RECIPE = (1, 3)
+DISHES = ('Суп', 'Салат', 'Пирог', 'Рагу', 'Омлет', 'Паста', 'Каша',
+          'Запеканка', 'Котлеты', 'Плов', 'Блины', 'Борщ')
+MAIN = ('с курицей', 'с грибами', 'с сыром', 'с овощами', 'с рыбой',
+        'с говядиной', 'с тыквой', 'с яблоками', 'с фасолью', 'с рисом')
+WORDS = ('нарежьте', 'обжарьте', 'добавьте', 'посолите', 'перемешайте',
+         'доведите', 'до', 'кипения', 'готовьте', 'минут', 'на', 'среднем',
+         'огне', 'подавайте', 'горячим', 'с', 'зеленью', 'и', 'сметаной')
+
+
+def skewed_sample(rng, population, count):
+    """
+    До count разных элементов population.
+    Первые элементы выбираются чаще: у популярных авторов и рецептов
+    больше подписчиков и добавлений в избранное.
+    """
+    count = min(count, len(population))
+    if count * 2 > len(population):
+        return rng.sample(population, count)
+    chosen = set()
+    while len(chosen) < count:
+        chosen.add(population[int(len(population) * rng.random() ** 2)])
+    return list(chosen)
+
+
+def last_id(model):
+    return model.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def make_image():
+    """Одно изображение-заглушка для всех рецептов."""
+    buffer = BytesIO()
+    Image.new('RGB', (640, 480), (230, 160, 90)).save(buffer, 'JPEG')
+    storage = Recipe._meta.get_field('image').storage
+    return storage.save('recipes/images/synthetic.jpg',
+                        ContentFile(buffer.getvalue()))
+
+
+class DatasetGenerator:
+    """
+    Генератор набора данных заданного размера.
+    Новые пользователи получают имена prefix-N и общий пароль,
+    связи (избранное, корзины, подписки) создаются между ними.
+    """
+
+    def __init__(self, users=100, recipes=10, tags=6, ingredients=100,
+                 favorites=20, carts=3, subscriptions=10, prefix='synthetic',
+                 password='synthetic-password', image=None, seed=None,
+                 batch_size=5000):
+        self.sizes = {'users': users, 'recipes': recipes, 'tags': tags,
+                      'ingredients': ingredients, 'favorites': favorites,
+                      'carts': carts, 'subscriptions': subscriptions}
+        self.prefix = prefix
+        self.password = password
+        self.image = image
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.created = {}
+
+    def insert(self, model, objects, label=None):
+        before = model.objects.count()
+        for batch in batches(objects, self.batch_size):
+            model.objects.bulk_create(batch, ignore_conflicts=True)
+        label = label or str(model._meta.verbose_name_plural)
+        self.created[label] = model.objects.count() - before
+
+    @transaction.atomic
+    def generate(self):
+        """Создание данных; возвращает количество записей по моделям."""
+        self.created = {}
+        tag_ids = self.ensure_tags()
+        ingredient_ids = self.ensure_ingredients()
+        user_ids = self.make_users()
+        recipe_ids = self.make_recipes(user_ids)
+        self.insert(Recipe.tags.through, (
+            Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+            for recipe_id in recipe_ids
+            for tag_id in self.rng.sample(
+                tag_ids, min(len(tag_ids),
+                             self.rng.randint(*TAGS_PER_RECIPE)))
+        ), 'Теги рецептов')
+        self.insert(AmountIngredient, (
+            AmountIngredient(recipe_id=recipe_id, ingredient_id=ingredient_id,
+                             amount=self.rng.randint(1, 500))
+            for recipe_id in recipe_ids
+            for ingredient_id in self.rng.sample(
+                ingredient_ids, min(len(ingredient_ids),
+                                    self.rng.randint(
+                                        *INGREDIENTS_PER_RECIPE)))
+        ))
+        self.make_relations(user_ids, recipe_ids)
+        self.update_derived(user_ids)
+        return self.created
+
+    def ensure_tags(self):
+        """Существующие теги, при нехватке добавляются синтетические."""
+        existing = Tag.objects.count()
+        self.insert(Tag, (
+            Tag(name=f'{self.prefix} {index}', color='#808080',
+                slug=f'{self.prefix}-{index}')
+            for index in range(existing, self.sizes['tags'])
+        ))
+        return list(Tag.objects.values_list('id', flat=True))
+
+    def ensure_ingredients(self):
+        existing = Ingredient.objects.count()
+        # в рецепте до INGREDIENTS_PER_RECIPE[1] разных ингредиентов
+        total = max(self.sizes['ingredients'], INGREDIENTS_PER_RECIPE[1])
+        self.insert(Ingredient, (
+            Ingredient(name=f'{self.prefix} {index}', measurement_unit='г')
+            for index in range(existing, total)
+        ))
+        return list(Ingredient.objects.values_list('id', flat=True))
+
+    def make_users(self):
+        start = last_id(User)
+        password = make_password(self.password)
+        first = User.objects.filter(
+            username__startswith=f'{self.prefix}-').count()
+        self.insert(User, (
+            User(username=f'{self.prefix}-{index}',
+                 email=f'{self.prefix}-{index}@example.com',
+                 first_name='Пользователь', last_name=str(index),
+                 password=password)
+            for index in range(first, first + self.sizes['users'])
+        ))
+        return list(User.objects.filter(id__gt=start).values_list(
+            'id', flat=True))
+
+    def make_recipes(self, user_ids):
+        """
+        В среднем recipes рецептов на пользователя;
+        у первых пользователей рецептов больше.
+        """
+        start = last_id(Recipe)
+        image = self.image or make_image()
+        total = self.sizes['recipes'] * len(user_ids)
+        self.insert(Recipe, (
+            Recipe(
+                name=(f'{self.rng.choice(DISHES)} {self.rng.choice(MAIN)}'
+                      f' №{index}'),
+                text=' '.join(self.rng.choices(WORDS, k=30)).capitalize(),
+                cooking_time=self.rng.randint(5, 180),
+                image=image,
+                author_id=skewed_sample(self.rng, user_ids, 1)[0]
+            )
+            for index in range(total)
+        ))
+        media_file, created = MediaFile.objects.get_or_create(name=image)
+        MediaFile.objects.filter(pk=media_file.pk).update(
+            ref_count=F('ref_count') + total)
+        return list(Recipe.objects.filter(id__gt=start).values_list(
+            'id', flat=True))
+
+    def make_relations(self, user_ids, recipe_ids):
+        self.insert(Favorite, (
+            Favorite(user_id=user_id, recipe_id=recipe_id)
+            for user_id in user_ids
+            for recipe_id in skewed_sample(self.rng, recipe_ids,
+                                           self.sizes['favorites'])
+        ))
+        self.insert(ShoppingCart, (
+            ShoppingCart(user_id=user_id, recipe_id=recipe_id)
+            for user_id in user_ids
+            for recipe_id in self.rng.sample(
+                recipe_ids, min(len(recipe_ids), self.sizes['carts']))
+        ))
+        self.insert(Subscribe, (
+            Subscribe(user_id=user_id, author_id=author_id)
+            for user_id in user_ids
+            for author_id in skewed_sample(self.rng, user_ids,
+                                           self.sizes['subscriptions'])
+            if author_id != user_id
+        ))
+
+    def update_derived(self, user_ids):
+        """Счетчики, корзины и ленты: bulk_create не вызывает сигналы."""
+        recount()
+        ShoppingCartIngredient.objects.rebuild(user_ids)
+        if FeedEntry.objects.enabled():
+            FeedEntry.objects.rebuild(user_ids)
+        for model in (Tag, Ingredient, User, Recipe, Favorite):
+            bulk_changed.send(sender=model)
@@ -0,0 +1,123 @@
+"""
+Потоковая загрузка справочников из CSV и JSON.
+Файл читается по частям, записи вставляются пачками
+через bulk_create(ignore_conflicts=True) в одной транзакции.
+"""
+import csv
+import json
+import os
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from .signals import bulk_changed
+
+CHUNK_SIZE = 64 * 1024
+FORMATS = ('csv', 'json')
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_csv(file, fields):
+    """Строки CSV без заголовка как словари с ключами fields."""
+    for row in csv.reader(file):
+        if row:
+            yield dict(zip(fields, row))
+
+
+def iter_json(file, chunk_size=CHUNK_SIZE):
+    """
+    Элементы JSON-массива верхнего уровня по одному,
+    без загрузки всего файла в память.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+    started = eof = False
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Ожидается массив JSON.')
+                started, position = True, position + 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # элемент не дочитан: нужна следующая часть файла
+                if eof:
+                    raise
+            else:
+                yield item
+                continue
+        if eof:
+            raise ValueError('Неожиданный конец файла.')
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ImportCommand(BaseCommand):
+    """
+    Основа команд загрузки справочника.
+    Наследники задают модель, поля CSV и файл по умолчанию.
+    """
+    model = None
+    fields = ()
+    default_file = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            default=os.path.join(settings.BASE_DIR, 'data',
+                                 self.default_file),
+            help='Путь к файлу (по умолчанию data/%s).' % self.default_file)
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Формат файла, по умолчанию по расширению.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def make_object(self, row):
+        return self.model(**{field: row[field] for field in self.fields})
+
+    def after_import(self, rows):
+        """Обработка после вставки: например, обновление существующих."""
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(
+            path)[1].lstrip('.').lower()
+        if file_format not in FORMATS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+        before = self.model.objects.count()
+        read = 0
+        try:
+            with open(path, encoding='utf-8', newline='') as file:
+                rows = (iter_csv(file, self.fields) if file_format == 'csv'
+                        else iter_json(file))
+                with transaction.atomic():
+                    for batch in batches(rows, options['batch_size']):
+                        read += len(batch)
+                        self.model.objects.bulk_create(
+                            map(self.make_object, batch),
+                            ignore_conflicts=True)
+                        self.after_import(batch)
+        except (OSError, ValueError, KeyError, IntegrityError) as error:
+            raise CommandError(f'Ошибка чтения {path}: {error!r}')
+        bulk_changed.send(sender=self.model)
+        created = self.model.objects.count() - before
+        self.stdout.write(self.style.SUCCESS(
+            f'Прочитано: {read}, добавлено: {created}, '
+            f'уже были: {read - created}'))
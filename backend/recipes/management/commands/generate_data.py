@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from recipes.dataset import DatasetGenerator
+
+
+class Command(BaseCommand):
+    """
+    Заполнение базы синтетическими данными для нагрузочных замеров.
+    Пользователи создаются с именами prefix-N и паролем --password.
+    """
+    help = 'Генерация пользователей, рецептов и связей между ними.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--recipes', type=int, default=10,
+                            help='Рецептов на пользователя в среднем.')
+        parser.add_argument('--tags', type=int, default=6,
+                            help='Минимальное количество тегов.')
+        parser.add_argument('--ingredients', type=int, default=100,
+                            help='Минимальное количество ингредиентов.')
+        parser.add_argument('--favorites', type=int, default=20,
+                            help='Рецептов в избранном у пользователя.')
+        parser.add_argument('--carts', type=int, default=3,
+                            help='Рецептов в корзине у пользователя.')
+        parser.add_argument('--subscriptions', type=int, default=10,
+                            help='Подписок у пользователя.')
+        parser.add_argument('--prefix', default='synthetic')
+        parser.add_argument('--password', default='synthetic-password')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        created = DatasetGenerator(
+            users=options['users'], recipes=options['recipes'],
+            tags=options['tags'], ingredients=options['ingredients'],
+            favorites=options['favorites'], carts=options['carts'],
+            subscriptions=options['subscriptions'],
+            prefix=options['prefix'], password=options['password'],
+            seed=options['seed'], batch_size=options['batch_size']
+        ).generate()
+        for name, count in created.items():
+            self.stdout.write(f'{name}: {count}')
+        self.stdout.write(self.style.SUCCESS('Данные созданы!'))
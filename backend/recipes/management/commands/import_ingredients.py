@@ -1,25 +1,17 @@
-import json
-
-from django.core.management.base import BaseCommand
-
+from recipes.importers import ImportCommand
 from recipes.models import Ingredient
 
 
-class Command(BaseCommand):
+class Command(ImportCommand):
     """
-    Загрузка ингредиентов из json файла в базу данных.
+    Загрузка ингредиентов из CSV (название, единица измерения)
+    или JSON в базу данных. Уже существующие ингредиенты пропускаются.
     """
+    help = 'Загрузка ингредиентов из CSV или JSON.'
+    model = Ingredient
+    fields = ('name', 'measurement_unit')
+    default_file = 'ingredients.json'
 
-    def handle(self, *args, **options):
-        with open('data/ingredients.json', 'rb') as file:
-            data = json.load(file)
-            for item in data:
-                ingredient, created = Ingredient.objects.get_or_create(
-                    name=item['name'].capitalize(),
-                    measurement_unit=item['measurement_unit']
-                )
-                if created:
-                    print(f'Добавлен: {item["name"]}, '
-                          f'{item["measurement_unit"]}')
-
-        self.stdout.write(self.style.SUCCESS('База данных успешно заполнена!'))
+    def make_object(self, row):
+        return Ingredient(name=row['name'].capitalize(),
+                          measurement_unit=row['measurement_unit'])
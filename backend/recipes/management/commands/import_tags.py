@@ -1,26 +1,25 @@
-import json
-
-from django.core.management.base import BaseCommand
-
+from recipes.importers import ImportCommand
 from recipes.models import Tag
 
 
-class Command(BaseCommand):
+class Command(ImportCommand):
     """
-    Загрузка тегов из json файла в базу данных.
+    Загрузка тегов из CSV (название, цвет, slug) или JSON в базу данных.
+    У существующих тегов обновляются название и цвет.
     """
+    help = 'Загрузка тегов из CSV или JSON.'
+    model = Tag
+    fields = ('name', 'color', 'slug')
+    default_file = 'tags.json'
 
-    def handle(self, *args, **options):
-        with open('data/tags.json', 'rb') as file:
-            data = json.load(file)
-            for item in data:
-                tag, created = Tag.objects.get_or_create(
-                    name=item['name'],
-                    color=item['color'],
-                    slug=item['slug']
-                )
-                if created:
-                    print(f'Добавлен: {item["name"]}, '
-                          f'{item["color"]}, {item["slug"]}')
-
-        self.stdout.write(self.style.SUCCESS('База данных успешно заполнена!'))
+    def after_import(self, rows):
+        # в Django 3.2 нет bulk_create(update_conflicts=True)
+        tags = {tag.slug: tag for tag in Tag.objects.filter(
+            slug__in=[row['slug'] for row in rows])}
+        changed = []
+        for row in rows:
+            tag = tags.get(row['slug'])
+            if tag and (tag.name, tag.color) != (row['name'], row['color']):
+                tag.name, tag.color = row['name'], row['color']
+                changed.append(tag)
+        Tag.objects.bulk_update(changed, ['name', 'color'])
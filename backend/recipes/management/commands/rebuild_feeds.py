@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import FeedEntry
+
+
+class Command(BaseCommand):
+    """
+    Заполнение лент подписок (FeedEntry) по текущим подпискам.
+    Нужно после переключения FEED_STRATEGY на write.
+    """
+    help = 'Пересчет лент подписок пользователей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append',
+                            dest='users', help='id пользователя.')
+
+    def handle(self, *args, **options):
+        FeedEntry.objects.rebuild(options['users'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Записей в лентах: {FeedEntry.objects.count()}'))
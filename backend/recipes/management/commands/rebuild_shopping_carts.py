@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import ShoppingCartIngredient
+
+
+class Command(BaseCommand):
+    """
+    Проверка и пересчет сводных корзин покупок.
+    С флагом --check только выводит пользователей с расхождениями.
+    """
+    help = 'Пересчет сводных корзин покупок пользователей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Только проверить, без пересчета.')
+        parser.add_argument('--user', type=int, action='append',
+                            dest='users', help='id пользователя.')
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        expected = ShoppingCartIngredient.objects.calculate(user_ids)
+        stored = ShoppingCartIngredient.objects.stored(user_ids)
+        broken = sorted({
+            key[0] for key in expected.keys() | stored.keys()
+            if expected.get(key) != stored.get(key)
+        })
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет.'))
+            return
+        self.stdout.write(self.style.WARNING(
+            f'Расхождения у пользователей: {len(broken)} '
+            f'({", ".join(map(str, broken[:20]))})'))
+        if options['check']:
+            return
+        ShoppingCartIngredient.objects.rebuild(broken)
+        self.stdout.write(self.style.SUCCESS('Корзины пересчитаны!'))
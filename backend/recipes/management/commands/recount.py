@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from recipes.counters import mismatches, recount
+
+
+class Command(BaseCommand):
+    """
+    Сверка хранимых счетчиков (избранное, корзины, рецепты, подписчики)
+    с исходными данными. С флагом --check только выводит расхождения.
+    """
+    help = 'Пересчет счетчиков рецептов и пользователей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Только проверить, без пересчета.')
+
+    def handle(self, *args, **options):
+        broken = {name: count for name, count in mismatches().items()
+                  if count}
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет.'))
+            return
+        self.stdout.write(self.style.WARNING('Расхождения: ' + ', '.join(
+            f'{name} ({count})' for name, count in broken.items())))
+        if options['check']:
+            return
+        recount()
+        self.stdout.write(self.style.SUCCESS('Счетчики пересчитаны!'))
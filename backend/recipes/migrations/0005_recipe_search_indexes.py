@@ -0,0 +1,41 @@
+from django.db import migrations
+
+FORWARD_SQL = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    "CREATE INDEX IF NOT EXISTS recipe_search_vector_idx "
+    "ON recipes_recipe USING gin (("
+    "setweight(to_tsvector('russian', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce(text, '')), 'B')))",
+    'CREATE INDEX IF NOT EXISTS recipe_name_trgm_idx '
+    'ON recipes_recipe USING gin (name gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS recipe_text_trgm_idx '
+    'ON recipes_recipe USING gin (text gin_trgm_ops)',
+)
+
+REVERSE_SQL = (
+    'DROP INDEX IF EXISTS recipe_text_trgm_idx',
+    'DROP INDEX IF EXISTS recipe_name_trgm_idx',
+    'DROP INDEX IF EXISTS recipe_search_vector_idx',
+)
+
+
+def run_postgresql(statements):
+    """GIN-индексы поиска создаются только в PostgreSQL."""
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_shopping_cart_ingredient'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_postgresql(FORWARD_SQL),
+                             run_postgresql(REVERSE_SQL)),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:02
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+COUNTERS = (
+    ('recipes', 'Recipe', 'favorites_count', 'Favorite', 'recipe'),
+    ('recipes', 'Recipe', 'in_carts_count', 'ShoppingCart', 'recipe'),
+    ('users', 'User', 'recipes_count', 'Recipe', 'author'),
+    ('users', 'User', 'subscribers_count', 'Subscribe', 'author'),
+)
+
+
+def fill_counters(apps, schema_editor):
+    for app, model_name, field, related_name, link in COUNTERS:
+        model = apps.get_model(app, model_name)
+        related_model = apps.get_model('recipes', related_name)
+        model.objects.update(**{field: Coalesce(models.Subquery(
+            related_model.objects.filter(**{link: models.OuterRef('pk')})
+            .order_by().values(link).annotate(total=models.Count('pk'))
+            .values('total')
+        ), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_recipe_feed'),
+        ('users', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в избранное'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в корзину'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-id'], name='recipe_popularity_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.18 on 2026-10-18 18:05
+
+from django.db import migrations, models
+import recipes.storage
+
+
+def fill_media_files(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    MediaFile = apps.get_model('recipes', 'MediaFile')
+    MediaFile.objects.bulk_create(
+        MediaFile(name=name, ref_count=total)
+        for name, total in Recipe.objects.exclude(image='').values_list(
+            'image').annotate(total=models.Count('id')).order_by()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_image_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Имя файла')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Количество ссылок')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата изменения')),
+            ],
+            options={
+                'verbose_name': 'Файл изображения',
+                'verbose_name_plural': 'Файлы изображений',
+            },
+        ),
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(storage=recipes.storage.ContentAddressedStorage(), upload_to='recipes/images/', verbose_name='Изображение'),
+        ),
+        migrations.RunPython(fill_media_files, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,16 @@
+from django.conf import settings
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Value, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest, RowNumber
+from django.utils import timezone
 
 from users.models import User
 
+from .search import search as full_text_search
+from .storage import ContentAddressedStorage
+
 
 class Tag(models.Model):
     """
@@ -44,10 +52,96 @@ class Ingredient(models.Model):
         return f'{self.name} {self.measurement_unit}'
 
 
+class RecipeQuerySet(models.QuerySet):
+    """
+    Набор запросов для рецептов.
+    Позволяет выводить список рецептов фиксированным числом запросов.
+    """
+
+    def with_related(self):
+        """Автор через JOIN, теги и ингредиенты через prefetch."""
+        return self.select_related('author').prefetch_related(
+            'tags',
+            Prefetch('amounts', queryset=AmountIngredient.objects.
+                     select_related('ingredient').order_by('id'))
+        )
+
+    def with_user_flags(self, user):
+        """
+        Аннотация флагов is_favorited, is_in_shopping_cart
+        и подписки на автора для текущего пользователя.
+        """
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=Value(False, models.BooleanField()),
+                is_in_shopping_cart=Value(False, models.BooleanField()),
+                author_is_subscribed=Value(False, models.BooleanField())
+            )
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            author_is_subscribed=Exists(Subscribe.objects.filter(
+                user=user, author=OuterRef('author')))
+        )
+
+    def search(self, value):
+        """Поиск по названию и описанию с аннотацией релевантности rank."""
+        return full_text_search(self, value)
+
+    def latest_by_authors(self, author_ids, limit=None):
+        """
+        Последние рецепты авторов author_ids, не больше limit у каждого.
+        Номер рецепта у автора считает ROW_NUMBER() OVER (PARTITION BY
+        author_id), поэтому рецепты всех авторов выбираются одним запросом.
+        """
+        recipes = self.filter(author_id__in=author_ids)
+        if limit is None:
+            return recipes
+        ranked = recipes.order_by().annotate(position=Window(
+            RowNumber(),
+            partition_by=[F('author_id')],
+            order_by=[F('pub_date').desc(), F('id').desc()]
+        )).values('id', 'position')
+        # Django 3.2 не фильтрует по оконным функциям,
+        # поэтому номер проверяется во внешнем подзапросе
+        sql, params = ranked.query.sql_with_params()
+        return self.filter(id__in=RawSQL(
+            f'SELECT "id" FROM ({sql}) AS "ranked" WHERE "position" <= %s',
+            (*params, limit)
+        ))
+
+    def feed(self, user):
+        """
+        Лента пользователя при чтении (fan-out on read):
+        рецепты авторов из его подписок.
+        """
+        return self.filter(author__in=Subscribe.objects.filter(
+            user=user).values('author'))
+
+    def timeline(self, user):
+        """
+        Лента пользователя из таблицы FeedEntry (fan-out on write)
+        с датой публикации записи ленты feed_pub_date для сортировки.
+        """
+        return self.filter(feed_entries__user=user).annotate(
+            feed_pub_date=F('feed_entries__pub_date'))
+
+
 class Recipe(models.Model):
     """
     Модель для описания Рецепта.
     """
+    IMAGE_PENDING = 'pending'
+    IMAGE_READY = 'ready'
+    IMAGE_FAILED = 'failed'
+    IMAGE_STATUSES = (
+        (IMAGE_PENDING, 'Обрабатывается'),
+        (IMAGE_READY, 'Готово'),
+        (IMAGE_FAILED, 'Ошибка'),
+    )
+
     name = models.TextField('Название рецепта', max_length=200)
     text = models.TextField('Описание', max_length=3000)
     cooking_time = models.PositiveSmallIntegerField(
@@ -56,7 +150,11 @@ class Recipe(models.Model):
             1, message='Время должно быть больше 1 минуты!'
         )]
     )
-    image = models.ImageField('Изображение', upload_to='recipes/images/')
+    image = models.ImageField('Изображение', upload_to='recipes/images/',
+                              storage=ContentAddressedStorage())
+    image_status = models.CharField(
+        'Обработка изображения', max_length=16, choices=IMAGE_STATUSES,
+        default=IMAGE_PENDING, editable=False)
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -75,15 +173,39 @@ class Recipe(models.Model):
         verbose_name='Ингредиент'
     )
     pub_date = models.DateTimeField('Дата публикации', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    favorites_count = models.PositiveIntegerField(
+        'Добавлений в избранное', default=0, editable=False)
+    in_carts_count = models.PositiveIntegerField(
+        'Добавлений в корзину', default=0, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
-        ordering = ('-pub_date',)
+        ordering = ('-pub_date', '-id')
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(fields=('-pub_date', '-id'),
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='recipe_author_pub_date_idx'),
+            models.Index(fields=('-favorites_count', '-id'),
+                         name='recipe_popularity_idx')
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # имя изображения в базе: по нему ведется учет ссылок на файлы
+        loaded = dict(zip(field_names, values))
+        if 'image' in loaded:
+            instance._stored_image = loaded['image']
+        return instance
+
 
 class AmountIngredient(models.Model):
     """
@@ -185,6 +307,185 @@ class ShoppingCart(models.Model):
         return f'{self.recipe} добавлен в список пользователем {self.user}'
 
 
+class ShoppingCartIngredientQuerySet(models.QuerySet):
+    """
+    Поддержка сводного списка покупок пользователей в актуальном состоянии.
+    Изменения применяются приращениями количества по ингредиентам.
+    """
+
+    @staticmethod
+    def recipe_amounts(recipe):
+        return dict(recipe.amounts.values_list('ingredient_id', 'amount'))
+
+    def apply_changes(self, user_ids, changes):
+        """
+        Изменение количества ингредиентов в корзинах пользователей.
+        changes: {ingredient_id: изменение количества}.
+        """
+        changes = {ingredient_id: change
+                   for ingredient_id, change in changes.items() if change}
+        if not changes:
+            return
+        user_ids = list(user_ids)
+        if user_ids:
+            with transaction.atomic():
+                self.apply_user_changes(user_ids, changes)
+
+    def apply_user_changes(self, user_ids, changes):
+        """Изменения непустого списка корзин в транзакции вызывающего."""
+        # блокировка пользователей упорядочивает параллельные изменения
+        list(User.objects.select_for_update().filter(
+            id__in=user_ids).values_list('id'))
+        existing = {
+            (row.user_id, row.ingredient_id): row
+            for row in self.filter(user_id__in=user_ids,
+                                   ingredient_id__in=changes)
+        }
+        to_create, to_update, to_delete = [], [], []
+        for user_id in user_ids:
+            for ingredient_id, change in changes.items():
+                row = existing.get((user_id, ingredient_id))
+                if row is None:
+                    if change > 0:
+                        to_create.append(self.model(
+                            user_id=user_id, ingredient_id=ingredient_id,
+                            amount=change))
+                    continue
+                row.amount += change
+                if row.amount > 0:
+                    to_update.append(row)
+                else:
+                    to_delete.append(row.id)
+        self.bulk_create(to_create)
+        self.bulk_update(to_update, ['amount'])
+        self.filter(id__in=to_delete).delete()
+
+    @staticmethod
+    def recipes_amounts(recipe_ids):
+        """Количество ингредиентов, суммированное по рецептам."""
+        return dict(AmountIngredient.objects.filter(
+            recipe_id__in=recipe_ids).values_list('ingredient_id').annotate(
+            total=models.Sum('amount')).order_by())
+
+    def add_recipe(self, user, recipe):
+        self.apply_changes([user.id], self.recipe_amounts(recipe))
+
+    def remove_recipe(self, user, recipe):
+        self.apply_changes([user.id], {
+            ingredient_id: -amount for ingredient_id, amount
+            in self.recipe_amounts(recipe).items()
+        })
+
+    def add_recipes(self, user, recipe_ids):
+        self.apply_changes([user.id], self.recipes_amounts(recipe_ids))
+
+    def remove_recipes(self, user, recipe_ids):
+        self.apply_changes([user.id], {
+            ingredient_id: -amount for ingredient_id, amount
+            in self.recipes_amounts(recipe_ids).items()
+        })
+
+    def change_cart(self, user_id, recipe_id, sign):
+        """Добавление (sign=1) или вычитание (sign=-1) рецепта в корзине."""
+        self.apply_changes([user_id], {
+            ingredient_id: sign * amount for ingredient_id, amount
+            in self.recipes_amounts([recipe_id]).items()
+        })
+
+    def change_recipe(self, recipe_id, changes):
+        """Изменение состава рецепта в корзинах, где он лежит."""
+        self.apply_changes(ShoppingCart.objects.filter(
+            recipe_id=recipe_id).values_list('user_id', flat=True), changes)
+
+    def update_recipe(self, recipe, old_amounts, new_amounts):
+        """Перенос изменений состава рецепта в корзины, где он лежит."""
+        self.change_recipe(recipe.id, {
+            ingredient_id: (new_amounts.get(ingredient_id, 0)
+                            - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in old_amounts.keys() | new_amounts.keys()
+        })
+
+    @staticmethod
+    def calculate(user_ids=None):
+        """
+        Расчет корзин по исходным данным.
+        Результат: {(user_id, ingredient_id): количество}.
+        """
+        # одно условие на связь: второй filter() добавил бы еще один JOIN
+        # и задвоил суммы рецептов, лежащих в нескольких корзинах
+        if user_ids is None:
+            amounts = AmountIngredient.objects.filter(
+                recipe__shopping__isnull=False)
+        else:
+            amounts = AmountIngredient.objects.filter(
+                recipe__shopping__user_id__in=user_ids)
+        return {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in amounts.values_list(
+                'recipe__shopping__user_id', 'ingredient_id').annotate(
+                total=models.Sum('amount')).order_by()
+        }
+
+    def stored(self, user_ids=None):
+        rows = self.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        return {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in rows.values_list(
+                'user_id', 'ingredient_id', 'amount')
+        }
+
+    @transaction.atomic
+    def rebuild(self, user_ids=None):
+        """Полный пересчет корзин пользователей (или всех корзин)."""
+        rows = self.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        rows.delete()
+        self.bulk_create(
+            self.model(user_id=user_id, ingredient_id=ingredient_id,
+                       amount=amount)
+            for (user_id, ingredient_id), amount
+            in self.calculate(user_ids).items()
+        )
+
+
+class ShoppingCartIngredient(models.Model):
+    """
+    Сводное количество ингредиента в продуктовой корзине пользователя.
+    Обновляется при изменении корзины и рецептов в ней.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_ingredients',
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='cart_amounts',
+        verbose_name='Ингредиент'
+    )
+    amount = models.PositiveIntegerField('Количество')
+
+    objects = ShoppingCartIngredientQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Ингредиент в продуктовой корзине'
+        verbose_name_plural = 'Ингредиенты в продуктовой корзине'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_cart_ingredient'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} - {self.amount}'
+
+
 class Subscribe(models.Model):
     """
     Модель для оформления подписки на автора.
@@ -214,3 +515,168 @@ class Subscribe(models.Model):
 
     def __str__(self):
         return f'{self.user} подписан на пользователя {self.author}'
+
+
+class FeedEntryQuerySet(models.QuerySet):
+    """
+    Ленты подписчиков при записи (fan-out on write).
+    Записи создаются при публикации рецепта и подписке на автора,
+    только если настройка FEED_STRATEGY равна 'write'.
+    """
+
+    @staticmethod
+    def enabled():
+        return settings.FEED_STRATEGY == 'write'
+
+    def add_recipe(self, recipe):
+        """Рецепт в ленты всех подписчиков автора."""
+        if not self.enabled():
+            return
+        user_ids = Subscribe.objects.filter(
+            author_id=recipe.author_id).values_list('user_id', flat=True)
+        self.bulk_create(
+            (self.model(user_id=user_id, recipe_id=recipe.id,
+                        author_id=recipe.author_id, pub_date=recipe.pub_date)
+             for user_id in user_ids.iterator()),
+            batch_size=settings.FEED_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+    def subscribe(self, user, author):
+        """Рецепты автора в ленту нового подписчика."""
+        self.subscribe_many(user, [author.id])
+
+    def subscribe_many(self, user, author_ids):
+        """Рецепты нескольких авторов в ленту подписчика."""
+        if not self.enabled():
+            return
+        recipes = Recipe.objects.filter(author_id__in=author_ids).values_list(
+            'id', 'author_id', 'pub_date').order_by()
+        self.bulk_create(
+            (self.model(user_id=user.id, recipe_id=recipe_id,
+                        author_id=author_id, pub_date=pub_date)
+             for recipe_id, author_id, pub_date in recipes.iterator()),
+            batch_size=settings.FEED_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+
+    def unsubscribe(self, user, author):
+        self.unsubscribe_many(user, [author.id])
+
+    def unsubscribe_many(self, user, author_ids):
+        self.filter(user=user, author_id__in=author_ids).delete()
+
+    @transaction.atomic
+    def rebuild(self, user_ids=None):
+        """Полное заполнение лент пользователей (или всех лент)."""
+        entries = self.all()
+        subscriptions = Subscribe.objects.all()
+        if user_ids is not None:
+            entries = entries.filter(user_id__in=user_ids)
+            subscriptions = subscriptions.filter(user_id__in=user_ids)
+        entries.delete()
+        rows = Recipe.objects.filter(
+            author__subscribers__in=subscriptions
+        ).values_list('author__subscribers__user_id', 'id',
+                      'author_id', 'pub_date').order_by()
+        self.bulk_create(
+            (self.model(user_id=user_id, recipe_id=recipe_id,
+                        author_id=author_id, pub_date=pub_date)
+             for user_id, recipe_id, author_id, pub_date in rows.iterator()),
+            batch_size=settings.FEED_BATCH_SIZE
+        )
+
+
+class FeedEntry(models.Model):
+    """
+    Запись ленты: рецепт автора, на которого подписан пользователь.
+    Дата публикации скопирована из рецепта, чтобы лента читалась
+    по одному индексу (user, pub_date).
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Подписчик'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    objects = FeedEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            )
+        ]
+        indexes = [
+            models.Index(fields=('user', '-pub_date', '-recipe'),
+                         name='feed_user_pub_date_idx')
+        ]
+
+    def __str__(self):
+        return f'{self.recipe} в ленте пользователя {self.user}'
+
+
+class MediaFileQuerySet(models.QuerySet):
+    """
+    Счетчики ссылок на файлы изображений.
+    Файлы без ссылок удаляет команда gc_media.
+    """
+
+    def acquire(self, name):
+        if not name:
+            return
+        # обычно файл уже учтен: хватает одного UPDATE
+        if self.filter(name=name).update(
+                ref_count=F('ref_count') + 1, updated_at=timezone.now()):
+            return
+        media_file, created = self.get_or_create(
+            name=name, defaults={'ref_count': 1})
+        if not created:
+            self.acquire(name)
+
+    def release(self, name):
+        if not name:
+            return
+        self.filter(name=name).update(
+            ref_count=Greatest(F('ref_count') - 1, 0),
+            updated_at=timezone.now())
+
+    def orphans(self, before):
+        """Файлы без ссылок, последние изменения которых раньше before."""
+        return self.filter(ref_count=0, updated_at__lt=before)
+
+
+class MediaFile(models.Model):
+    """
+    Файл изображения в хранилище и число рецептов, которые на него
+    ссылаются. Одинаковые изображения хранятся одним файлом.
+    """
+    name = models.CharField('Имя файла', max_length=255, unique=True)
+    ref_count = models.PositiveIntegerField('Количество ссылок', default=0)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+
+    objects = MediaFileQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Файл изображения'
+        verbose_name_plural = 'Файлы изображений'
+
+    def __str__(self):
+        return f'{self.name} ({self.ref_count})'
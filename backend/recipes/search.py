@@ -0,0 +1,74 @@
+"""
+Полнотекстовый поиск рецептов.
+В PostgreSQL: русская морфология (to_tsvector) по названию и описанию
+и триграммное сходство (pg_trgm), индексы создает миграция 0005.
+В остальных СУБД: поиск по вхождению подстроки.
+"""
+from django.contrib.postgres.lookups import TrigramSimilar
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVectorField,
+                                            TrigramSimilarity)
+from django.db import connections
+from django.db.models import Case, FloatField, Q, TextField, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.lookups import PostgresOperatorLookup
+
+SEARCH_CONFIG = 'russian'
+
+# Выражение совпадает с индексом recipe_search_vector_idx из миграции,
+# иначе планировщик PostgreSQL не сможет его использовать.
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('russian', coalesce("
+    '"recipes_recipe"."name"'
+    ", '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce("
+    '"recipes_recipe"."text"'
+    ", '')), 'B')"
+)
+
+
+class TrigramWordSimilar(PostgresOperatorLookup):
+    """
+    Похожесть запроса на слова в длинном тексте (оператор %> из pg_trgm).
+    """
+    lookup_name = 'trigram_word_similar'
+    postgres_operator = '%%>'
+
+
+# поиск не требует django.contrib.postgres в INSTALLED_APPS
+TextField.register_lookup(TrigramSimilar)
+TextField.register_lookup(TrigramWordSimilar)
+
+
+def postgresql_search(queryset, value):
+    vector = RawSQL(SEARCH_VECTOR_SQL, [], output_field=SearchVectorField())
+    query = SearchQuery(value, config=SEARCH_CONFIG)
+    return queryset.alias(search_vector=vector).filter(
+        Q(search_vector=query)
+        | Q(name__trigram_similar=value)
+        | Q(text__trigram_word_similar=value)
+    ).annotate(
+        rank=SearchRank(vector, query) + TrigramSimilarity('name', value)
+    )
+
+
+def fallback_search(queryset, value):
+    return queryset.filter(
+        Q(name__icontains=value) | Q(text__icontains=value)
+    ).annotate(rank=Case(
+        When(name__iexact=value, then=Value(3.0)),
+        When(name__istartswith=value, then=Value(2.0)),
+        When(name__icontains=value, then=Value(1.0)),
+        default=Value(0.0),
+        output_field=FloatField()
+    ))
+
+
+def search(queryset, value):
+    """
+    Рецепты, найденные по строке value, с аннотацией rank:
+    чем выше, тем релевантнее.
+    """
+    if connections[queryset.db].vendor == 'postgresql':
+        return postgresql_search(queryset, value)
+    return fallback_search(queryset, value)
@@ -0,0 +1,115 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from .counters import change_counters
+from .models import (AmountIngredient, Favorite, MediaFile, Recipe,
+                     ShoppingCart, ShoppingCartIngredient, Subscribe)
+
+# массовое изменение модели sender без сигналов post_save
+# (bulk_create, update, запросы SQL): получатели сбрасывают свои кэши;
+# изменения связей пользователей передают их id в user_ids
+bulk_changed = Signal()
+
+
+@receiver(pre_save, sender=Recipe)
+def remember_stored_image(instance, **kwargs):
+    """
+    Имя изображения в базе до сохранения рецепта.
+    У загруженных из базы рецептов оно уже известно (Recipe.from_db).
+    """
+    if hasattr(instance, '_stored_image'):
+        return
+    instance._stored_image = None
+    if instance.pk is not None:
+        instance._stored_image = Recipe.objects.filter(
+            pk=instance.pk).values_list('image', flat=True).first()
+
+
+@receiver(post_save, sender=Recipe)
+def count_image_references(instance, **kwargs):
+    """Учет ссылок на файлы при добавлении и замене изображения."""
+    new_name = instance.image.name
+    if new_name != instance._stored_image:
+        MediaFile.objects.acquire(new_name)
+        MediaFile.objects.release(instance._stored_image)
+        instance._stored_image = new_name
+
+
+@receiver(post_delete, sender=Recipe)
+def release_image(instance, **kwargs):
+    MediaFile.objects.release(instance.image.name)
+
+
+# Хранимые счетчики при создании и удалении объектов через ORM (админка,
+# shell, каскадное удаление рецепта или пользователя). Связи API создает
+# и удаляет запросами без сигналов и меняет счетчики сам (api.utils).
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_save, sender=Subscribe)
+def count_created(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counters(instance, 1)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_delete, sender=Subscribe)
+def count_deleted(instance, **kwargs):
+    change_counters(instance, -1)
+
+
+# Сводная корзина при изменениях моделей не через API (админка, shell,
+# каскадное удаление рецепта или пользователя). Представления API
+# меняют корзины запросами без сигналов и обновляют ее сами.
+# При каскадном удалении рецепта сигналы post_delete приходят после
+# удаления строк своей модели, поэтому рецепт вычитается один раз:
+# либо вместе с корзиной, либо по строкам состава.
+
+
+@receiver(pre_save, sender=ShoppingCart)
+@receiver(pre_save, sender=AmountIngredient)
+def remember_stored_row(sender, instance, **kwargs):
+    """Строка в базе до сохранения, если объект уже существует."""
+    instance._stored_row = None
+    if instance.pk is not None:
+        instance._stored_row = sender.objects.filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=ShoppingCart)
+def save_cart_recipe(instance, **kwargs):
+    stored = instance._stored_row
+    if stored is not None:
+        if (stored.user_id, stored.recipe_id) == (instance.user_id,
+                                                  instance.recipe_id):
+            return
+        delete_cart_recipe(stored)
+    ShoppingCartIngredient.objects.change_cart(
+        instance.user_id, instance.recipe_id, 1)
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def delete_cart_recipe(instance, **kwargs):
+    ShoppingCartIngredient.objects.change_cart(
+        instance.user_id, instance.recipe_id, -1)
+
+
+@receiver(post_save, sender=AmountIngredient)
+def save_recipe_amount(instance, **kwargs):
+    stored = instance._stored_row
+    if stored is not None:
+        if (stored.recipe_id, stored.ingredient_id, stored.amount) == (
+                instance.recipe_id, instance.ingredient_id, instance.amount):
+            return
+        delete_recipe_amount(stored)
+    ShoppingCartIngredient.objects.change_recipe(
+        instance.recipe_id, {instance.ingredient_id: instance.amount})
+
+
+@receiver(post_delete, sender=AmountIngredient)
+def delete_recipe_amount(instance, **kwargs):
+    ShoppingCartIngredient.objects.change_recipe(
+        instance.recipe_id, {instance.ingredient_id: -instance.amount})
@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Хранилище, называющее файлы по SHA-256 содержимого.
+    Одинаковые файлы хранятся один раз: повторная запись только
+    возвращает имя уже сохраненного файла. Файл по имени никогда
+    не меняется, поэтому его можно кэшировать без ограничения срока.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.touch(name):
+            return name
+        try:
+            return super().save(name, content, max_length)
+        except FileExistsError:
+            # тот же файл одновременно записал другой запрос
+            return name
+
+    def touch(self, name):
+        """
+        Обновление времени изменения существующего файла: повторная
+        запись делает его "свежим", и gc_media не удалит его, пока ссылку
+        на него не сохранит рецепт. False - файла нет (или его успели
+        удалить), его нужно записать.
+        """
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def get_available_name(self, name, max_length=None):
+        """
+        Имя по хэшу не заменяется другим: занятое имя значит, что файл
+        с тем же содержимым уже записан, например параллельным запросом.
+        """
+        name = validate_file_name(str(name).replace('\\', '/'),
+                                  allow_relative_path=True)
+        if max_length and len(name) > max_length:
+            raise SuspiciousFileOperation(
+                f'Имя файла длиннее {max_length} символов: {name}')
+        if self.exists(name):
+            raise FileExistsError(name)
+        return name
+
+    @staticmethod
+    def hashed_name(name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest.hexdigest() + extension)
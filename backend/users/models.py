@@ -7,6 +7,10 @@ class User(AbstractUser):
     Модель для описания полей Пользователя.
     """
     email = models.EmailField('Почта', max_length=254, unique=True)
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов', default=0, editable=False)
+    subscribers_count = models.PositiveIntegerField(
+        'Количество подписчиков', default=0, editable=False)
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name',)
 
@@ -17,3 +21,14 @@ class User(AbstractUser):
 
     def __str__(self):
         return self.username
+
+    def refresh_from_db(self, using=None, fields=None):
+        """
+        Обращение к незагруженному полю загружает все незагруженные поля
+        одним запросом: пользователь из кэша токенов (api.authentication)
+        создается только с полями CACHED_USER_FIELDS.
+        """
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred.issuperset(fields):
+            fields = deferred
+        super().refresh_from_db(using, fields)